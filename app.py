@@ -4,228 +4,38 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import os, io, json, shutil, re
+import os, io, json, shutil, re, hashlib, uuid
 from datetime import datetime
 from pathlib import Path
 
+from batch_runner import build_batch_tasks, catalog_results, latest_uploads, run_batch, write_batch_output
+from upload_pipeline import UPLOAD_TYPES, UploadJobs, guess_country, upload_tasks
+from profit_core import (
+    CATALOG_MATCH_MIN_SCORE, CHART_HIST_BINS, CHART_MAX_MARKS, CONFIG_HISTORY_DIR, COUNTRY_CURRENCY, EXPORT_FORMATS,
+    META_DB, PERF_LOG_FILE, RATES_FILE, RATE_HISTORY_COLUMNS, RATE_HISTORY_FILE, RESULT_PAGE_SIZES, SHARED_CACHE,
+    SHEET_COLUMN, STREAM_MEMORY_MB, STREAM_PREVIEW_ROWS, UPLOAD_DIR, FeeConfigStore, MetaStore, PerfTrace,
+    ProductSearchIndex, ProfileCapture, ResultMemo, archive_previous_version, change_report, chart_max_products,
+    chart_products, chart_window, compact_results, compact_sheet, compute_profit, compute_profit_streaming,
+    consolidate_catalog, count_rows, diff_sheets, discard_previous_version, effective_conversion, effective_terms,
+    ensure_storage, evict_exports, export_cache_path, export_results, fee_chart_data, file_content_hash,
+    frame_nbytes, guess_column_mapping, invalidate_parse_cache, list_sheets_shared, load_rate_history, load_rates,
+    perf_span, previous_version_path, process_pool, product_ranking, profit_histogram, read_and_clean_shared,
+    result_key, result_page, sorted_results, style_results_page, sweep_profit, try_read_and_clean, update_profit,
+)
+
 # ============== 页面基本设置 ==============
 st.set_page_config(page_title="Profit Calculator — Multi-Country", layout="wide")
 st.title("💰 多国家利润计算器（合并表头自动清理 + 历史费率管理 + 可视化）")
 
-# ============== 文件与配置路径 ==============
-BASE_DIR = Path(".")
-UPLOAD_DIR = BASE_DIR / "uploads"
-META_FILE = BASE_DIR / "file_metadata.csv"
-CONFIG_FILE = BASE_DIR / "platform_fees.csv"
-CONFIG_HISTORY_DIR = BASE_DIR / "config_history"
-RATES_FILE = BASE_DIR / "exchange_rates.json"
-
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-CONFIG_HISTORY_DIR.mkdir(parents=True, exist_ok=True)
-if not META_FILE.exists():
-    pd.DataFrame(columns=["country", "filename", "filepath", "upload_date"]).to_csv(META_FILE, index=False)
-
-# ============== 国家与汇率默认 ==============
-COUNTRY_CURRENCY = {
-    "Thailand": "THB",
-    "Malaysia": "MYR",
-    "Vietnam": "VND",
-    "Philippines": "PHP",
-    "Indonesia": "IDR",
-}
-
-DEFAULT_RATES = {"THB": 7.8, "MYR": 1.0, "VND": 5400.0, "PHP": 12.0, "IDR": 3400.0}
-
-# ============== 平台费率配置初始化（示例文件） ==============
-def ensure_config_file():
-    if not CONFIG_FILE.exists():
-        demo = pd.DataFrame([
-            ["Thailand","Shopee","基础佣金",9,"示例"],
-            ["Thailand","Lazada","Full（FS+LazCoin）",13,"示例"],
-            ["Malaysia","Shopee","基础佣金",8,"示例"],
-        ], columns=["country","platform","scenario","fee_pct","remark"])
-        demo.to_csv(CONFIG_FILE, index=False)
-
-ensure_config_file()
-
-def load_fee_config():
-    try:
-        return pd.read_csv(CONFIG_FILE)
-    except Exception:
-        return pd.DataFrame(columns=["country","platform","scenario","fee_pct","remark"])
-
-def save_fee_config(df: pd.DataFrame, keep_history=True):
-    df.to_csv(CONFIG_FILE, index=False)
-    if keep_history:
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        shutil.copy(CONFIG_FILE, CONFIG_HISTORY_DIR / f"platform_fees_{ts}.csv")
-
-fee_df_global = load_fee_config()
-
-# ============== 辅助函数 ==============
-def clean_column_names_from_multiindex(cols):
-    """
-    cols: array-like from pandas MultiIndex or tuples
-    合并 multiindex header，去掉 Unnamed，拼接为单行列名
-    """
-    new_cols = []
-    for col in cols:
-        if isinstance(col, tuple) or isinstance(col, list):
-            parts = [str(x).strip() for x in col if x is not None and "Unnamed" not in str(x)]
-            joined = " ".join([p for p in parts if p and p.lower() != 'nan']).strip()
-            new_cols.append(joined if joined else None)
-        else:
-            c = str(col)
-            new_cols.append(c if c and "Unnamed" not in c and c.lower() != 'nan' else None)
-    # forward fill None
-    ser = pd.Series(new_cols)
-    if ser.isna().all():
-        # fallback: make synthetic names
-        return [f"Column_{i}" for i in range(len(new_cols))]
-    ser = ser.fillna(method="ffill").fillna(method="bfill")
-    return ser.tolist()
-
-def try_read_and_clean(path, header_idx):
-    """
-    读取 excel 或 csv，处理合并表头（Unnamed）：
-    - 尝试直接读取 header=header_idx
-    - 若有大量 Unnamed 或 None，则尝试 header=[0, header_idx] 合并两行表头并清理
-    - 最后把列名替换成 clean names（不会有 Unnamed）
-    """
-    p = Path(path)
-    df = None
-    if p.suffix.lower() in [".xlsx", ".xls"]:
-        # first try: read with single header
-        try:
-            df_try = pd.read_excel(path, header=header_idx)
-            cols = [str(c) for c in df_try.columns]
-            unnamed_count = sum(1 for c in cols if "Unnamed" in str(c) or str(c).strip() == "nan" or str(c).strip() == "")
-            if unnamed_count <= 0.3 * len(cols):  # mostly fine
-                # clean remaining unnamed by forward fill
-                clean_cols = []
-                for i, c in enumerate(df_try.columns):
-                    if c is None or str(c).startswith("Unnamed") or str(c).strip() == "":
-                        clean_cols.append(None)
-                    else:
-                        clean_cols.append(str(c).strip())
-                clean_cols = pd.Series(clean_cols).fillna(method="ffill").fillna(method="bfill")
-                df_try.columns = clean_cols
-                return df_try
-            else:
-                # try multi-row header read and combine
-                try:
-                    df2 = pd.read_excel(path, header=[0, header_idx])
-                    new_cols = clean_column_names_from_multiindex(df2.columns.values)
-                    df2.columns = new_cols
-                    return df2
-                except Exception:
-                    # fallback to initial but replace unnamed
-                    cols = [c if not str(c).startswith("Unnamed") else None for c in df_try.columns]
-                    cols = pd.Series(cols).fillna(method="ffill").fillna(method="bfill")
-                    df_try.columns = cols
-                    return df_try
-        except Exception:
-            # final fallback: read without header, create Column_*
-            df = pd.read_excel(path, header=None)
-            df.columns = [f"Column_{i}" for i in range(len(df.columns))]
-            return df
-    else:
-        # csv
-        try:
-            df_try = pd.read_csv(path, header=header_idx)
-            cols = [str(c) for c in df_try.columns]
-            unnamed_count = sum(1 for c in cols if "Unnamed" in str(c) or str(c).strip() == "nan" or str(c).strip() == "")
-            if unnamed_count <= 0.3 * len(cols):
-                clean_cols = []
-                for i, c in enumerate(df_try.columns):
-                    if c is None or str(c).startswith("Unnamed") or str(c).strip() == "":
-                        clean_cols.append(None)
-                    else:
-                        clean_cols.append(str(c).strip())
-                clean_cols = pd.Series(clean_cols).fillna(method="ffill").fillna(method="bfill")
-                df_try.columns = clean_cols
-                return df_try
-            else:
-                # fallback read without header
-                df = pd.read_csv(path, header=None)
-                df.columns = [f"Column_{i}" for i in range(len(df.columns))]
-                return df
-        except Exception:
-            # robust fallback
-            df = pd.read_csv(path, header=None)
-            df.columns = [f"Column_{i}" for i in range(len(df.columns))]
-            return df
-
-# 价格拆分：支持多分隔符
-def split_price_cell(v):
-    if pd.isna(v):
-        return []
-    s = str(v)
-    # replace common separators with comma
-    s = re.sub(r"[\/\|;，\s]+", ",", s)
-    parts = [p.strip() for p in s.split(",") if p.strip() != "" and p.strip().lower() not in ["nan","none"]]
-    out = []
-    for p in parts:
-        try:
-            out.append(float(p))
-        except:
-            # ignore non-numeric candidate
-            continue
-    return out
-
-# 样式：按条件上色（return DataFrame styler）
-def style_results(df_results):
-    # apply row-wise style: negative profit -> red; promotion -> green (but red dominates)
-    def row_style(row):
-        if pd.isna(row["利润 (MYR)"]):
-            return [""] * len(row)
-        if row["利润 (MYR)"] < 0:
-            return ["background-color:#ffd6d6"] * len(row)  # light red
-        if row.get("来源", "") == "Promotion":
-            return ["background-color:#e6ffe6"] * len(row)  # light green
-        return [""] * len(row)
-
-    sty = df_results.style.apply(lambda r: row_style(r), axis=1)
-
-    # ✅ 动态格式化函数：整数不加小数点，小数保留 2 位
-    def smart_format(x, prefix="", suffix=""):
-        try:
-            if pd.isna(x):
-                return "-"
-            if float(x).is_integer():
-                return f"{prefix}{int(x)}{suffix}"
-            else:
-                return f"{prefix}{x:,.2f}{suffix}"
-        except Exception:
-            return x
-
-    # 构建格式化规则
-    format_dict = {}
-    for col in df_results.columns:
-        if "利润 (MYR)" in col:
-            format_dict[col] = lambda x, p="RM ": smart_format(x, prefix=p)
-        elif "抽成" in col or "成本" in col or "卖价" in col:
-            format_dict[col] = lambda x: smart_format(x)
-        elif "%" in col:  # 利润率百分比
-            format_dict[col] = lambda x: smart_format(x, suffix="%")
-
-    sty = sty.format(format_dict, na_rep="-")
-    return sty
-
-
-    # 构建格式化规则
-    format_dict = {}
-    for col in df_results.columns:
-        if "利润 (MYR)" in col:
-            format_dict[col] = lambda x, p="RM ": smart_format(x, prefix=p)
-        elif "抽成" in col or "成本" in col or "卖价" in col:
-            format_dict[col] = lambda x: smart_format(x)
-        elif "%" in col:  # 利润率百分比
-            format_dict[col] = lambda x: smart_format(x, suffix="%")
-
-    sty = sty.format(format_dict, na_rep="-")
-    return sty
+# ============== 性能埋点：每次重跑一份分段计时（页面底部 “⏱ Performance” 查看，同时写入 perf_log.jsonl） ==============
+perf = PerfTrace(track_memory=st.session_state.get("perf_track_memory", False)).start()
+profile_capture = ProfileCapture().start() if st.session_state.pop("perf_profile_requested", False) else None
 
+# ============== 本地存储初始化（目录 / 上传记录 / 示例费率配置） ==============
+ensure_storage()
+meta_store = MetaStore(META_DB)
+# 解析好的表格 / 费率配置在进程内所有会话间共享（SHARED_CACHE），按会话登记引用
+session_holder = st.session_state.setdefault("shared_cache_holder", uuid.uuid4().hex)
 
 # ============== 侧边栏：国家选择 & 文件上传 ==============
 st.sidebar.header("🌍 国家选择")
@@ -233,30 +43,26 @@ countries = list(COUNTRY_CURRENCY.keys())
 country = st.sidebar.selectbox("选择国家", countries)
 
 st.sidebar.header("📤 上传价钱表")
-uploaded_file = st.sidebar.file_uploader(f"上传 {country} 的 Excel/CSV（表头可调整）", type=["xlsx","xls","csv"])
+uploaded_file = st.sidebar.file_uploader(f"上传 {country} 的 Excel/CSV（表头可调整）", type=UPLOAD_TYPES)
 if uploaded_file:
     save_dir = UPLOAD_DIR / country
     save_dir.mkdir(parents=True, exist_ok=True)
     save_path = save_dir / uploaded_file.name
-    with open(save_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-
-    # update meta
-    meta_df = pd.read_csv(META_FILE)
-    meta_df = meta_df[~((meta_df["country"] == country) & (meta_df["filename"] == uploaded_file.name))]
-    new_record = pd.DataFrame([{
-        "country": country,
-        "filename": uploaded_file.name,
-        "filepath": str(save_path),
-        "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }])
-    meta_df = pd.concat([meta_df, new_record], ignore_index=True)
-    meta_df.to_csv(META_FILE, index=False)
+    upload_hash = hashlib.sha1(uploaded_file.getbuffer()).hexdigest()
+    saved = meta_store.get(country, uploaded_file.name)
+    # 上传控件在每次重跑时都还在：内容没变就不重复写文件 / 作废缓存
+    if saved is None or saved["content_hash"] != upload_hash or not save_path.exists():
+        # 同名覆盖：旧版本连同解析缓存挪到 .previous/，供增量重算与“与上次上传相比”
+        archive_previous_version(save_path)
+        with open(save_path, "wb") as f:
+            f.write(uploaded_file.getbuffer())
+
+        # update meta（同名覆盖，原子写入）
+        meta_store.upsert(country, uploaded_file.name, save_path, content_hash=upload_hash, n_rows=count_rows(save_path))
     st.sidebar.success("✅ 文件已保存（同名保留最新）")
 
 # list uploaded files for selected country
-meta_df = pd.read_csv(META_FILE)
-country_files = meta_df[meta_df["country"] == country].sort_values("upload_date", ascending=False)
+country_files = meta_store.list_files(country)
 
 selected_file = None
 if not country_files.empty:
@@ -264,14 +70,16 @@ if not country_files.empty:
     selected_file = st.sidebar.selectbox("选择文件", country_files["filename"].tolist())
     if selected_file:
         info = country_files[country_files["filename"] == selected_file].iloc[0]
-        st.sidebar.caption(f"最后上传：{info['upload_date']}")
+        rows_note = f"，{int(info['n_rows']):,} 行" if pd.notna(info["n_rows"]) else ""
+        st.sidebar.caption(f"最后上传：{info['upload_date']}{rows_note}")
         if st.sidebar.button(f"🗑️ 删除此文件: {selected_file}"):
             try:
                 p = Path(info["filepath"])
                 if p.exists():
                     p.unlink()
-                meta_df = meta_df.drop(meta_df[(meta_df["country"] == country) & (meta_df["filename"] == selected_file)].index)
-                meta_df.to_csv(META_FILE, index=False)
+                invalidate_parse_cache(p)
+                discard_previous_version(p)
+                meta_store.delete(country, selected_file)
                 st.sidebar.success("✅ 已删除，刷新页面后生效")
                 st.stop()
             except Exception as e:
@@ -284,7 +92,7 @@ if st.sidebar.button("🧨 删除所有已上传文件与记录（所有国家
         if UPLOAD_DIR.exists():
             shutil.rmtree(UPLOAD_DIR)
         UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-        pd.DataFrame(columns=["country", "filename", "filepath", "upload_date"]).to_csv(META_FILE, index=False)
+        meta_store.clear()
         st.sidebar.success("✅ 已清空所有上传文件与记录")
         st.stop()
     except Exception as e:
@@ -296,26 +104,120 @@ header_row = st.sidebar.number_input("表头所在行（从1开始）", min_valu
 # 额外尝试：是否强制用 multi-row 合并（若你知道有多行表头）:
 try_merge_multirow = st.sidebar.checkbox("尝试合并多行表头（如果上传文件有多行标题）", value=False)
 
+# ============== 侧边栏：批量上传（多个文件 / 多个国家，后台并行解析） ==============
+@st.cache_resource
+def upload_executor():
+    # 所有会话共用一个进程池；解析在工作进程里做，页面不等待
+    return process_pool(min(4, os.cpu_count() or 1))
+
+if "upload_jobs" not in st.session_state:
+    st.session_state["upload_jobs"] = UploadJobs()
+    st.session_state["upload_batch"] = 0
+upload_jobs = st.session_state["upload_jobs"]
+
+with st.sidebar.expander("📦 批量上传（多个文件 / 多个国家）", expanded=bool(len(upload_jobs))):
+    pick_folder = st.radio("上传方式", ["选择文件", "选择文件夹"], horizontal=True) == "选择文件夹"
+    bulk_files = st.file_uploader("价钱表（国家按文件夹名 / 文件名识别）", type=UPLOAD_TYPES,
+                                  accept_multiple_files="directory" if pick_folder else True,
+                                  key=f"bulk_upload_{st.session_state['upload_batch']}")
+    fallback = st.selectbox("认不出国家的文件", ["跳过"] + countries, index=countries.index(country) + 1)
+    if bulk_files:
+        default_country = None if fallback == "跳过" else fallback
+        st.dataframe(pd.DataFrame({"文件": [f.name for f in bulk_files],
+                                   "国家": [guess_country(f.name, default_country) or "（跳过）" for f in bulk_files]}),
+                     use_container_width=True, hide_index=True)
+        if st.button("▶️ 后台解析并保存"):
+            tasks, skipped = upload_tasks([(f.name, f.getvalue()) for f in bulk_files], default_country,
+                                          header_idx=header_row - 1, merge_multirow=try_merge_multirow,
+                                          upload_dir=UPLOAD_DIR, meta_db=META_DB)
+            # 跳过的文件名存进会话：提交后整页重跑，这里直接提示会被清掉
+            st.session_state["upload_skipped"] = skipped
+            if tasks:
+                upload_jobs.submit(upload_executor(), tasks)
+                st.session_state["upload_running"] = True
+                st.session_state["upload_batch"] += 1  # 换 key 清空上传控件，避免重跑时重复提交
+                st.rerun()
+    skipped = st.session_state.get("upload_skipped")
+    if skipped:
+        st.warning(f"{len(skipped)} 个文件认不出国家，已跳过：{'、'.join(skipped)}")
+
+    def show_upload_jobs():
+        if not len(upload_jobs):
+            return
+        upload_jobs.sync()
+        jobs_df = upload_jobs.table()
+        done = len(jobs_df) - upload_jobs.pending
+        st.progress(done / len(jobs_df), text=f"{done}/{len(jobs_df)} 个文件")
+        st.dataframe(jobs_df, use_container_width=True, hide_index=True)
+        if upload_jobs.pending:
+            return
+        if st.session_state.pop("upload_running", False):
+            st.rerun()  # 全部完成：整页重跑，刷新文件列表
+        elif st.button("清除已完成"):
+            upload_jobs.clear_finished()
+            st.session_state["upload_skipped"] = []
+            st.rerun()
+
+    st.fragment(show_upload_jobs, run_every=1.0 if upload_jobs.pending else None)()
+
+# ============== 侧边栏：大文件 CSV 分块计算 ==============
+stream_csv = False
+if selected_file and str(selected_file).lower().endswith(".csv"):
+    st.sidebar.header("🚚 大文件分块计算")
+    stream_csv = st.sidebar.checkbox("分块流式计算（只预览前几行，结果直接写入文件）", value=False)
+    if stream_csv:
+        stream_memory_mb = st.sidebar.number_input("内存上限（MB）", min_value=32, max_value=16384, value=STREAM_MEMORY_MB, step=32)
+        stream_format = st.sidebar.selectbox("输出格式", ["csv.gz", "parquet", "xlsx"])
+
+# ============== 侧边栏：多工作表 Excel（选中的表各自识别表头、并行解析后合并） ==============
+selected_sheets = None
+no_sheet_picked = False
+if selected_file and not stream_csv and not str(selected_file).lower().endswith(".csv"):
+    try:
+        sheet_names = list_sheets_shared(country_files[country_files["filename"] == selected_file].iloc[0]["filepath"])
+    except Exception:
+        sheet_names = []
+    if len(sheet_names) > 1:
+        st.sidebar.header("📑 工作表")
+        picked = st.sidebar.multiselect(f"读取哪些工作表（共 {len(sheet_names)} 张，结果多一列“{SHEET_COLUMN}”）",
+                                        sheet_names, default=sheet_names)
+        # 全部取消 = 什么都不读（不退回第一张表）；只选第一张表时按原来的单表方式读取
+        if not picked:
+            no_sheet_picked = True
+        elif picked != sheet_names[:1]:
+            selected_sheets = [name for name in sheet_names if name in picked]
+
 # ============== 侧边栏：汇率设置（1 本币 = ? MYR） ==============
 st.sidebar.header("💱 汇率设置（换算为 MYR）")
-rates = {}
-if RATES_FILE.exists():
-    try:
-        rates = json.loads(RATES_FILE.read_text(encoding="utf-8"))
-    except:
-        rates = DEFAULT_RATES.copy()
-else:
-    rates = DEFAULT_RATES.copy()
+rates = load_rates(RATES_FILE)
 
 for cur in COUNTRY_CURRENCY.values():
-    rates[cur] = st.sidebar.number_input(f"1 {cur} = ? MYR", value=float(rates.get(cur, DEFAULT_RATES.get(cur, 1.0))), step=0.01)
+    rates[cur] = st.sidebar.number_input(f"1 {cur} = ? MYR", value=float(rates.get(cur, 1.0)), step=0.01)
 if st.sidebar.button("💾 保存汇率"):
     RATES_FILE.write_text(json.dumps(rates, ensure_ascii=False, indent=2), encoding="utf-8")
     st.sidebar.success("✅ 汇率已保存")
 
+# 汇率历史：按生效日期优先于上面的当前汇率
+rate_history = load_rate_history(RATE_HISTORY_FILE)
+rate_hist_file = st.sidebar.file_uploader("上传汇率历史 CSV（currency, rate, effective_from, effective_to）",
+                                          type=["csv"], key="rate_hist_up")
+if rate_hist_file is not None:
+    try:
+        new_hist = pd.read_csv(rate_hist_file)
+        if not {"currency", "rate"}.issubset(new_hist.columns):
+            st.sidebar.error("❌ 汇率历史至少需要 currency, rate 两列")
+        else:
+            new_hist.reindex(columns=RATE_HISTORY_COLUMNS).to_csv(RATE_HISTORY_FILE, index=False)
+            rate_history = load_rate_history(RATE_HISTORY_FILE)
+    except Exception as e:
+        st.sidebar.error(f"上传失败：{e}")
+if not rate_history.empty:
+    st.sidebar.caption(f"汇率历史 {len(rate_history)} 条（按生效日期优先使用）")
+
 # ============== 侧边栏：平台费率配置管理 ==============
 st.sidebar.header("⚙️ 平台费率配置管理")
-fee_df = load_fee_config()
+fee_store = FeeConfigStore(CONFIG_HISTORY_DIR)
+fee_df = fee_store.load(holder=session_holder)
 
 # upload new config CSV
 cfg_file = st.sidebar.file_uploader("上传新的 platform_fees.csv（覆盖）", type=["csv"], key="cfg_up")
@@ -326,29 +228,35 @@ if cfg_file is not None:
         if not required.issubset(set(new_cfg.columns)):
             st.sidebar.error(f"❌ 配置缺少列，请包含：{required}")
         else:
-            save_fee_config(new_cfg, keep_history=True)
-            st.sidebar.success("✅ 配置已更新并保存历史版本")
-            fee_df = load_fee_config()
+            fee_store.save(new_cfg, note=f"上传 {cfg_file.name}")
+            st.sidebar.success("✅ 配置已更新并保存历史版本（内容相同不重复保存）")
+            fee_df = fee_store.load(holder=session_holder)
     except Exception as e:
         st.sidebar.error(f"上传失败：{e}")
 
-# history rollback
-history_files = sorted(os.listdir(CONFIG_HISTORY_DIR), reverse=True)
-if history_files:
-    pick = st.sidebar.selectbox("选择历史版本回滚", history_files)
+# history rollback（只切换当前版本指针）
+fee_versions = fee_store.versions()
+if not fee_versions.empty:
+    version_labels = {
+        i: f"{r.timestamp} · {r.digest[:8]} · {r.note}" + ("（当前）" if r.digest == fee_store.head() else "")
+        for i, r in enumerate(fee_versions.itertuples(index=False))
+    }
+    pick = st.sidebar.selectbox("选择历史版本回滚", list(version_labels), format_func=version_labels.get)
     if st.sidebar.button("🔄 回滚到选定版本"):
         try:
-            shutil.copy(CONFIG_HISTORY_DIR / pick, CONFIG_FILE)
-            st.sidebar.success(f"✅ 已回滚到 {pick}，请刷新页面")
-            fee_df = load_fee_config()
+            fee_store.checkout(fee_versions["digest"].iloc[pick])
+            st.sidebar.success(f"✅ 已回滚到 {version_labels[pick]}")
+            fee_df = fee_store.load(holder=session_holder)
         except Exception as e:
             st.sidebar.error(f"回滚失败：{e}")
+fee_as_of = st.sidebar.date_input("按日期取生效的费率 / 汇率", value=datetime.now().date())
+fee_index = fee_store.index(as_of=fee_as_of)
 
 # download current config
-if CONFIG_FILE.exists():
+if fee_store.head():
     st.sidebar.download_button(
         label="⬇️ 下载当前 platform_fees.csv",
-        data=CONFIG_FILE.read_bytes(),
+        data=fee_store.read_bytes(),
         file_name="platform_fees.csv",
         mime="text/csv",
     )
@@ -362,6 +270,27 @@ if st.sidebar.button("🔁 从公开公告尝试同步（示范）"):
     except Exception as e:
         st.sidebar.error(f"同步失败：{e}")
 
+# ============== 侧边栏：批量计算（所有国家 × 所有方案） ==============
+st.sidebar.header("🧮 批量计算")
+batch_out = UPLOAD_DIR / ".results" / "batch_comparison.xlsx"
+batch_as_of = st.sidebar.radio("费率 / 汇率生效日期", ["按各文件上传日期", "按上面选择的日期"], horizontal=True)
+if st.sidebar.button("▶️ 计算所有已上传文件 × 所有费率方案"):
+    batch_tasks = build_batch_tasks(meta_store.list_files(), fee_df, rates, header_idx=header_row-1,
+                                    merge_multirow=try_merge_multirow, cache_root=UPLOAD_DIR,
+                                    rate_history=rate_history,
+                                    as_of="upload" if batch_as_of == "按各文件上传日期" else fee_as_of)
+    batch_bar = st.sidebar.progress(0.0, text=f"0/{len(batch_tasks)} 个文件")
+    batch_result, batch_errors = run_batch(
+        batch_tasks, progress=lambda done, total: batch_bar.progress(done / max(1, total), text=f"{done}/{total} 个文件"),
+    )
+    write_batch_output(batch_result, batch_out)
+    st.sidebar.success(f"✅ {len(batch_tasks)} 个文件，{len(batch_result):,} 条结果")
+    for path, msg in batch_errors:
+        st.sidebar.error(f"{path}：{msg}")
+if batch_out.exists():
+    st.sidebar.download_button("⬇️ 下载批量对比表", data=batch_out.read_bytes(), file_name=batch_out.name,
+                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
 with st.expander("📄 当前费率配置预览"):
     st.dataframe(fee_df, use_container_width=True)
 
@@ -390,39 +319,102 @@ if not fee_show.empty:
         .reset_index()
     )
     st.dataframe(sum_df, use_container_width=True)
+    # 方案太多时只画 国家 × 平台 的费率区间（最低–最高，点为平均），不把每个方案都发给浏览器
+    fee_chart_df, fee_chart_kind = fee_chart_data(fee_show)
     try:
         import altair as alt
-        chart = (
-            alt.Chart(fee_show)
-            .mark_bar()
-            .encode(
-                x=alt.X("fee_pct:Q", title="费率 (%)"),
-                y=alt.Y("scenario:N", title="方案", sort="-x"),
-                color=alt.Color("platform:N", title="平台"),
-                column=alt.Column("country:N", title="国家")
-            )
-            .properties(height=260)
-        )
-        st.altair_chart(chart, use_container_width=True)
+        with perf_span("fee_chart", rows=len(fee_show), kind=fee_chart_kind):
+            if fee_chart_kind == "detail":
+                chart = (
+                    alt.Chart(fee_chart_df)
+                    .mark_bar()
+                    .encode(
+                        x=alt.X("fee_pct:Q", title="费率 (%)"),
+                        y=alt.Y("scenario:N", title="方案", sort="-x"),
+                        color=alt.Color("platform:N", title="平台"),
+                        column=alt.Column("country:N", title="国家")
+                    )
+                    .properties(height=260)
+                )
+            else:
+                st.caption(f"共 {len(fee_show):,} 个方案，按 国家 × 平台 汇总显示（线为最低–最高费率，点为平均）")
+                base = alt.Chart(fee_chart_df).encode(
+                    y=alt.Y("platform:N", title="平台"),
+                    color=alt.Color("platform:N", title="平台", legend=None),
+                    tooltip=list(fee_chart_df.columns),
+                )
+                chart = (
+                    (base.mark_rule(strokeWidth=6).encode(x=alt.X("min_pct:Q", title="费率 (%)"), x2="max_pct:Q")
+                     + base.mark_point(filled=True, size=80, color="black").encode(x="avg_pct:Q"))
+                    .properties(height=160)
+                    .facet(row=alt.Row("country:N", title="国家"))
+                )
+            st.altair_chart(chart, use_container_width=True)
     except Exception:
         pass
 
+# ============== 跨国家商品对比（各国家最近上传的文件） ==============
+with st.expander("🌏 跨国家商品对比（各国家最近上传的文件，商品 × 国家 的利润）"):
+    g1, g2, g3 = st.columns([1, 1, 1])
+    with g1:
+        catalog_platform = st.selectbox("平台", sorted(fee_df["platform"].unique().tolist()), key="catalog_platform")
+    with g2:
+        catalog_agg = st.radio("多个卖价 / 方案时取", ["最高利润", "最低利润", "平均利润"], horizontal=True)
+    with g3:
+        catalog_fuzzy = st.checkbox("模糊匹配商品名（归一化后仍对不上的）", value=False)
+        catalog_min_score = st.slider("最低相似度", 0.3, 1.0, CATALOG_MATCH_MIN_SCORE, 0.05, disabled=not catalog_fuzzy)
+    if st.button("▶️ 生成跨国家对比"):
+        latest = latest_uploads(meta_store.list_files())
+        catalog_tasks = build_batch_tasks(latest, fee_df[fee_df["platform"] == catalog_platform], rates,
+                                          header_idx=header_row-1, merge_multirow=try_merge_multirow,
+                                          cache_root=UPLOAD_DIR, rate_history=rate_history, as_of=fee_as_of)
+        with st.spinner(f"计算 {len(catalog_tasks)} 个国家…"):
+            with perf_span("catalog_batch", files=len(catalog_tasks)):
+                catalog_batch, catalog_errors = run_batch(catalog_tasks)
+            st.session_state["catalog"] = consolidate_catalog(
+                catalog_results(catalog_batch),
+                agg={"最高利润": "max", "最低利润": "min", "平均利润": "mean"}[catalog_agg],
+                fuzzy=catalog_fuzzy, min_score=catalog_min_score)
+        for path, msg in catalog_errors:
+            st.error(f"{path}：{msg}")
+        no_fee = sorted(set(latest["country"]) - {t["country"] for t in catalog_tasks})
+        if no_fee:
+            st.warning(f"费率配置里没有 {catalog_platform} 的方案，已跳过：{'、'.join(no_fee)}")
+    if "catalog" in st.session_state:
+        catalog, catalog_matches = st.session_state["catalog"]
+        catalog_query = st.text_input("搜索商品", key="catalog_query")
+        catalog_show = catalog
+        if catalog_query:
+            catalog_show = catalog[catalog["产品名称"].str.contains(catalog_query, case=False, regex=False, na=False)]
+        st.caption(f"{len(catalog_show):,} / {len(catalog):,} 个商品（最多显示 1,000 行）")
+        st.dataframe(catalog_show.head(1000), use_container_width=True, hide_index=True)
+        st.download_button("⬇️ 下载跨国家对比 CSV", data=catalog.to_csv(index=False).encode("utf-8-sig"),
+                           file_name="catalog_by_country.csv", mime="text/csv")
+        if not catalog_matches.empty:
+            st.caption(f"模糊匹配 {len(catalog_matches):,} 个商品名：")
+            st.dataframe(catalog_matches, use_container_width=True, hide_index=True)
+
 st.divider()
 
 # ============== 读取选择的价钱表并计算利润 ==============
 df = None
-if selected_file:
+if selected_file and not no_sheet_picked:
     sel_info = country_files[country_files["filename"] == selected_file].iloc[0]
     fpath = sel_info["filepath"]
     # read & clean with helper (handles merged header)
     try:
-        df = try_read_and_clean(fpath, header_row-1)
+        if stream_csv:
+            # 分块模式：只读前几行用于预览和字段映射
+            df = try_read_and_clean(fpath, header_row-1, merge_multirow=try_merge_multirow, nrows=STREAM_PREVIEW_ROWS)
+        else:
+            df = read_and_clean_shared(fpath, header_row-1, merge_multirow=try_merge_multirow, cache_root=UPLOAD_DIR,
+                                       holder=session_holder, sheets=selected_sheets)
     except Exception as e:
         st.error(f"读取文件失败：{e}")
         df = None
 
 if df is None:
-    st.info("请在左侧上传/选择文件并设置表头行开始计算。")
+    st.info("请在左侧至少选择一张工作表。" if no_sheet_picked else "请在左侧上传/选择文件并设置表头行开始计算。")
 else:
     st.subheader("📋 数据预览（已尝试清理合并表头）")
     st.dataframe(df.head(), use_container_width=True)
@@ -431,135 +423,212 @@ else:
     st.sidebar.header("🔎 当前列名（用于映射）")
     st.sidebar.write(list(df.columns))
 
-    # 字段映射（带默认智能猜测 DESCRIPTION）
-    def guess_name_column_local(df):
-        patterns = [r"\b(desc(ription)?|product(\s*name)?|item(\s*name)?|name|title)\b",
-                    r"(产品|商品|品名|名稱|名称|标题|描述)",
-                    r"(ชื่อสินค้า|รายละเอียด)"]
-        cols = [str(c) for c in df.columns]
-        for pat in patterns:
-            for c in cols:
-                if re.search(pat, c, flags=re.IGNORECASE):
-                    return c
-        # fallback: first string-like column
-        for c in cols:
-            s = df[c].dropna()
-            if not s.empty:
-                # if many unique values => likely name
-                if s.astype(str).nunique() / max(1, len(s)) > 0.2:
-                    return c
-        return cols[0]
-
     st.sidebar.header("🧩 字段映射")
-    # default guesses
-    default_name = guess_name_column_local(df)
-    default_cost = "COST" if "COST" in df.columns else (None)
-    default_promo = "PROMOTION" if "PROMOTION" in df.columns else None
+    # default guesses（带默认智能猜测 DESCRIPTION）
+    default_mapping = guess_column_mapping(df)
+    default_name = default_mapping["name"]
+    default_cost = default_mapping["cost"]
+    default_promo = default_mapping["promo_cost"]
     name_col = st.sidebar.selectbox("产品名称列", [None] + list(df.columns), index=(list(df.columns).index(default_name)+1 if default_name in list(df.columns) else 0))
     cost_col = st.sidebar.selectbox("普通成本列（COST）", [None] + list(df.columns), index=(list(df.columns).index(default_cost)+1 if default_cost in list(df.columns) else 0))
     promo_cost_col = st.sidebar.selectbox("促销成本列（PROMOTION，可选）", [None] + list(df.columns), index=(list(df.columns).index(default_promo)+1 if default_promo in list(df.columns) else 0))
     promo_price_col = st.sidebar.selectbox("促销售价列（PROMO SELLING PRICE，可选）", [None] + list(df.columns))
-    # guess price columns by name containing price or selling
-    guess_price_cols = [c for c in df.columns if re.search(r"price|sell|selling|PRICE", str(c), re.I)]
-    price_cols = st.sidebar.multiselect("普通卖价列（可多选，支持多分隔符）", list(df.columns), default=guess_price_cols[:2] if guess_price_cols else [])
+    price_cols = st.sidebar.multiselect("普通卖价列（可多选，支持多分隔符）", list(df.columns), default=default_mapping["price_cols"])
+    date_col = None
+    if not stream_csv:
+        date_col = st.sidebar.selectbox("日期列（可选，逐行按日期取费率 / 汇率）", [None] + list(df.columns))
 
     # 平台抽成与个人抽成（默认从 fee config 中带入）
     st.sidebar.header("🏷️ 抽成/设置")
     # default platform choice
-    fee_country = fee_df[fee_df["country"] == country]
+    fee_choices = fee_index.scenarios(country)
     platform_choice = None
     platform_fee_pct = 0.0
-    if not fee_country.empty:
-        fee_country = fee_country.copy()
-        fee_country["display"] = fee_country["platform"] + " — " + fee_country["scenario"] + "（" + fee_country["remark"].fillna("") + "）"
-        platform_choice = st.sidebar.selectbox("选择平台/活动方案", fee_country["display"].tolist())
-        platform_fee_pct = float(fee_country.loc[fee_country["display"] == platform_choice, "fee_pct"].iloc[0])
+    if fee_choices:
+        platform_choice = st.sidebar.selectbox("选择平台/活动方案", fee_choices)
+        platform_fee_pct = fee_index.fee_for_label(country, platform_choice)
     else:
         platform_fee_pct = st.sidebar.number_input("平台费率（%）", value=5.0, step=0.1)
 
+    fee_overridden = False
     if platform_choice:
         # allow manual override
+        resolved_fee_pct = platform_fee_pct
         platform_fee_pct = st.sidebar.number_input("平台费率（%） - 手动覆盖", value=float(platform_fee_pct), step=0.1)
+        fee_overridden = platform_fee_pct != resolved_fee_pct
 
     personal_commission_pct = st.sidebar.number_input("个人抽成（%）", value=0.0, step=0.1)
 
     # 计算
     if name_col and (price_cols or promo_price_col) and (cost_col or promo_cost_col):
-        records = []
-        conv = float(rates[COUNTRY_CURRENCY[country]]) if float(rates[COUNTRY_CURRENCY[country]]) > 0 else 1.0
-
-        for _, row in df.iterrows():
-            product = str(row.get(name_col, "")).strip()
-            # promotion priority
-            use_promo = False
-            base_cost = np.nan
-            prices = []
-
-            if promo_cost_col and promo_price_col and pd.notna(row.get(promo_cost_col)) and pd.notna(row.get(promo_price_col)):
-                base_cost = pd.to_numeric(row.get(promo_cost_col), errors="coerce")
-                base_cost = 0.0 if pd.isna(base_cost) else float(base_cost)
-                prices = split_price_cell(row.get(promo_price_col))
-                use_promo = True
+        conv = as_of_conv = float(effective_conversion(rate_history, [COUNTRY_CURRENCY[country]],
+                                                       np.datetime64(fee_as_of), rates)[0])
+        if date_col:
+            # 逐行按日期取值；没填日期的行按上面选择的日期
+            row_dates = pd.to_datetime(df[date_col], errors="coerce", format="mixed").fillna(pd.Timestamp(fee_as_of))
+            if platform_choice and not fee_overridden:
+                row_platform, row_scenario = fee_index.key_for_label(country, platform_choice)
+                platform_fee_pct, conv = effective_terms(fee_df, rate_history, rates, country, row_platform,
+                                                         row_scenario, row_dates.to_numpy())
             else:
-                base_cost = pd.to_numeric(row.get(cost_col), errors="coerce") if cost_col else np.nan
-                base_cost = 0.0 if pd.isna(base_cost) else float(base_cost)
-                prices = []
-                for col in price_cols:
-                    prices += split_price_cell(row.get(col))
-                use_promo = False
-
-            # if no prices parsed skip
-            if not prices:
-                continue
-
-            for price in prices:
-                platform_fee_local = price * (platform_fee_pct / 100.0)
-                profit_local = price - base_cost - platform_fee_local
-                margin_pct = (profit_local / price * 100.0) if price > 0 else np.nan
-                personal_comm_local = profit_local * (personal_commission_pct / 100.0)
-
-                # convert to MYR
-                profit_myr = profit_local / conv
-                personal_comm_myr = personal_comm_local / conv
-
-                records.append({
-                    "产品名称": product,
-                    f"成本 ({COUNTRY_CURRENCY[country]})": base_cost,
-                    f"卖价 ({COUNTRY_CURRENCY[country]})": price,
-                    f"平台抽成 ({COUNTRY_CURRENCY[country]})": platform_fee_local,
-                    "利润 (MYR)": profit_myr,
-                    "利润率 %": margin_pct,
-                    "个人抽成 (MYR)": personal_comm_myr,
-                    "来源": "Promotion" if use_promo else "Normal",
-                    "平台方案": platform_choice or "自定义"
-                })
-
-        result_df = pd.DataFrame(records)
+                conv = effective_conversion(rate_history, np.full(len(df), COUNTRY_CURRENCY[country], dtype=object),
+                                            row_dates.to_numpy(), rates)
+        mapping = {
+            "name": name_col,
+            "cost": cost_col,
+            "promo_cost": promo_cost_col,
+            "promo_price": promo_price_col,
+            "price_cols": price_cols,
+            "sheet": SHEET_COLUMN if SHEET_COLUMN in df.columns else None,
+        }
+        if stream_csv:
+            st.subheader("🚚 分块计算（大文件 CSV，结果按原文件顺序写出）")
+            out_path = UPLOAD_DIR / country / ".results" / f"{Path(fpath).stem}_profit.{stream_format}"
+            if st.button("▶️ 开始分块计算并导出"):
+                bar = st.progress(0.0, text="计算中…")
+                summary = compute_profit_streaming(
+                    fpath, header_row-1, mapping, platform_fee_pct, personal_commission_pct, conv, out_path,
+                    currency=COUNTRY_CURRENCY[country], platform_label=platform_choice,
+                    merge_multirow=try_merge_multirow, memory_mb=stream_memory_mb,
+                    progress=lambda done, total: bar.progress(min(1.0, done / max(1, total)), text=f"已读取 {done / 1e6:,.1f} / {total / 1e6:,.1f} MB"),
+                )
+                bar.progress(1.0, text="完成")
+                st.success(f"✅ 已处理 {summary['rows_in']:,} 行，输出 {summary['rows_out']:,} 条结果")
+            if out_path.exists():
+                with open(out_path, "rb") as f:
+                    st.download_button(f"⬇️ 下载分块计算结果（{stream_format}）", data=f, file_name=out_path.name)
+            result_df = pd.DataFrame()
+        else:
+            # 会话内记忆：只改显示控件（搜索 / 筛选 / 分页 / 图表）时不重新计算
+            if "result_memo" not in st.session_state:
+                st.session_state["result_memo"] = ResultMemo()
+            memo = st.session_state["result_memo"]
+            memo_panel = st.sidebar.expander("🐞 结果缓存（调试）")
+            with memo_panel:
+                memo.max_mb = st.number_input("内存上限（MB）", min_value=16, max_value=16384, value=memo.max_mb, step=16, key="memo_mb")
+                memo.max_entries = st.number_input("最多缓存结果数", min_value=1, max_value=256, value=memo.max_entries, step=1, key="memo_n")
+                if st.button("清空结果缓存"):
+                    memo.clear()
+            # 本版与上一版的结果 key 只差文件：两处共用同一组参数
+            key_args = (header_row-1, try_merge_multirow, mapping, platform_fee_pct, personal_commission_pct, conv)
+            key_kwargs = {"currency": COUNTRY_CURRENCY[country], "platform_label": platform_choice,
+                          "sheets": selected_sheets}
+            key = result_key(fpath, *key_args, **key_kwargs)
+
+            # 同名文件被覆盖过：与上一版逐行对比，只重算新增 / 改动的行
+            prev_path = previous_version_path(fpath)
+            prev_df = None
+            if prev_path.exists():
+                try:
+                    prev_df = read_and_clean_shared(prev_path, header_row-1, merge_multirow=try_merge_multirow,
+                                                    cache_root=UPLOAD_DIR, holder=session_holder, slot="previous",
+                                                    sheets=selected_sheets)
+                except Exception:
+                    prev_df = None
+            if prev_df is None:
+                SHARED_CACHE.drop(session_holder, "previous")
+            sheet_diff = {}
+
+            def get_sheet_diff():
+                if not sheet_diff:
+                    sheet_diff.update(diff_sheets(prev_df, df, mapping))
+                return sheet_diff
+
+            def compute_result():
+                # 计算前瘦身：只留映射到的列，纯数字列转 float，重复多的文本转 category（不改变计算结果）
+                calc_df = compact_sheet(df, mapping, keep=[date_col])
+                raw = None
+                if prev_df is not None and np.ndim(platform_fee_pct) == 0 and np.ndim(conv) == 0:
+                    prev_result = memo.peek(result_key(prev_path, *key_args, **key_kwargs))
+                    if prev_result is not None:
+                        raw = sorted_results(update_profit(
+                            prev_result, get_sheet_diff(), calc_df, mapping, platform_fee_pct, personal_commission_pct,
+                            conv, currency=COUNTRY_CURRENCY[country], platform_label=platform_choice))
+                if raw is None:
+                    raw = sorted_results(compute_profit(
+                        calc_df, mapping, platform_fee_pct, personal_commission_pct, conv,
+                        currency=COUNTRY_CURRENCY[country], platform_label=platform_choice))
+                compact = compact_results(raw)
+                st.session_state["compact_stats"] = {"表格": (frame_nbytes(df), frame_nbytes(calc_df)),
+                                                     "结果": (frame_nbytes(raw), frame_nbytes(compact))}
+                return compact
+
+            with perf_span("result", rows=len(df)) as span:
+                hits_before = memo.hits
+                result_df = memo.get_or_compute(key, compute_result, pin=True)
+                span["memo_hit"] = memo.hits > hits_before
+            with memo_panel:
+                memo_stats = memo.stats()
+                st.write(f"命中 {memo_stats['hits']} / 未命中 {memo_stats['misses']}，淘汰 {memo_stats['evictions']}")
+                st.write(f"{memo_stats['entries']} 条结果，{memo_stats['memory_mb']:,.1f} MB")
+                for what, (before, after) in st.session_state.get("compact_stats", {}).items():
+                    st.write(f"{what}瘦身：{before / 2**20:,.1f} MB → {after / 2**20:,.1f} MB（{before / max(1, after):.1f}×）")
+                shared_stats = SHARED_CACHE.stats()
+                st.write(f"跨会话共享：{shared_stats['entries']} 份，{shared_stats['memory_mb']:,.1f} MB，"
+                         f"{shared_stats['sessions']} 个会话，命中 {shared_stats['hits']} / 加载 {shared_stats['loads']}")
+                st.dataframe(SHARED_CACHE.table(), use_container_width=True, hide_index=True)
+
+            if prev_df is not None:
+                with st.expander("🔁 与上次上传相比的变化"):
+                    changes = memo.get_or_compute(("changes", file_content_hash(prev_path)) + key, lambda: change_report(
+                        prev_df, df, mapping, get_sheet_diff(), platform_fee_pct, personal_commission_pct, conv,
+                        currency=COUNTRY_CURRENCY[country]))
+                    counts = changes["变化"].value_counts()
+                    c1, c2, c3, c4 = st.columns(4)
+                    c1.metric("新增价格", int(counts.get("新增", 0)))
+                    c2.metric("修改价格", int(counts.get("修改", 0)))
+                    c3.metric("删除价格", int(counts.get("删除", 0)))
+                    c4.metric("利润变化合计 (MYR)", f"{changes['利润变化 (MYR)'].sum():,.2f}")
+                    if changes.empty:
+                        st.info("映射到的列与上次上传相比没有变化")
+                    else:
+                        st.dataframe(changes.head(1000), use_container_width=True)
+                        st.download_button("⬇️ 下载变化明细 CSV", data=changes.to_csv(index=False).encode("utf-8-sig"),
+                                           file_name=f"{Path(fpath).stem}_changes.csv", mime="text/csv")
         if result_df.empty:
-            st.info("未解析到有效价格（请检查映射与价格格式）")
+            if not stream_csv:
+                st.info("未解析到有效价格（请检查映射与价格格式）")
         else:
-            # sort
-            result_df["产品名称"] = result_df["产品名称"].astype(str)
-            result_df = result_df.sort_values(by="利润 (MYR)", ascending=False).reset_index(drop=True)
-
-            # 筛选产品（全部转字符串，防止类型混合）
-            st.sidebar.header("🔎 产品筛选")
-            all_products = sorted(result_df["产品名称"].unique().tolist())
-            search_term = st.sidebar.text_input("🔍 搜索产品（支持模糊匹配）")
-            if search_term:
-                filtered_products = [p for p in all_products if search_term.lower() in str(p).lower()]
+            # 筛选产品：搜索索引每组结果建一次；每次输入只查索引，候选列表按相关度排好、最多 SEARCH_MAX_RESULTS 个
+            search_index = memo.get_or_compute(("search_index",) + key,
+                                               lambda: ProductSearchIndex(result_df["产品名称"]))
+            search_term = st.sidebar.text_input("🔍 搜索产品（前缀 / 任意片段，中文、泰文均可）")
+            with perf_span("product_search", rows=len(search_index)):
+                candidates = search_index.search(search_term)
+                matched_products = search_index.matching(search_term)
+            if candidates is None:
+                st.sidebar.caption(f"共 {len(search_index):,} 个产品，输入关键词后可从匹配结果里勾选")
+                picked = []
             else:
-                filtered_products = all_products
-
-            selected_products = st.sidebar.multiselect("选择要显示的产品", filtered_products, default=filtered_products)
-            filtered_df = result_df[result_df["产品名称"].isin(selected_products)]
+                more = f"，以下为最相关的前 {len(candidates):,} 个" if len(matched_products) > len(candidates) else ""
+                st.sidebar.caption(f"匹配 {len(matched_products):,} 个产品{more}")
+                picked = st.sidebar.multiselect("只看这些产品（不选 = 全部匹配的产品）", candidates)
+            if picked:
+                selected_products = picked
+            elif matched_products is not None:
+                selected_products = list(matched_products)
+            else:
+                selected_products = None
+            filtered_df = result_df if selected_products is None else result_df[result_df["产品名称"].isin(selected_products)]
 
-            # 显示并样式化（高亮）
+            # 显示并样式化（高亮）：服务端排序 + 分页，只样式化当前页
             st.subheader("📊 计算结果（按利润排序）")
-            display_df = filtered_df.copy()
+            display_df = filtered_df.reset_index(drop=True)
+            p1, p2, p3, p4 = st.columns([2, 1, 1, 1])
+            with p1:
+                sort_by = st.selectbox("排序列", list(display_df.columns), index=list(display_df.columns).index("利润 (MYR)"))
+            with p2:
+                sort_asc = st.checkbox("升序", value=False)
+            with p3:
+                page_size = st.selectbox("每页行数", RESULT_PAGE_SIZES, index=1)
+            n_pages = max(1, -(-len(display_df) // page_size))
+            with p4:
+                page = st.number_input(f"页码（共 {n_pages} 页）", min_value=1, max_value=n_pages, value=1, step=1)
+            page_df, _ = result_page(display_df, page, page_size, sort_by=sort_by, ascending=sort_asc)
             # 用 Styler 上色（Streamlit 会渲染 pandas Styler）
-            sty = style_results(display_df)
-            st.write(sty, unsafe_allow_html=True)
+            with perf_span("render_table", rows=len(page_df)):
+                st.write(style_results_page(page_df), unsafe_allow_html=True)
+            st.caption(f"共 {len(display_df):,} 条结果，当前第 {page} / {n_pages} 页")
             st.markdown(
     """
     **颜色说明：**
@@ -569,35 +638,158 @@ else:
 )
 
 
-            # 可视化利润对比
+            # 可视化利润对比：服务端先聚合，发给浏览器的图形数不超过 CHART_MAX_MARKS
             st.subheader("📈 产品利润对比（MYR）")
+            selection_digest = ("all" if selected_products is None
+                                else hashlib.sha1("\x00".join(selected_products).encode("utf-8")).hexdigest())
+            v1, v2, v3 = st.columns([2, 1, 2])
+            with v1:
+                chart_view = st.radio("图表", ["利润最高", "利润最低", "按名次区间", "利润分布"], horizontal=True)
             try:
                 import altair as alt
-                chart_data = display_df.groupby(["产品名称", "来源", f"卖价 ({COUNTRY_CURRENCY[country]})"])["利润 (MYR)"].sum().reset_index()
-                chart = (
-                    alt.Chart(chart_data)
-                    .mark_bar()
-                    .encode(
-                        x=alt.X("产品名称:N", sort="-y"),
-                        y=alt.Y("利润 (MYR):Q"),
-                        color=alt.Color("来源:N"),
-                        tooltip=list(chart_data.columns)
-                    )
-                    .properties(height=400)
-                )
-                st.altair_chart(chart, use_container_width=True)
+                if chart_view == "利润分布":
+                    with v2:
+                        hist_bins = st.slider("分箱数", 10, 100, CHART_HIST_BINS, 5)
+                    profit_values = display_df["利润 (MYR)"]
+                    with v3:
+                        profit_lo, profit_hi = float(profit_values.min()), float(profit_values.max())
+                        hist_range = (st.slider("利润区间（下钻）", profit_lo, profit_hi, (profit_lo, profit_hi))
+                                      if profit_hi > profit_lo else None)
+                    with perf_span("profit_chart", rows=len(display_df), view=chart_view):
+                        chart_data = profit_histogram(display_df, bins=hist_bins, value_range=hist_range)
+                        chart = (
+                            alt.Chart(chart_data)
+                            .mark_bar()
+                            .encode(
+                                x=alt.X("区间下限:Q", bin="binned", title="利润 (MYR)"),
+                                x2="区间上限:Q",
+                                y=alt.Y("数量:Q", stack=True),
+                                color=alt.Color("来源:N"),
+                                tooltip=list(chart_data.columns)
+                            )
+                            .properties(height=400)
+                        )
+                        st.altair_chart(chart, use_container_width=True)
+                else:
+                    # 排名按结果 + 产品筛选缓存：拖动名次 / 改产品数只取缓存结果里的一小段
+                    ranking = memo.get_or_compute(("chart_ranking", selection_digest) + key,
+                                                  lambda: product_ranking(display_df))
+                    max_products = min(len(ranking), chart_max_products(display_df))
+                    with v2:
+                        n_chart = st.number_input("产品数", min_value=1, max_value=max(1, max_products),
+                                                  value=min(30, max(1, max_products)), step=5)
+                    rank_start = 0
+                    if chart_view == "按名次区间":
+                        with v3:
+                            rank_start = st.slider("起始名次", 1, max(1, len(ranking) - n_chart + 1), 1) - 1
+                    view = {"利润最高": "top", "利润最低": "bottom"}.get(chart_view, "range")
+                    start, stop = chart_window(len(ranking), n_chart, view, rank_start)
+                    with perf_span("profit_chart", rows=len(display_df), view=chart_view):
+                        chart_data = chart_products(display_df, ranking, start, stop)
+                        chart = (
+                            alt.Chart(chart_data)
+                            .mark_bar()
+                            .encode(
+                                x=alt.X("产品名称:N", sort=ranking["产品名称"].iloc[start:stop].tolist()),
+                                y=alt.Y("利润 (MYR):Q"),
+                                color=alt.Color("来源:N"),
+                                tooltip=list(chart_data.columns)
+                            )
+                            .properties(height=400)
+                        )
+                        st.altair_chart(chart, use_container_width=True)
+                    st.caption(f"按利润合计排名第 {start + 1:,}–{stop:,} 名 / 共 {len(ranking):,} 个产品")
             except Exception:
-                st.bar_chart(display_df.set_index("产品名称")["利润 (MYR)"])
-
-            # 导出 Excel
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-                result_df.to_excel(writer, index=False, sheet_name="All_Results")
-                filtered_df.to_excel(writer, index=False, sheet_name="Filtered_Results")
-            st.download_button("⬇️ 下载结果 Excel", data=buffer.getvalue(), file_name=f"profit_results_{country}.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                ranking = product_ranking(display_df)
+                st.bar_chart(ranking.head(CHART_MAX_MARKS).set_index("产品名称")["利润合计 (MYR)"])
+
+            # 导出：点击后才生成（分批写出，不在内存里拼整个文件），同一组结果 + 筛选 + 格式只生成一次
+            st.subheader("⬇️ 导出结果")
+            e1, e2 = st.columns([1, 3])
+            with e1:
+                export_format = st.selectbox("导出格式", EXPORT_FORMATS)
+            export_dir = UPLOAD_DIR / country / ".results" / "exports"
+            export_path = export_cache_path(export_dir, (key, selection_digest), export_format,
+                                            stem=f"profit_results_{country}")
+            with e2:
+                if not export_path.exists() and st.button("🧾 生成导出文件"):
+                    export_settings = {
+                        "国家": country,
+                        "文件": selected_file,
+                        "表头所在行": int(header_row),
+                        "合并多行表头": bool(try_merge_multirow),
+                        "平台方案": platform_choice or "自定义",
+                        "平台费率 %": float(platform_fee_pct) if np.ndim(platform_fee_pct) == 0 else "按日期逐行",
+                        "个人抽成 %": float(personal_commission_pct),
+                        f"汇率（1 {COUNTRY_CURRENCY[country]} = ? MYR）": float(conv) if np.ndim(conv) == 0 else "按日期逐行",
+                        "生效日期": str(fee_as_of),
+                        "日期列": date_col,
+                        "产品名称列": name_col,
+                        "普通成本列": cost_col,
+                        "促销成本列": promo_cost_col,
+                        "促销售价列": promo_price_col,
+                        "普通卖价列": price_cols,
+                        "筛选后产品数": len(search_index) if selected_products is None else len(selected_products),
+                        "导出时间": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    }
+                    with st.spinner("生成中…"):
+                        export_results(export_path, result_df, filtered_df=filtered_df, settings=export_settings)
+                    evict_exports(export_dir)
+                if export_path.exists():
+                    with open(export_path, "rb") as f:
+                        st.download_button(f"⬇️ 下载结果（{export_format}）", data=f,
+                                           file_name=f"profit_results_{country}.{export_format}")
+
+            # 价格敏感度：该国家全部费率方案 × 汇率冲击，一次广播计算
+            with st.expander("📐 价格敏感度 / 保本价（全部费率方案 × 汇率冲击）"):
+                s1, s2 = st.columns([2, 1])
+                with s1:
+                    shock_text = st.text_input("汇率冲击 %（逗号分隔）", value="-10, 0, 10")
+                with s2:
+                    sweep_commission = st.number_input("个人抽成档位 %", value=float(personal_commission_pct), step=0.5)
+                try:
+                    shocks = [float(x) / 100.0 for x in re.split(r"[,，\s]+", shock_text.strip()) if x]
+                except ValueError:
+                    shocks = [0.0]
+                    st.warning("汇率冲击格式不对，已按 0 计算")
+                fee_grid = [(label, fee_index.fee_for_label(country, label)) for label in fee_index.scenarios(country)]
+                if not fee_grid:
+                    fee_grid = [(platform_choice or "自定义", float(np.nanmean(platform_fee_pct)))]
+                if st.button("▶️ 计算敏感度"):
+                    sweep = sweep_profit(df, mapping, fee_grid, as_of_conv, rate_shocks=shocks or [0.0],
+                                         commissions=[sweep_commission], currency=COUNTRY_CURRENCY[country])
+                    st.caption(f"{sweep.shape[0]:,} 个价格 × {sweep.shape[1]} 个方案 × {sweep.shape[2]} 档汇率")
+                    st.dataframe(sweep.summary(), use_container_width=True)
+                    be_table = sweep.break_even_table()
+                    st.dataframe(be_table.head(RESULT_PAGE_SIZES[-1]), use_container_width=True)
+                    be_buf = io.BytesIO()
+                    be_table.to_csv(be_buf, index=False, encoding="utf-8-sig")
+                    st.download_button("⬇️ 下载保本价表（CSV）", data=be_buf.getvalue(),
+                                       file_name=f"break_even_{country}.csv", mime="text/csv")
     else:
         st.warning("请至少映射：产品名 + 成本(普通或促销) + 卖价(促销或普通价列)")
 
+# ============== 性能面板 ==============
+with st.expander("⏱ Performance（本次重跑的分段耗时）"):
+    q1, q2 = st.columns([1, 1])
+    with q1:
+        st.checkbox("记录峰值内存（tracemalloc，会明显变慢）", key="perf_track_memory")
+    with q2:
+        st.button("🔬 采集一次 profile（重跑一次页面）", key="perf_profile_button",
+                  on_click=lambda: st.session_state.update(perf_profile_requested=True))
+    st.caption(f"本次重跑 {perf.total_ms:,.0f} ms（到此为止）；每段也写入 {PERF_LOG_FILE.name}")
+    st.dataframe(perf.to_frame(), use_container_width=True, hide_index=True)
+    if profile_capture is not None:
+        st.session_state["perf_profile"] = profile_capture.stop()
+        profile_capture = None
+    captured = st.session_state.get("perf_profile")
+    if captured:
+        st.caption(f"最近一次 profile（{captured['kind']}）：")
+        st.code(captured["text"][:20000], language="text")
+        st.download_button(f"⬇️ 下载 profile（{captured['file_name']}）", data=captured["data"],
+                           file_name=captured["file_name"], mime=captured["mime"])
+
 # ============== 结束 ==============
 st.caption("说明：本工具只抓取公开信息（示范），不会登录任何平台。费率/汇率请按实际业务情况确认。")
+perf.stop()
+perf.write_log(PERF_LOG_FILE, country=country, file=selected_file)
@@ -0,0 +1,226 @@
+# batch_runner.py
+# -*- coding: utf-8 -*-
+"""
+批量计算：上传记录（file_metadata.sqlite）里的每个文件 × 费率配置里该国家的每个（平台, 方案）
+- 费率 / 汇率默认按各文件的上传日期取当时生效的值（--as-of 可改成统一某天）
+- 每个文件一个任务，用 ProcessPoolExecutor 分到多个进程；价格在任务内只解析一次，各方案向量化计算
+- 所有结果合并成一张对比表（Comparison：产品 × 方案 的利润；All_Results：明细）
+- --catalog：再按商品名跨国家合并成 商品 × 国家 的利润宽表（见 consolidate_catalog）
+
+用法：
+    python batch_runner.py --out batch_comparison.xlsx [--workers 16] [--header-row 2] [--as-of 2025-03-31]
+    python batch_runner.py --latest --platform Shopee --catalog catalog.xlsx [--fuzzy]
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import pandas as pd
+
+from profit_core import (
+    COUNTRY_CURRENCY, RATE_HISTORY_FILE, MetaStore, ResultWriter, compute_profit_scenarios, consolidate_catalog,
+    current_fee_config, effective_conversion, effective_positions, guess_column_mapping, load_rate_history, load_rates,
+    process_pool, read_and_clean_cached, result_columns, scenario_label,
+)
+
+# 合并表里的币种无关列名（各国本币列统一成“本币”）
+BATCH_KEY_COLUMNS = ["国家", "币种", "文件", "平台", "方案", "费率 %", "生效日期"]
+
+def latest_uploads(meta_df):
+    """每个国家只保留最近上传的一个文件"""
+    dates = pd.to_datetime(meta_df["upload_date"], errors="coerce", format="mixed")
+    order = dates.sort_values(ascending=False, kind="stable", na_position="last").index
+    return meta_df.loc[order].drop_duplicates("country").reset_index(drop=True)
+
+def build_batch_tasks(meta_df, fee_df, rates, header_idx=1, merge_multirow=False, mapping=None,
+                      personal_commission_pct=0.0, cache_root=None, rate_history=None, as_of="upload"):
+    """
+    每个已上传文件一个任务，带上该国家的全部费率方案；没有方案的国家跳过
+    as_of: "upload" = 每个文件按自己的上传日期取生效的费率 / 汇率；也可以是一个日期（所有文件统一按这天）
+    所有 文件 × 方案 的费率、所有文件的汇率各用一次 merge_asof 解析（见 effective_positions）
+    """
+    meta_df = meta_df[meta_df["country"].map(COUNTRY_CURRENCY).notna()].reset_index(drop=True)
+    if as_of == "upload":
+        dates = pd.to_datetime(meta_df["upload_date"], errors="coerce", format="mixed").fillna(pd.Timestamp.now())
+    else:
+        dates = pd.Series(pd.Timestamp(as_of or pd.Timestamp.now()), index=meta_df.index)
+    files = meta_df.assign(_file=meta_df.index, date=dates.astype("datetime64[ns]"))
+    keys = fee_df[["country", "platform", "scenario"]].drop_duplicates()
+    pairs = files.merge(keys, on="country", how="inner", sort=False)
+    pos = effective_positions(fee_df, pairs, ["country", "platform", "scenario"])
+    pairs = pairs[pos >= 0].assign(_row=pos[pos >= 0])
+    currencies = files["country"].map(COUNTRY_CURRENCY)
+    convs = effective_conversion(rate_history, currencies.to_numpy(dtype=object), files["date"].to_numpy(), rates)
+
+    tasks = []
+    for i, group in pairs.groupby("_file", sort=True):
+        info = files.loc[i]
+        eff = fee_df.iloc[group["_row"].to_numpy()]
+        scenarios = [
+            (str(p), str(sc), scenario_label(p, sc, r), float(fee))
+            for p, sc, r, fee in zip(eff["platform"], eff["scenario"], eff["remark"], eff["fee_pct"])
+        ]
+        tasks.append({
+            "country": info["country"],
+            "currency": currencies[i],
+            "filename": info["filename"],
+            "filepath": str(info["filepath"]),
+            "as_of": info["date"].strftime("%Y-%m-%d"),
+            "header_idx": header_idx,
+            "merge_multirow": merge_multirow,
+            "mapping": mapping,
+            "scenarios": scenarios,
+            "personal_commission_pct": float(personal_commission_pct),
+            "conv": float(convs[i]),
+            "cache_root": str(cache_root) if cache_root else None,
+        })
+    return tasks
+
+def run_batch_task(task):
+    """单个文件：读取（走解析缓存）→ 映射 → 全部方案一起算 → 统一列名"""
+    df = read_and_clean_cached(task["filepath"], task["header_idx"], merge_multirow=task["merge_multirow"],
+                               cache_root=task["cache_root"])
+    mapping = task["mapping"] or guess_column_mapping(df)
+    scenarios = task["scenarios"]
+    res = compute_profit_scenarios(df, mapping, [(label, fee) for _, _, label, fee in scenarios],
+                                   task["personal_commission_pct"], task["conv"], currency=task["currency"])
+    cols = result_columns(task["currency"])
+    res = res.rename(columns={cols[1]: "成本 (本币)", cols[2]: "卖价 (本币)", cols[3]: "平台抽成 (本币)"})
+
+    per_label = {label: (platform, scenario, fee) for platform, scenario, label, fee in scenarios}
+    keys = res["平台方案"].map(per_label)
+    res.insert(0, "国家", task["country"])
+    res.insert(1, "币种", task["currency"])
+    res.insert(2, "文件", task["filename"])
+    res.insert(3, "平台", keys.str[0])
+    res.insert(4, "方案", keys.str[1])
+    res.insert(5, "费率 %", keys.str[2].astype(float))
+    res.insert(6, "生效日期", task.get("as_of"))
+    return res
+
+def run_batch(tasks, max_workers=None, progress=None):
+    """
+    并行执行全部任务；max_workers=1 时在当前进程顺序执行（便于调试）
+    progress: 可选回调 progress(已完成任务数, 总任务数)
+    返回 (合并后的明细 DataFrame, [(文件路径, 错误信息), ...])
+    """
+    frames, errors = [], []
+    total = len(tasks)
+    if max_workers == 1:
+        for i, task in enumerate(tasks, 1):
+            try:
+                frames.append(run_batch_task(task))
+            except Exception as e:
+                errors.append((task["filepath"], str(e)))
+            if progress is not None:
+                progress(i, total)
+    elif tasks:
+        with process_pool(max_workers) as pool:
+            futures = {pool.submit(run_batch_task, task): task for task in tasks}
+            for i, fut in enumerate(as_completed(futures), 1):
+                try:
+                    frames.append(fut.result())
+                except Exception as e:
+                    errors.append((futures[fut]["filepath"], str(e)))
+                if progress is not None:
+                    progress(i, total)
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=BATCH_KEY_COLUMNS), errors
+    result = pd.concat(frames, ignore_index=True)
+    result = result.sort_values(["国家", "文件", "平台", "方案"], kind="stable").reset_index(drop=True)
+    return result, errors
+
+def comparison_table(result):
+    """产品 × 方案 的利润 (MYR) 宽表：每行一个（国家, 文件, 产品, 来源, 卖价），每列一个平台方案"""
+    if result.empty:
+        return result
+    index = ["国家", "文件", "产品名称", "来源", "卖价 (本币)"]
+    wide = result.pivot_table(index=index, columns="平台方案", values="利润 (MYR)", aggfunc="max", sort=False)
+    wide.columns = [f"利润 (MYR) | {c}" for c in wide.columns]
+    return wide.reset_index()
+
+def catalog_results(result, platform=None):
+    """批量明细 → {国家: 结果}（按 COUNTRY_CURRENCY 的国家顺序），可只取某个平台的方案，供 consolidate_catalog 使用"""
+    if platform:
+        result = result[result["平台"] == platform]
+    groups = dict(tuple(result.groupby("国家", sort=False)))
+    return {c: groups[c] for c in COUNTRY_CURRENCY if c in groups}
+
+def write_catalog_output(catalog, matches, out_path):
+    """.xlsx：Catalog + Matches 两个工作表；其它格式只写宽表"""
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if out_path.suffix.lower() == ".xlsx":
+        with pd.ExcelWriter(out_path, engine="xlsxwriter") as writer:
+            catalog.to_excel(writer, index=False, sheet_name="Catalog")
+            matches.to_excel(writer, index=False, sheet_name="Matches")
+    else:
+        with ResultWriter(out_path) as writer:
+            writer.write(catalog)
+    return out_path
+
+def write_batch_output(result, out_path):
+    """.xlsx：Comparison + All_Results 两个工作表；其它格式（.parquet / .csv / .csv.gz）只写明细"""
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if out_path.suffix.lower() == ".xlsx":
+        with pd.ExcelWriter(out_path, engine="xlsxwriter") as writer:
+            comparison_table(result).to_excel(writer, index=False, sheet_name="Comparison")
+            result.to_excel(writer, index=False, sheet_name="All_Results")
+    else:
+        with ResultWriter(out_path) as writer:
+            writer.write(result)
+    return out_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量计算：所有已上传文件 × 所有费率方案")
+    parser.add_argument("--meta", default="file_metadata.sqlite", help="上传记录（默认 file_metadata.sqlite；也接受旧版 .csv）")
+    parser.add_argument("--fees", help="费率配置 CSV（默认 config_history/ 里的当前版本）")
+    parser.add_argument("--rates", default="exchange_rates.json", help="汇率（1 本币 = ? MYR）")
+    parser.add_argument("--rate-history", default=str(RATE_HISTORY_FILE),
+                        help="汇率历史（currency, rate, effective_from, effective_to），按日期优先于 --rates")
+    parser.add_argument("--as-of", default="upload",
+                        help="按哪天生效的费率 / 汇率计算：upload = 各文件上传日期（默认），或 YYYY-MM-DD")
+    parser.add_argument("--out", default="batch_comparison.xlsx", help="输出文件（.xlsx / .parquet / .csv / .csv.gz）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="进程数（默认 CPU 核数）")
+    parser.add_argument("--header-row", type=int, default=2, help="表头所在行（从 1 开始，默认 2）")
+    parser.add_argument("--merge-multirow", action="store_true", help="强制合并多行表头")
+    parser.add_argument("--commission", type=float, default=0.0, help="个人抽成 %%")
+    parser.add_argument("--latest", action="store_true", help="每个国家只算最近上传的一个文件")
+    parser.add_argument("--platform", help="只算这个平台的方案")
+    parser.add_argument("--catalog", help="另外输出 商品 × 国家 的利润宽表（.xlsx / .parquet / .csv / .csv.gz）")
+    parser.add_argument("--catalog-agg", choices=["max", "min", "mean"], default="max",
+                        help="同一国家同一商品多个卖价 / 方案时取最高（默认）/ 最低 / 平均利润")
+    parser.add_argument("--fuzzy", action="store_true", help="名称归一化后仍对不上的商品再做模糊匹配")
+    args = parser.parse_args(argv)
+
+    meta_df = pd.read_csv(args.meta) if args.meta.lower().endswith(".csv") else MetaStore(args.meta).list_files()
+    if args.latest:
+        meta_df = latest_uploads(meta_df)
+    fee_df = pd.read_csv(args.fees) if args.fees else current_fee_config()
+    if args.platform:
+        fee_df = fee_df[fee_df["platform"] == args.platform]
+    tasks = build_batch_tasks(meta_df, fee_df, load_rates(args.rates), header_idx=args.header_row - 1,
+                              merge_multirow=args.merge_multirow, personal_commission_pct=args.commission,
+                              rate_history=load_rate_history(args.rate_history), as_of=args.as_of)
+    result, errors = run_batch(
+        tasks, max_workers=args.workers,
+        progress=lambda done, total: print(f"\r{done}/{total} 个文件", end="", file=sys.stderr),
+    )
+    print(file=sys.stderr)
+    for path, msg in errors:
+        print(f"失败：{path}：{msg}", file=sys.stderr)
+    out = write_batch_output(result, args.out)
+    print(f"{len(tasks)} 个文件，{len(result):,} 条结果 → {out}")
+    if args.catalog:
+        catalog, matches = consolidate_catalog(catalog_results(result), agg=args.catalog_agg, fuzzy=args.fuzzy)
+        out = write_catalog_output(catalog, matches, args.catalog)
+        print(f"{len(catalog):,} 个商品，{len(matches):,} 个模糊匹配 → {out}")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
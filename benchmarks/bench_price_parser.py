@@ -0,0 +1,70 @@
+# benchmarks/bench_price_parser.py
+# -*- coding: utf-8 -*-
+"""
+价格解析基准：逐格 split_price_cell vs 批量 parse_price_series
+用法：python benchmarks/bench_price_parser.py [cells]   （默认 1,000,000 格）
+"""
+
+import re
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from profit_core import parse_price_series, split_price_cell  # noqa: E402
+from synth import make_price_cells  # noqa: E402
+
+
+def legacy_split_price_cell(v):
+    """优化前的实现（每格 re.sub + split + try/float），作为对照"""
+    if pd.isna(v):
+        return []
+    s = str(v)
+    s = re.sub(r"[\/\|;，\s]+", ",", s)
+    parts = [p.strip() for p in s.split(",") if p.strip() != "" and p.strip().lower() not in ["nan","none"]]
+    out = []
+    for p in parts:
+        try:
+            out.append(float(p))
+        except:
+            continue
+    return out
+
+
+def _long_from_cells(lists):
+    """逐格结果 → long-form；只去掉没有价格的格，解析出的 NaN 价格（如 "+nan"）保留"""
+    long = lists[lists.str.len() > 0].explode()
+    return pd.DataFrame({"row": long.index.to_numpy(dtype=np.int64),
+                         "price": long.to_numpy(dtype=float)})
+
+
+def main(n=1_000_000):
+    s = make_price_cells(n)
+    timings = {}
+
+    t = time.perf_counter()
+    legacy = _long_from_cells(s.map(legacy_split_price_cell))
+    timings["legacy split_price_cell"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    per_cell = _long_from_cells(s.map(split_price_cell))
+    timings["split_price_cell (compiled)"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    bulk = parse_price_series(s)
+    timings["parse_price_series"] = time.perf_counter() - t
+
+    pd.testing.assert_frame_equal(legacy, per_cell, check_exact=True)
+    pd.testing.assert_frame_equal(legacy, bulk, check_exact=True)
+
+    base = timings["legacy split_price_cell"]
+    print(f"{n:,} cells → {len(bulk):,} prices")
+    for name, sec in timings.items():
+        print(f"  {name:<30} {sec:8.3f}s  {n / sec:12,.0f} cells/s  x{base / sec:.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,190 @@
+# benchmarks/bench_suite.py
+# -*- coding: utf-8 -*-
+"""
+热点路径基准：合成价钱表（synth.py）× 行数 × 格式，逐段计时
+- read：try_read_and_clean（两行合并表头）
+- split：split_price_cell 逐格 / parse_price_columns 批量
+- compute：compute_profit
+- sweep：sweep_profit（50 个费率方案 × 3 档汇率冲击）
+- style：style_results(...).to_html()（整表）
+- style_page：result_page + style_results_page(...).to_html()（按利润排序后的第一页）
+- export：与 app 相同的 export_results 分批导出（All_Results + Filtered_Results + Settings）
+
+每段报告：最快一次耗时、吞吐（行/秒）、峰值内存（tracemalloc，单独跑一次，不计入耗时）
+结果可存为 JSON 基线，之后用 --compare 对比（耗时超出阈值记为回退，退出码 1）
+
+用法：
+    python benchmarks/bench_suite.py --rows 1000 100000 --formats csv xlsx --save benchmarks/baselines/local.json
+    python benchmarks/bench_suite.py --rows 1000 100000 --compare benchmarks/baselines/local.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE))
+from profit_core import (  # noqa: E402
+    compute_profit, export_results, parse_price_columns, result_page, split_price_cell, style_results,
+    style_results_page, sweep_profit, try_read_and_clean,
+)
+from synth import HEADER_IDX, make_price_sheet, sheet_mapping, write_price_sheet  # noqa: E402
+
+STAGES = ["read", "split_price_cell", "parse_price_columns", "compute", "sweep", "style", "style_page", "export"]
+DATA_DIR = HERE / ".data"
+# 逐格 / Styler 渲染 / Excel 导出在大表上很慢（且 Excel 有 1,048,576 行上限），超过上限的规模跳过
+DEFAULT_LIMITS = {"split_price_cell": 1_000_000, "style": 100_000, "export": 1_000_000}
+
+
+def synthetic_file(n_rows, fmt, seed=0):
+    """生成（或复用已生成的）合成文件"""
+    path = DATA_DIR / f"synthetic_{n_rows}_{seed}.{fmt}"
+    if not path.exists():
+        write_price_sheet(make_price_sheet(n_rows, seed=seed), path)
+    return path
+
+
+def export_excel(result_df):
+    path = DATA_DIR / "export_bench.xlsx"
+    export_results(path, result_df, filtered_df=result_df, settings={"平台费率 %": 9.0, "汇率": 7.8})
+    return path.stat().st_size
+
+
+def measure(fn, repeat=3, memory=True):
+    """返回 (最快耗时秒, 峰值内存 MB 或 None, 最后一次的返回值)"""
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t)
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return best, peak_mb, out
+
+
+def run_case(path, n_rows, repeat=3, memory=True, limits=DEFAULT_LIMITS, stages=STAGES):
+    """单个文件跑全部阶段；返回 {stage: {...}}"""
+    results = {}
+
+    def record(stage, rows, fn):
+        if stage not in stages:
+            return None
+        if rows > limits.get(stage, float("inf")):
+            results[stage] = {"skipped": f"rows {rows:,} > limit {limits[stage]:,}"}
+            return None
+        sec, peak, out = measure(fn, repeat=repeat, memory=memory)
+        results[stage] = {"rows": int(rows), "seconds": sec, "rows_per_s": rows / sec if sec > 0 else None,
+                          "peak_mb": peak}
+        return out
+
+    # 后面的阶段需要前面的结果：即使没选 read / compute，也先算出输入
+    df = record("read", n_rows, lambda: try_read_and_clean(path, HEADER_IDX, merge_multirow=True))
+    if df is None:
+        df = try_read_and_clean(path, HEADER_IDX, merge_multirow=True)
+    mapping = sheet_mapping(df.columns)
+
+    cells = pd.concat([df[c] for c in mapping["price_cols"]], ignore_index=True).tolist()
+    record("split_price_cell", len(cells), lambda: [split_price_cell(v) for v in cells])
+    record("parse_price_columns", len(cells), lambda: parse_price_columns(df, mapping["price_cols"]))
+
+    def compute():
+        return compute_profit(df, mapping, 9.0, 1.0, 7.8, currency="THB", platform_label="Shopee")
+    result = record("compute", n_rows, compute)
+    if result is None:
+        result = compute()
+
+    sweep_grid = [(f"方案 {k}", k * 0.5) for k in range(50)]
+    record("sweep", n_rows, lambda: sweep_profit(df, mapping, sweep_grid, 7.8, rate_shocks=[-0.1, 0.0, 0.1]))
+    record("style", len(result), lambda: style_results(result).to_html())
+    record("style_page", len(result),
+           lambda: style_results_page(result_page(result, 1, 100, sort_by="利润 (MYR)")[0]).to_html())
+    record("export", len(result), lambda: export_excel(result))
+    return results
+
+
+def environment():
+    return {
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+
+def compare(current, baseline, threshold):
+    """打印对比；返回回退的 key 列表（耗时 > 基线 × (1 + threshold)）"""
+    regressions = []
+    print(f"\n对比基线（阈值 +{threshold:.0%}）")
+    for key, cur in current.items():
+        base = baseline.get(key)
+        if not base or "seconds" not in base or "seconds" not in cur:
+            continue
+        ratio = cur["seconds"] / base["seconds"] if base["seconds"] > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  ← 回退"
+            regressions.append(key)
+        print(f"  {key:<34} {base['seconds']:9.4f}s → {cur['seconds']:9.4f}s  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成价钱表基准测试")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="行数（可多个，1k–1M）")
+    parser.add_argument("--formats", nargs="+", default=["csv", "xlsx"], choices=["csv", "xlsx"])
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--repeat", type=int, default=3, help="每段重复次数，取最快一次")
+    parser.add_argument("--no-memory", action="store_true", help="不测峰值内存（省一次运行）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="把本次结果存为 JSON 基线")
+    parser.add_argument("--compare", help="与 JSON 基线对比")
+    parser.add_argument("--threshold", type=float, default=0.2, help="回退阈值（默认 0.2 = 慢 20%%）")
+    args = parser.parse_args(argv)
+
+    current = {}
+    for fmt in args.formats:
+        for n in args.rows:
+            path = synthetic_file(n, fmt, seed=args.seed)
+            print(f"{fmt} {n:,} 行  ({path.name}, {path.stat().st_size / 2**20:.1f} MB)")
+            case = run_case(path, n, repeat=args.repeat, memory=not args.no_memory, stages=args.stages)
+            for stage, r in case.items():
+                current[f"{fmt}/{n}/{stage}"] = r
+                if "skipped" in r:
+                    print(f"  {stage:<20} 跳过：{r['skipped']}")
+                    continue
+                mem = f"{r['peak_mb']:9.1f} MB" if r["peak_mb"] is not None else ""
+                print(f"  {stage:<20} {r['seconds']:9.4f}s  {r['rows_per_s']:14,.0f} 行/s  {mem}")
+
+    if args.save:
+        out = Path(args.save)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps({"env": environment(), "results": current}, ensure_ascii=False, indent=2),
+                       encoding="utf-8")
+        print(f"\n基线已保存：{out}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        if compare(current, baseline["results"], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
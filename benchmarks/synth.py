@@ -0,0 +1,125 @@
+# benchmarks/synth.py
+# -*- coding: utf-8 -*-
+"""
+合成供应商价钱表（基准测试用）：
+- 两行表头，第一行是合并的分组标题（产品信息 / 成本 / 售价），第二行是列名
+- 普通卖价单元格含多个价格，分隔符混用（/ | ; ， 空格 逗号），夹杂 NaN / none / 非数字
+- 促销成本 / 促销售价稀疏（约 10% 的行有值）
+- 写成 .xlsx（真正的合并单元格）或 .csv（分组标题只写在第一列，其余留空）
+
+用法：python benchmarks/synth.py 100000 out.xlsx
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# (分组标题, 列名)；读取时 merge_multirow=True，header_idx=1
+HEADER_GROUPS = [
+    ("产品信息", ["SKU", "DESCRIPTION"]),
+    ("成本", ["COST", "PROMOTION"]),
+    ("售价", ["SELLING PRICE", "PRICE 2", "PROMO SELLING PRICE"]),
+]
+HEADER_IDX = 1
+
+
+def make_price_cells(n, seed=0):
+    """
+    混合分隔符的多价格单元格 + 少量 NaN / none / 非数字，以及只由数字字符组成却不是数字的片段（-、1e、1.2.3）
+    和 float() 能解析的非常规写法（全角 / 阿拉伯-印度数字、inf、1_000、+nan）；价格解析的基准和测试共用
+    """
+    rng = np.random.default_rng(seed)
+    seps = np.array(["/", " / ", "|", ";", "，", " ", ","])
+    a = np.round(rng.uniform(1, 500, n), 2).astype(str)
+    b = np.round(rng.uniform(1, 500, n), 2).astype(str)
+    sep = seps[rng.integers(0, len(seps), n)]
+    k = rng.integers(0, 13, n)
+    cells = np.where(k < 5, a, np.char.add(np.char.add(a, sep), b)).astype(object)
+    cells[k == 7] = "none"
+    cells[k == 8] = np.nan
+    cells[k == 9] = "ask"
+    # 价格区间（"10 - 12"）、单独的 "-"、以及 1e / 1.2.3 这类片段
+    cells[k == 10] = np.char.add(np.char.add(a, " - "), b)[k == 10]
+    cells[k == 11] = "-"
+    odd = np.array(["1e", "1.2.3", "-", "+", "e5", ".", "１５", "inf", "1_000", "١٢٣", "+nan"])
+    cells[k == 12] = np.char.add(np.char.add(a, sep), odd[rng.integers(0, len(odd), n)])[k == 12]
+    return pd.Series(cells)
+
+
+def make_price_sheet(n_rows, seed=0):
+    """表体（列名 = HEADER_GROUPS 第二行），n_rows 行"""
+    rng = np.random.default_rng(seed)
+    cost = np.round(rng.uniform(1, 400, n_rows), 2)
+    promo = rng.random(n_rows) < 0.1
+    promo_cost = np.where(promo, np.round(cost * rng.uniform(0.7, 0.95, n_rows), 2), np.nan)
+    # 少数促销行只有成本没有售价（不满足促销条件，按普通价计算）
+    promo_price = np.where(promo & (rng.random(n_rows) < 0.9), np.round(cost * rng.uniform(0.9, 1.6, n_rows), 2), np.nan)
+    return pd.DataFrame({
+        "SKU": np.char.add("SKU-", np.arange(n_rows).astype(str)),
+        "DESCRIPTION": np.char.add("Product ", (rng.integers(0, max(n_rows // 3, 1), n_rows)).astype(str)),
+        "COST": cost,
+        "PROMOTION": promo_cost,
+        "SELLING PRICE": make_price_cells(n_rows, seed=seed + 1).to_numpy(),
+        "PRICE 2": np.where(rng.random(n_rows) < 0.5, np.round(cost * 1.3, 2), np.nan),
+        "PROMO SELLING PRICE": promo_price,
+    })
+
+
+def _group_row():
+    row = []
+    for group, cols in HEADER_GROUPS:
+        row += [group] + [""] * (len(cols) - 1)
+    return row
+
+
+def write_price_sheet(df, path):
+    """按扩展名写 .csv / .xlsx，带两行表头"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix.lower() == ".csv":
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(",".join(_group_row()) + "\n")
+            df.to_csv(f, index=False)
+        return path
+
+    import xlsxwriter
+
+    wb = xlsxwriter.Workbook(str(path), {"constant_memory": True, "nan_inf_to_errors": False})
+    ws = wb.add_worksheet("Sheet1")
+    bold = wb.add_format({"bold": True, "align": "center"})
+    c = 0
+    for group, cols in HEADER_GROUPS:
+        if len(cols) > 1:
+            ws.merge_range(0, c, 0, c + len(cols) - 1, group, bold)
+        else:
+            ws.write(0, c, group, bold)
+        c += len(cols)
+    ws.write_row(1, 0, list(df.columns), bold)
+    values = df.astype(object).where(df.notna(), None).to_numpy()
+    for r, row in enumerate(values, start=2):
+        for j, v in enumerate(row):
+            if v is not None:
+                ws.write(r, j, v)
+    wb.close()
+    return path
+
+
+def sheet_mapping(columns):
+    """合并表头后的列名 → compute_profit 的 mapping（按第二行列名结尾匹配）"""
+    def find(label, exclude=None):
+        return next(c for c in columns if str(c).endswith(label) and not (exclude and exclude in str(c)))
+    return {
+        "name": find("DESCRIPTION"),
+        "cost": find("COST"),
+        "promo_cost": find("PROMOTION"),
+        "promo_price": find("PROMO SELLING PRICE"),
+        "price_cols": [find("SELLING PRICE", exclude="PROMO"), find("PRICE 2")],
+    }
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    out = sys.argv[2] if len(sys.argv) > 2 else f"synthetic_{n}.xlsx"
+    print(write_price_sheet(make_price_sheet(n), out))
@@ -0,0 +1,135 @@
+# profit_calc.py
+# -*- coding: utf-8 -*-
+"""
+命令行入口（profit-calc）：单个价钱表 → 利润结果，不启动 Streamlit
+
+用法：
+    profit-calc 价钱表.xlsx --country Thailand --platform Shopee --scenario 基础佣金 --out result.xlsx
+    python profit_calc.py prices.csv --country Malaysia --fee-pct 8 --price-col "SELLING PRICE" > result.csv
+
+未指定的列按 app 里的默认规则猜测（名称 / COST / PROMOTION / 含 price、sell 的列）；
+费率优先取 --fee-pct，否则按 国家 / 平台 / 方案 在费率配置里查 --as-of 当天生效的费率（默认当前版本、今天，见 FeeConfigStore）；
+汇率同样优先取汇率历史里当天生效的值。
+pandas 等依赖在参数解析之后才加载，--help 几乎零开销。
+"""
+
+import argparse
+import sys
+from datetime import date
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="profit-calc", description="价钱表 → 利润计算结果（不依赖 Streamlit）")
+    parser.add_argument("file", help="价钱表（.xlsx / .xls / .csv）")
+    parser.add_argument("--country", required=True, help="国家（Thailand / Malaysia / Vietnam / Philippines / Indonesia）")
+    parser.add_argument("--header-row", type=int, default=2, help="表头所在行（从 1 开始，默认 2）")
+    parser.add_argument("--merge-multirow", action="store_true", help="强制合并多行表头")
+
+    cols = parser.add_argument_group("列映射（不填则自动猜测）")
+    cols.add_argument("--name-col", help="产品名称列")
+    cols.add_argument("--cost-col", help="成本列（COST）")
+    cols.add_argument("--promo-cost-col", help="促销成本列（PROMOTION）")
+    cols.add_argument("--promo-price-col", help="促销售价列（PROMO SELLING PRICE）")
+    cols.add_argument("--price-col", action="append", dest="price_cols", help="普通卖价列（可重复）")
+
+    fees = parser.add_argument_group("费率与汇率")
+    fees.add_argument("--fee-pct", type=float, help="平台费率 %%（填了就不查配置）")
+    fees.add_argument("--platform", help="平台（在费率配置里查费率）")
+    fees.add_argument("--scenario", help="活动方案（在费率配置里查费率）")
+    fees.add_argument("--fees", help="费率配置 CSV（默认 config_history/ 里的当前版本）")
+    fees.add_argument("--commission", type=float, default=0.0, help="个人抽成 %%")
+    fees.add_argument("--rate", type=float, help="1 本币 = ? MYR（填了就不读汇率文件）")
+    fees.add_argument("--rates", default="exchange_rates.json", help="汇率文件（默认 exchange_rates.json）")
+    fees.add_argument("--rate-history", default="exchange_rate_history.csv",
+                      help="汇率历史（currency, rate, effective_from, effective_to），按日期优先于 --rates")
+    fees.add_argument("--as-of", type=date.fromisoformat, default=None,
+                      help="按哪天生效的费率 / 汇率计算（YYYY-MM-DD，默认今天）")
+
+    out = parser.add_argument_group("输出")
+    out.add_argument("--out", default="-", help="输出文件（.xlsx / .parquet / .csv / .csv.gz；默认 - 输出 CSV 到 stdout）")
+    out.add_argument("--stream", action="store_true", help="大 CSV 分块计算（需要 --out 文件）")
+    out.add_argument("--memory-mb", type=int, help="分块计算的内存预算 MB")
+    return parser
+
+def resolve_mapping(df, args):
+    """自动猜测的映射，再用命令行显式指定的列覆盖"""
+    from profit_core import guess_column_mapping
+
+    mapping = guess_column_mapping(df)
+    overrides = {
+        "name": args.name_col,
+        "cost": args.cost_col,
+        "promo_cost": args.promo_cost_col,
+        "promo_price": args.promo_price_col,
+        "price_cols": args.price_cols,
+    }
+    mapping.update({k: v for k, v in overrides.items() if v})
+    missing = [c for c in [mapping["name"], mapping["cost"], mapping["promo_cost"], mapping["promo_price"]] + list(mapping["price_cols"])
+               if c and c not in df.columns]
+    if missing:
+        raise ValueError(f"找不到列：{missing}；可用列：{list(df.columns)}")
+    return mapping
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.stream and args.out == "-":
+        parser.error("--stream 需要指定 --out 输出文件")
+
+    from profit_core import (
+        COUNTRY_CURRENCY, STREAM_MEMORY_MB, STREAM_PREVIEW_ROWS, ResultWriter, compute_profit,
+        compute_profit_streaming, current_fee_config, effective_conversion, effective_fee_rows, load_fee_config,
+        load_rate_history, load_rates, lookup_fee_pct, scenario_label, try_read_and_clean,
+    )
+
+    currency = COUNTRY_CURRENCY.get(args.country)
+    if currency is None:
+        parser.error(f"未知国家：{args.country}；可选：{', '.join(COUNTRY_CURRENCY)}")
+
+    as_of = args.as_of or date.today()
+    fee_pct, label = args.fee_pct, "自定义"
+    if fee_pct is None:
+        fee_df = load_fee_config(args.fees) if args.fees else current_fee_config()
+        fee_pct = lookup_fee_pct(effective_fee_rows(fee_df, as_of), args.country, args.platform, args.scenario)
+        if fee_pct is None:
+            wanted = " / ".join(x for x in [args.country, args.platform, args.scenario] if x)
+            parser.error(f"{args.fees or '费率配置'} 里没有 {as_of} 生效的 {wanted} 费率，请用 --fee-pct 指定")
+        if args.platform or args.scenario:
+            label = scenario_label(args.platform or "", args.scenario or "", None)
+    if args.rate:
+        conv = args.rate
+    else:
+        conv = float(effective_conversion(load_rate_history(args.rate_history), [currency], as_of,
+                                          load_rates(args.rates))[0])
+
+    header_idx = args.header_row - 1
+    try:
+        if args.stream:
+            preview = try_read_and_clean(args.file, header_idx, merge_multirow=args.merge_multirow, nrows=STREAM_PREVIEW_ROWS)
+            mapping = resolve_mapping(preview, args)
+            stats = compute_profit_streaming(
+                args.file, header_idx, mapping, fee_pct, args.commission, conv, args.out,
+                currency=currency, platform_label=label, merge_multirow=args.merge_multirow,
+                memory_mb=args.memory_mb or STREAM_MEMORY_MB,
+                progress=lambda done, total: print(f"\r{done / max(total, 1):.0%}", end="", file=sys.stderr),
+            )
+            print(file=sys.stderr)
+            print(f"{stats['rows_in']:,} 行 → {stats['rows_out']:,} 条结果 → {stats['path']}", file=sys.stderr)
+            return 0
+
+        df = try_read_and_clean(args.file, header_idx, merge_multirow=args.merge_multirow)
+        mapping = resolve_mapping(df, args)
+        result = compute_profit(df, mapping, fee_pct, args.commission, conv, currency=currency, platform_label=label)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"失败：{e}", file=sys.stderr)
+        return 1
+
+    if args.out == "-":
+        result.to_csv(sys.stdout, index=False)
+    else:
+        with ResultWriter(args.out) as writer:
+            writer.write(result)
+        print(f"{len(df):,} 行 → {len(result):,} 条结果 → {args.out}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2768 @@
+# profit_core.py
+# -*- coding: utf-8 -*-
+"""
+利润计算核心（不依赖 Streamlit，可单独 import）：
+- split_price_cell / parse_price_series / parse_price_columns：多分隔符价格拆分（单格 / 整列批量）
+- compute_profit / compute_profit_scenarios：按列整体（向量化）计算平台抽成 / 利润 / 利润率 / MYR 换算
+- try_read_and_clean / read_and_clean_cached：读取 + 表头清理（按内容哈希持久缓存）
+- read_workbook / detect_header_row：多工作表 Excel 每张表一个进程并行解析（各自识别表头行），合并时带“工作表”列；
+  process_pool：统一的进程池（spawn 启动）
+- compute_profit_streaming / ResultWriter：大 CSV 分块计算，结果分批写出（内存有上限）
+- export_results / export_cache_path：结果按需导出（xlsx / parquet / csv.gz，带 Settings），按结果 key 缓存
+- sweep_profit / break_even_price：费率 × 汇率网格的利润立方体与保本价（价格敏感度扫描）
+- ResultMemo / result_key：会话内计算结果记忆（LRU，按输入组合作 key）
+- MetaStore：上传记录（SQLite，按 国家 + 文件名 索引，原子写入）
+- FeeConfigStore / FeeIndex / current_fee_config：版本化费率配置（内容寻址快照 + HEAD 指针）与按 key 查费率
+- effective_positions / effective_terms：费率 / 汇率按生效日期取值（merge_asof，一次向量化完成）
+- load_fee_config / lookup_fee_pct：读取单个费率配置文件与查询
+- style_results：结果表上色 + 数字格式
+- result_page / style_results_page：服务端排序 + 分页，只样式化当前页（大结果表用）
+- diff_sheets / update_profit / change_report：重新上传时逐行对比，只重算改动的行
+- consolidate_catalog / ProductMatchIndex：各国家结果按归一化商品名合并成 商品 × 国家 的宽表
+- compact_sheet / compact_results：计算前 / 缓存前无损瘦身（float32 / category）
+- ProductSearchIndex：产品名搜索（前缀 + 字符三元组，中文 / 泰文可搜任意片段）
+- product_ranking / chart_products / profit_histogram / fee_chart_data：图表数据先在服务端聚合，图形数有上限
+- SharedFrameCache / read_and_clean_shared / invalidate_shared_caches：进程内跨会话共享的只读解析结果与费率配置（引用计数 + 淘汰）
+- PerfTrace / perf_span / perf_stage：分段计时（耗时 / 行数 / 内存），写 JSON Lines 日志；ProfileCapture：单次运行的 profile
+
+import 本模块没有任何副作用（不建目录、不写文件）；需要本地存储时显式调用 ensure_storage()。
+openpyxl / xlsxwriter / pyarrow 只在真正读写对应格式时才由 pandas 或本模块按需加载。
+"""
+
+import csv
+import functools
+import glob
+import hashlib
+import heapq
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import unicodedata
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing, contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# ============== 国家与汇率默认 ==============
+COUNTRY_CURRENCY = {
+    "Thailand": "THB",
+    "Malaysia": "MYR",
+    "Vietnam": "VND",
+    "Philippines": "PHP",
+    "Indonesia": "IDR",
+}
+
+DEFAULT_RATES = {"THB": 7.8, "MYR": 1.0, "VND": 5400.0, "PHP": 12.0, "IDR": 3400.0}
+
+def load_rates(path):
+    """读取 exchange_rates.json（1 本币 = ? MYR）；文件不存在或损坏时用默认值"""
+    rates = DEFAULT_RATES.copy()
+    try:
+        rates.update(json.loads(Path(path).read_text(encoding="utf-8")))
+    except (OSError, ValueError):
+        pass
+    return rates
+
+def conversion_rate(rates, currency):
+    """本币 → MYR 的除数；未设置或 <= 0 时按 1 处理"""
+    conv = float(rates.get(currency, DEFAULT_RATES.get(currency, 1.0)))
+    return conv if conv > 0 else 1.0
+
+# ============== 本地存储与平台费率配置 ==============
+BASE_DIR = Path(".")
+UPLOAD_DIR = BASE_DIR / "uploads"
+META_FILE = BASE_DIR / "file_metadata.csv"  # 旧版上传记录，只用于一次性迁移
+META_DB = BASE_DIR / "file_metadata.sqlite"
+CONFIG_FILE = BASE_DIR / "platform_fees.csv"  # 旧版费率配置，只用于一次性导入
+CONFIG_HISTORY_DIR = BASE_DIR / "config_history"  # FeeConfigStore 的根目录
+RATES_FILE = BASE_DIR / "exchange_rates.json"
+
+META_COLUMNS = ["country", "filename", "filepath", "upload_date"]
+META_DB_COLUMNS = META_COLUMNS + ["content_hash", "n_rows"]
+FEE_CONFIG_COLUMNS = ["country", "platform", "scenario", "fee_pct", "remark"]
+# 可选的生效日期列（含首尾两天，留空 = 不限）；没有这两列的旧配置照常使用
+EFFECTIVE_COLUMNS = ["effective_from", "effective_to"]
+RATE_HISTORY_FILE = BASE_DIR / "exchange_rate_history.csv"
+RATE_HISTORY_COLUMNS = ["currency", "rate"] + EFFECTIVE_COLUMNS
+
+DEMO_FEE_CONFIG = [
+    ["Thailand", "Shopee", "基础佣金", 9, "示例"],
+    ["Thailand", "Lazada", "Full（FS+LazCoin）", 13, "示例"],
+    ["Malaysia", "Shopee", "基础佣金", 8, "示例"],
+]
+
+def temp_path(path, keep_suffix=False):
+    """
+    path 同目录下的临时文件名（写完再 os.replace 成 path）：进程号 + 随机串——
+    Streamlit 的多个会话是同一进程里的线程，只用进程号会让并发写入共用同一个临时文件
+    keep_suffix: 保留扩展名（按扩展名判断格式的写出器用）
+    """
+    path = Path(path)
+    tag = f"{os.getpid()}.{uuid.uuid4().hex[:12]}"
+    if keep_suffix:
+        return path.with_name(f".{path.stem}.{tag}.tmp{''.join(path.suffixes)}")
+    return path.with_name(f".{path.name}.{tag}.tmp")
+
+def ensure_storage():
+    """创建上传目录、上传记录库和费率配置库（首次会迁移旧 CSV / 历史文件，都没有则写入示例配置）"""
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    CONFIG_HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+    MetaStore(META_DB, legacy_csv=META_FILE)
+    FeeConfigStore(CONFIG_HISTORY_DIR, legacy_file=CONFIG_FILE)
+
+class MetaStore:
+    """
+    上传记录（SQLite，WAL 模式，只用标准库）：主键 (country, filename)，同名上传覆盖
+    - 每次操作单独连接、单条语句 / 单个事务完成，多个 Streamlit 会话并发上传不会互相覆盖
+    - (country, upload_date) 上有索引，按国家列文件不扫全表
+    - 记录上传时的内容哈希（content_hash）和原始行数（n_rows，含表头）
+    - legacy_csv 存在且库是新建的：一次性导入旧 file_metadata.csv（PRAGMA user_version 标记已迁移）
+    """
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path=META_DB, legacy_csv=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+                with conn:
+                    conn.execute("""
+                        CREATE TABLE IF NOT EXISTS files (
+                            country TEXT NOT NULL,
+                            filename TEXT NOT NULL,
+                            filepath TEXT NOT NULL,
+                            upload_date TEXT NOT NULL,
+                            content_hash TEXT,
+                            n_rows INTEGER,
+                            PRIMARY KEY (country, filename)
+                        ) WITHOUT ROWID""")
+                    conn.execute("CREATE INDEX IF NOT EXISTS files_by_country_date ON files (country, upload_date)")
+                    if legacy_csv is not None and Path(legacy_csv).exists():
+                        self._migrate_csv(conn, legacy_csv)
+                    conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _migrate_csv(conn, csv_path):
+        """旧 CSV → 表；文件仍在的顺便补上内容哈希（行数留空）"""
+        try:
+            old = pd.read_csv(csv_path, dtype=str)
+        except Exception:
+            return
+        rows = []
+        for r in old.reindex(columns=META_COLUMNS).itertuples(index=False):
+            if pd.isna(r.country) or pd.isna(r.filename) or pd.isna(r.filepath):
+                continue
+            digest = file_content_hash(r.filepath) if Path(r.filepath).exists() else None
+            rows.append((r.country, r.filename, r.filepath, r.upload_date if not pd.isna(r.upload_date) else "", digest))
+        conn.executemany(
+            "INSERT OR REPLACE INTO files (country, filename, filepath, upload_date, content_hash) VALUES (?, ?, ?, ?, ?)",
+            rows)
+
+    def upsert(self, country, filename, filepath, upload_date=None, content_hash=None, n_rows=None):
+        """新增或覆盖一条记录（原子）"""
+        upload_date = upload_date or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""
+                INSERT INTO files (country, filename, filepath, upload_date, content_hash, n_rows)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (country, filename) DO UPDATE SET
+                    filepath = excluded.filepath, upload_date = excluded.upload_date,
+                    content_hash = excluded.content_hash, n_rows = excluded.n_rows""",
+                (country, filename, str(filepath), upload_date, content_hash, n_rows))
+
+    def delete(self, country, filename):
+        """删除一条记录；返回是否删到了"""
+        with closing(self._connect()) as conn, conn:
+            cur = conn.execute("DELETE FROM files WHERE country = ? AND filename = ?", (country, filename))
+            return cur.rowcount > 0
+
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM files")
+
+    def get(self, country, filename):
+        """按主键取一条记录（dict），不存在返回 None"""
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM files WHERE country = ? AND filename = ?", (country, filename)).fetchone()
+        return dict(row) if row is not None else None
+
+    def list_files(self, country=None):
+        """某国家（None = 全部）的上传记录 DataFrame，按上传时间从新到旧"""
+        sql = f"SELECT {', '.join(META_DB_COLUMNS)} FROM files"
+        params = ()
+        if country is not None:
+            sql += " WHERE country = ?"
+            params = (country,)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql + " ORDER BY country, upload_date DESC", params).fetchall()
+        return pd.DataFrame(rows, columns=META_DB_COLUMNS)
+
+def count_rows(path):
+    """原始行数（含表头）：CSV 数换行，Excel 各工作表已用区域的行数之和；读不出返回 None"""
+    try:
+        if _is_excel(path):
+            import openpyxl
+            wb = openpyxl.load_workbook(path, read_only=True)
+            try:
+                return sum(ws.max_row or 0 for ws in wb.worksheets)
+            finally:
+                wb.close()
+        n, last = 0, b"\n"
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                n += chunk.count(b"\n")
+                last = chunk[-1:]
+        return n + (last != b"\n")
+    except Exception:
+        return None
+
+def load_fee_config(path=CONFIG_FILE):
+    """读取一个费率配置 CSV 文件（命令行 --fees 指定文件时用；应用内请用 FeeConfigStore）"""
+    try:
+        return pd.read_csv(path)
+    except Exception:
+        return pd.DataFrame(columns=FEE_CONFIG_COLUMNS)
+
+class FeeConfigStore:
+    """
+    版本化的平台费率配置（root 默认 config_history/）：
+    - objects/<sha1>.csv：按内容寻址的快照，内容相同的保存只存一份
+    - HEAD：当前版本的 sha1；保存 / 回滚都只是原子替换这个指针（写临时文件再 os.replace）
+    - versions.tsv：追加写的版本记录（时间、sha1、说明），列历史版本只读这一个文件
+    加载结果和 FeeIndex 按 sha1（+ 生效日期）记忆在 SHARED_CACHE 里（进程内所有会话共用），HEAD 不变时不重复解析
+    首次使用时导入旧的 platform_fees.csv 和 config_history/platform_fees_*.csv；都没有则写入示例配置
+    """
+
+    def __init__(self, root=CONFIG_HISTORY_DIR, legacy_file=CONFIG_FILE):
+        self.root = Path(root)
+        self.objects_dir = self.root / "objects"
+        self.head_file = self.root / "HEAD"
+        self.log_file = self.root / "versions.tsv"
+        if not self.head_file.exists():
+            self._init_store(legacy_file)
+
+    def _init_store(self, legacy_file):
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        imported = False
+        for f in sorted(self.root.glob("platform_fees_*.csv")):
+            try:
+                ts = datetime.strptime(f.stem[len("platform_fees_"):], "%Y%m%d_%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                ts = None
+            self.save(load_fee_config(f), note=f"导入 {f.name}", timestamp=ts)
+            imported = True
+        if legacy_file is not None and Path(legacy_file).exists():
+            self.save(load_fee_config(legacy_file), note=f"导入 {Path(legacy_file).name}")
+            imported = True
+        if not imported:
+            self.save(pd.DataFrame(DEMO_FEE_CONFIG, columns=FEE_CONFIG_COLUMNS), note="示例配置")
+
+    def _object_path(self, digest):
+        return self.objects_dir / f"{digest}.csv"
+
+    def head(self):
+        """当前版本 sha1（没有则 None）"""
+        try:
+            return self.head_file.read_text(encoding="utf-8").strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _set_head(self, digest):
+        tmp = temp_path(self.head_file)
+        tmp.write_text(digest, encoding="utf-8")
+        os.replace(tmp, self.head_file)
+
+    def _append_log(self, digest, note, timestamp=None):
+        ts = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        note = str(note).replace("\t", " ").replace("\n", " ")
+        with open(self.log_file, "a", encoding="utf-8") as f:
+            f.write(f"{ts}\t{digest}\t{note}\n")
+
+    def save(self, df, note="", timestamp=None):
+        """保存为新版本并设为当前版本；内容与当前版本相同则什么都不做。返回 sha1"""
+        columns = FEE_CONFIG_COLUMNS + [c for c in EFFECTIVE_COLUMNS if c in df.columns]
+        data = df.reindex(columns=columns).to_csv(index=False).encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self.head():
+            return digest
+        obj = self._object_path(digest)
+        if not obj.exists():
+            self.objects_dir.mkdir(parents=True, exist_ok=True)
+            tmp = temp_path(obj)
+            tmp.write_bytes(data)
+            os.replace(tmp, obj)
+        self._set_head(digest)
+        self._append_log(digest, note, timestamp)
+        return digest
+
+    def checkout(self, digest, note="回滚"):
+        """回滚到已有版本：只替换 HEAD 指针"""
+        if not self._object_path(digest).exists():
+            raise KeyError(f"没有这个版本：{digest}")
+        if digest != self.head():
+            self._set_head(digest)
+            self._append_log(digest, f"{note} → {digest[:8]}")
+
+    def versions(self):
+        """版本记录 DataFrame[timestamp, digest, note]，从新到旧（按文件大小 + mtime 记忆）"""
+        try:
+            st_ = self.log_file.stat()
+        except FileNotFoundError:
+            return pd.DataFrame(columns=["timestamp", "digest", "note"])
+        memo_key = (str(self.log_file), st_.st_size, st_.st_mtime_ns)
+        hit = _fee_versions_memo.get(memo_key)
+        if hit is None:
+            hit = pd.read_csv(self.log_file, sep="\t", header=None, names=["timestamp", "digest", "note"],
+                              dtype=str, keep_default_na=False, quoting=csv.QUOTE_NONE).iloc[::-1].reset_index(drop=True)
+            _fee_versions_memo.clear()
+            _fee_versions_memo[memo_key] = hit
+        return hit
+
+    def read_bytes(self, digest=None):
+        """某版本（默认当前版本）的 CSV 原文（下载用）"""
+        return self._object_path(digest or self.head()).read_bytes()
+
+    def load(self, digest=None, holder=None):
+        """某版本（默认当前版本）的费率配置 DataFrame；调用方只读使用（holder：会话标识，见 SharedFrameCache）"""
+        return self._loaded(digest or self.head(), holder)[0]
+
+    def index(self, digest=None, as_of=None):
+        """某版本（默认当前版本）在 as_of 日期（默认今天）生效的 FeeIndex"""
+        df, indexes = self._loaded(digest or self.head())
+        day = pd.Timestamp(as_of or datetime.now()).normalize()
+        if day not in indexes:
+            indexes[day] = FeeIndex(df, as_of=day)
+        return indexes[day]
+
+    def _loaded(self, digest, holder=None):
+        """(DataFrame, {生效日期: FeeIndex})，按 sha1 记忆"""
+        if digest is None:
+            return pd.DataFrame(columns=FEE_CONFIG_COLUMNS), {}
+        # 进程内所有会话共用（SHARED_CACHE），没有会话引用的旧版本超出容量时会被淘汰
+        return SHARED_CACHE.get(("fee_config", digest), lambda: (pd.read_csv(self._object_path(digest)), {}),
+                                holder=holder, slot="fee_config")
+
+_fee_versions_memo = {}
+
+def current_fee_config(root=CONFIG_HISTORY_DIR, legacy_file=CONFIG_FILE):
+    """当前费率配置：有版本库读 HEAD 版本，否则读旧 CSV（不创建任何文件，命令行用）"""
+    if (Path(root) / "HEAD").exists():
+        return FeeConfigStore(root, legacy_file=None).load()
+    return load_fee_config(legacy_file)
+
+class FeeIndex:
+    """
+    费率配置的内存索引（建一次，之后按 key 取值都是 dict 查找）：
+    - fee_pct(country, platform, scenario)：(国家, 平台, 方案) → 费率 %
+    - scenarios(country)：该国家的方案下拉列表（显示文字，与 scenario_label 一致）
+    - fee_for_label / key_for_label(country, label)：下拉选中的显示文字 → 费率 % / (平台, 方案)
+    只收录 as_of 当天生效的行（没有生效日期列则全部收录），同一 key 有多个区间生效时取 effective_from 最晚的；
+    其余重复的 key 取第一条（与 lookup_fee_pct 一致）
+    """
+
+    def __init__(self, fee_df, as_of=None):
+        self._fees = {}
+        self._labels = {}
+        if as_of is not None:
+            fee_df = effective_fee_rows(fee_df, as_of)
+        for c, p, sc, fee, remark in zip(fee_df["country"], fee_df["platform"], fee_df["scenario"],
+                                         fee_df["fee_pct"], fee_df["remark"]):
+            self._fees.setdefault((c, p, sc), float(fee))
+            self._labels.setdefault(c, {}).setdefault(scenario_label(p, sc, remark), (float(fee), p, sc))
+
+    def fee_pct(self, country, platform, scenario):
+        return self._fees.get((country, platform, scenario))
+
+    def scenarios(self, country):
+        return list(self._labels.get(country, {}))
+
+    def fee_for_label(self, country, label):
+        hit = self._labels.get(country, {}).get(label)
+        return hit[0] if hit is not None else None
+
+    def key_for_label(self, country, label):
+        """下拉显示文字 → (平台, 方案)"""
+        hit = self._labels.get(country, {}).get(label)
+        return hit[1:] if hit is not None else None
+
+# ============== 生效日期（费率 / 汇率按日期取值） ==============
+def _as_days(values, index=None):
+    """转成日期（datetime64[ns]，去掉时分秒）；无法解析为 NaT"""
+    days = pd.to_datetime(pd.Series(values, index=index), errors="coerce", format="mixed")
+    return days.astype("datetime64[ns]").dt.normalize()
+
+def _effective_bounds(table):
+    """生效区间 [from, to)：留空的 from 视为最早，留空的 to（NaT）视为不限；effective_to 当天仍生效"""
+    none = pd.Series(pd.NaT, index=table.index)
+    start = _as_days(table["effective_from"] if "effective_from" in table.columns else none, table.index)
+    end = _as_days(table["effective_to"] if "effective_to" in table.columns else none, table.index)
+    return start.fillna(pd.Timestamp.min), end + pd.Timedelta(days=1)
+
+def effective_rows(table, on):
+    """on 当天生效的行；同一组其它列重复时由调用方决定取哪条（表内顺序不变）"""
+    start, end = _effective_bounds(table)
+    day = pd.Timestamp(on).normalize()
+    return table[(start <= day) & (end.isna() | (day < end))]
+
+def _effective_segments(table, by):
+    """
+    把每组 by 的生效区间切成首尾相接、互不重叠的片段 DataFrame[by..., _from, _row]：
+    每段取当时覆盖它的区间里 effective_from 最晚的那行（起始日也相同取表内第一条），没有区间覆盖的空档 _row = -1
+    例：不限期的基础费率 + 3 月的临时费率 → 基础 / 临时 / 基础 三段
+    """
+    start, end = _effective_bounds(table)
+    starts = start.to_numpy().astype("datetime64[ns]").astype(np.int64)
+    ends = end.to_numpy().astype("datetime64[ns]")
+    ends = np.where(np.isnat(ends), np.iinfo(np.int64).max, ends.astype(np.int64))
+    keys = pd.DataFrame({k: table[k].astype(str).to_numpy() for k in by})
+    segments = []
+    for key, rows in keys.groupby(by, sort=False).indices.items():
+        key = key if isinstance(key, tuple) else (key,)
+        rows = rows[np.lexsort((rows, starts[rows]))]
+        bounds = np.unique(np.r_[starts[rows], ends[rows]])
+        heap, j, last = [], 0, None
+        for b in bounds.tolist():
+            while j < len(rows) and starts[rows[j]] <= b:
+                r = int(rows[j])
+                heapq.heappush(heap, (-int(starts[r]), r, int(ends[r])))
+                j += 1
+            # 已结束的区间不会再生效，懒删除
+            while heap and heap[0][2] <= b:
+                heapq.heappop(heap)
+            winner = heap[0][1] if heap else -1
+            if winner != last:
+                segments.append(key + (b, winner))
+                last = winner
+    seg = pd.DataFrame(segments, columns=list(by) + ["_from", "_row"])
+    seg = seg[seg["_from"] < np.iinfo(np.int64).max]
+    seg["_from"] = seg["_from"].to_numpy(dtype=np.int64).astype("datetime64[ns]")
+    return seg.sort_values("_from", kind="stable")
+
+def effective_positions(table, queries, by, date_col="date"):
+    """
+    按日期匹配（向量化，一次 merge_asof）：queries 每行 (by..., date) → table 中
+    by 相同、effective_from <= date <= effective_to 的那行的行位置；找不到（或 date 为空）为 -1
+    同一组 by 有多个区间覆盖同一天时取 effective_from 最晚的；起始日也相同则取表内第一条
+    （临时区间结束后回到仍在生效的更早区间，见 _effective_segments）
+    返回与 queries 行对齐的 int 数组
+    """
+    n = len(queries)
+    out = np.full(n, -1, dtype=np.int64)
+    if n == 0 or table.empty:
+        return out
+    right = _effective_segments(table, by)
+
+    left = pd.DataFrame({k: queries[k].astype(str).to_numpy() for k in by})
+    left["_date"] = _as_days(queries[date_col].to_numpy()).to_numpy()
+    left["_pos"] = np.arange(n)
+    left = left[left["_date"].notna()].sort_values("_date", kind="stable")
+
+    merged = pd.merge_asof(left, right, left_on="_date", right_on="_from", by=by, direction="backward")
+    row = merged["_row"].fillna(-1).to_numpy(dtype=np.int64)
+    ok = row >= 0
+    out[merged["_pos"].to_numpy()[ok]] = row[ok]
+    return out
+
+def effective_lookup(table, queries, by, value_col, date_col="date"):
+    """effective_positions 匹配到的行的 value_col（转成 float）；找不到为 NaN"""
+    pos = effective_positions(table, queries, by, date_col)
+    out = np.full(len(pos), np.nan)
+    hit = pos >= 0
+    out[hit] = pd.to_numeric(table[value_col], errors="coerce").to_numpy(dtype=float)[pos[hit]]
+    return out
+
+def effective_fee_rows(fee_df, as_of):
+    """
+    as_of 当天生效的费率行：同一 (国家, 平台, 方案) 有多个区间覆盖这一天时只留 effective_from 最晚的
+    （与 effective_positions 一致），表内顺序不变
+    """
+    fee_df = effective_rows(fee_df, as_of)
+    start = _effective_bounds(fee_df)[0].to_numpy().astype("datetime64[ns]").astype(np.int64)
+    order = np.argsort(-start, kind="stable")
+    first = ~fee_df.iloc[order].duplicated(["country", "platform", "scenario"]).to_numpy()
+    return fee_df.iloc[np.sort(order[first])]
+
+def effective_fee_pct(fee_df, queries):
+    """queries: DataFrame[country, platform, scenario, date] → 当天生效的费率 %（NaN = 当天没有该方案）"""
+    return effective_lookup(fee_df, queries, ["country", "platform", "scenario"], "fee_pct")
+
+def effective_conversion(rate_history, currencies, dates, rates):
+    """
+    按日期取 本币 → MYR 的除数：汇率历史里当天生效的值优先，没有则用 rates（当前汇率）
+    currencies / dates 等长（也可以是单个值，会广播）；<= 0 的汇率按 1 处理（与 conversion_rate 一致）
+    """
+    currencies = np.asarray(currencies, dtype=object)
+    dates = np.broadcast_to(np.asarray(dates, dtype="datetime64[ns]"), currencies.shape)
+    fallback = np.array([conversion_rate(rates, c) for c in currencies], dtype=float)
+    if rate_history is None or rate_history.empty:
+        return fallback
+    queries = pd.DataFrame({"currency": currencies, "date": dates})
+    hist = effective_lookup(rate_history, queries, ["currency"], "rate")
+    return np.where(np.isnan(hist), fallback, np.where(hist > 0, hist, 1.0))
+
+def load_rate_history(path=RATE_HISTORY_FILE):
+    """汇率历史 CSV（currency, rate, effective_from, effective_to）；不存在返回空表"""
+    try:
+        return pd.read_csv(path)
+    except Exception:
+        return pd.DataFrame(columns=RATE_HISTORY_COLUMNS)
+
+def effective_terms(fee_df, rate_history, rates, country, platform, scenario, dates):
+    """
+    一张表按日期逐行取 (费率 %, 汇率除数) 两个数组：dates 为逐行日期（或单个日期，会广播）
+    当天没有该方案的行费率为 NaN（利润也为 NaN）；汇率规则见 effective_conversion
+    """
+    dates = np.asarray(dates, dtype="datetime64[ns]")
+    n = dates.size
+    queries = pd.DataFrame({"country": [country] * n, "platform": [platform] * n, "scenario": [scenario] * n,
+                            "date": dates.ravel()})
+    fee = effective_fee_pct(fee_df, queries)
+    conv = effective_conversion(rate_history, np.full(n, COUNTRY_CURRENCY.get(country, "MYR"), dtype=object),
+                                dates.ravel(), rates)
+    return fee, conv
+
+def scenario_label(platform, scenario, remark):
+    """与侧边栏“选择平台/活动方案”下拉的显示一致"""
+    remark = "" if pd.isna(remark) else str(remark)
+    return f"{platform} — {scenario}（{remark}）"
+
+def fee_scenarios(fee_df, country):
+    """某国家的全部费率方案（附 display 列，用于下拉显示）"""
+    fee_country = fee_df[fee_df["country"] == country].copy()
+    fee_country["display"] = [
+        scenario_label(p, sc, r)
+        for p, sc, r in zip(fee_country["platform"], fee_country["scenario"], fee_country["remark"])
+    ]
+    return fee_country
+
+def lookup_fee_pct(fee_df, country, platform=None, scenario=None):
+    """按 国家 / 平台 / 方案 查费率 %（平台、方案可省略，取第一条匹配）；查不到返回 None"""
+    m = fee_df["country"] == country
+    if platform is not None:
+        m &= fee_df["platform"] == platform
+    if scenario is not None:
+        m &= fee_df["scenario"] == scenario
+    hit = fee_df.loc[m, "fee_pct"]
+    return float(hit.iloc[0]) if not hit.empty else None
+
+# ============== 性能埋点 ==============
+# 核心函数里的 perf_span 在没有激活的 PerfTrace 时什么都不做；app 每次重跑激活一个，结束后写日志
+PERF_LOG_FILE = BASE_DIR / "perf_log.jsonl"
+PERF_LOG_MAX_BYTES = 20 * 1024 * 1024
+_active_trace = ContextVar("profit_perf_trace", default=None)
+
+def _rss_mb():
+    """当前进程常驻内存（MB）；没有 /proc 时退回 ru_maxrss（历史峰值）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError, AttributeError):
+        try:
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+        except ImportError:
+            return None
+
+class PerfTrace:
+    """
+    一次运行（如一次页面重跑）的分段计时：
+        trace = PerfTrace(); trace.start()
+        with perf_span("read", rows=n) as span: ...; span["rows"] = len(df)
+        trace.stop(); trace.write_log(PERF_LOG_FILE, file=...)
+    每段记录：耗时、行数（行/秒）、结束时的 RSS；track_memory=True 时用 tracemalloc 记本段峰值新增内存（较慢）
+    span 可以嵌套（depth 表示层级），父段的峰值包含子段
+    """
+
+    def __init__(self, track_memory=False):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.track_memory = track_memory
+        self.spans = []
+        self._stack = []
+        self._token = None
+        self._t0 = time.perf_counter()
+        self._started_tracemalloc = False
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        self._token = _active_trace.set(self)
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return self
+
+    def stop(self):
+        if self._token is not None:
+            _active_trace.reset(self._token)
+            self._token = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        return self
+
+    @property
+    def total_ms(self):
+        return (time.perf_counter() - self._t0) * 1000.0
+
+    @contextmanager
+    def span(self, name, rows=None, **fields):
+        info = {"stage": name, "depth": len(self._stack), "rows": rows, **fields}
+        tracing = self.track_memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]["_peak"] = max(self._stack[-1].get("_peak", 0), peak)
+            info["_base"] = current
+            tracemalloc.reset_peak()
+        self._stack.append(info)
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            info["start_ms"] = round((start - self._t0) * 1000.0, 3)
+            info["ms"] = round(elapsed * 1000.0, 3)
+            if info.get("rows") is not None and elapsed > 0:
+                info["rows_per_s"] = round(info["rows"] / elapsed)
+            info["rss_mb"] = _rss_mb()
+            if tracing:
+                peak = max(tracemalloc.get_traced_memory()[1], info.pop("_peak", 0))
+                info["peak_mb"] = round((peak - info.pop("_base")) / 2**20, 3)
+                if self._stack:
+                    self._stack[-1]["_peak"] = max(self._stack[-1].get("_peak", 0), peak)
+            self.spans.append(info)
+
+    def to_frame(self):
+        """按开始时间排序的分段表（阶段名按层级缩进）"""
+        cols = ["阶段", "开始 (ms)", "耗时 (ms)", "行数", "行/秒", "峰值新增内存 (MB)", "RSS (MB)"]
+        rows = [
+            ["  " * s["depth"] + s["stage"], s["start_ms"], s["ms"], s.get("rows"), s.get("rows_per_s"),
+             s.get("peak_mb"), None if s.get("rss_mb") is None else round(s["rss_mb"], 1)]
+            for s in sorted(self.spans, key=lambda s: (s["start_ms"], s["depth"]))
+        ]
+        return pd.DataFrame(rows, columns=cols)
+
+    def records(self, **context):
+        """每段一条可 JSON 序列化的记录，带 run_id / 时间戳 / 调用方给的上下文（国家、文件等）"""
+        ts = datetime.now().isoformat(timespec="seconds")
+        return [{"ts": ts, "run_id": self.run_id, **context,
+                 **{k: v for k, v in s.items() if not k.startswith("_")}} for s in self.spans]
+
+    def write_log(self, path=PERF_LOG_FILE, max_bytes=PERF_LOG_MAX_BYTES, **context):
+        """追加写 JSON Lines（每段一行）；超过 max_bytes 时先把旧日志轮转为 .1"""
+        path = Path(path)
+        try:
+            if path.exists() and path.stat().st_size > max_bytes:
+                os.replace(path, path.with_name(path.name + ".1"))
+            with open(path, "a", encoding="utf-8") as f:
+                for rec in self.records(**context):
+                    f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+        except OSError:
+            # 日志写失败不影响页面
+            pass
+
+def perf_stage(name):
+    """装饰器：整个函数作为一个分段（行数取第一个 DataFrame 参数的行数）；没有激活的 PerfTrace 时直接调用"""
+    def wrap(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            trace = _active_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            rows = next((len(a) for a in args if isinstance(a, pd.DataFrame)), None)
+            with trace.span(name, rows=rows):
+                return func(*args, **kwargs)
+        return inner
+    return wrap
+
+def perf_span(name, rows=None, **fields):
+    """当前激活的 PerfTrace 上开一个分段；没有激活时是空操作（yield 一个用完即弃的 dict）"""
+    trace = _active_trace.get()
+    if trace is None:
+        return nullcontext({})
+    return trace.span(name, rows=rows, **fields)
+
+class ProfileCapture:
+    """
+    采集一次运行的函数级 profile：装了 pyinstrument 用它（调用树 HTML），否则用标准库 cProfile
+    capture.start(); ...; out = capture.stop()
+    out: {"kind", "text"（前 top 个函数 / 调用树文本）, "data"（可下载的 bytes）, "file_name", "mime"}
+    """
+
+    def __init__(self, top=40):
+        self.top = top
+        self.kind = None
+        self._prof = None
+
+    def start(self):
+        try:
+            from pyinstrument import Profiler
+            self.kind, self._prof = "pyinstrument", Profiler()
+            self._prof.start()
+        except ImportError:
+            import cProfile
+            self.kind, self._prof = "cProfile", cProfile.Profile()
+            self._prof.enable()
+        return self
+
+    def stop(self):
+        if self.kind == "pyinstrument":
+            self._prof.stop()
+            return {"kind": self.kind, "text": self._prof.output_text(), "data": self._prof.output_html().encode("utf-8"),
+                    "file_name": "profile.html", "mime": "text/html"}
+        import marshal
+        import pstats
+        self._prof.disable()
+        buf = io.StringIO()
+        stats = pstats.Stats(self._prof, stream=buf)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        # .prof 与 cProfile.dump_stats 的格式相同，可用 snakeviz / pstats 打开
+        return {"kind": self.kind, "text": buf.getvalue(), "data": marshal.dumps(stats.stats),
+                "file_name": "profile.prof", "mime": "application/octet-stream"}
+
+# ============== 表格读取与表头清理 ==============
+def clean_column_names_from_multiindex(cols):
+    """
+    cols: array-like from pandas MultiIndex or tuples
+    合并 multiindex header，去掉 Unnamed，拼接为单行列名
+    """
+    new_cols = []
+    for col in cols:
+        if isinstance(col, tuple) or isinstance(col, list):
+            parts = [str(x).strip() for x in col if x is not None and "Unnamed" not in str(x)]
+            joined = " ".join([p for p in parts if p and p.lower() != 'nan']).strip()
+            new_cols.append(joined if joined else None)
+        else:
+            c = str(col)
+            new_cols.append(c if c and "Unnamed" not in c and c.lower() != 'nan' else None)
+    # forward fill None
+    ser = pd.Series(new_cols)
+    if ser.isna().all():
+        # fallback: make synthetic names
+        return [f"Column_{i}" for i in range(len(new_cols))]
+    ser = ser.ffill().bfill()
+    return ser.tolist()
+
+def _is_excel(path):
+    return isinstance(path, pd.ExcelFile) or Path(path).suffix.lower() in [".xlsx", ".xls"]
+
+CSV_WIDTH_SAMPLE_ROWS = 1000
+
+def _csv_width(path, skiprows=None, nrows=None, sample_rows=CSV_WIDTH_SAMPLE_ROWS):
+    """CSV 前几行里最多的字段数（跳过 skiprows 行后最多看 nrows / sample_rows 行）"""
+    skip = skiprows or 0
+    limit = skip + min(nrows or sample_rows, sample_rows)
+    width = 0
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as f:
+        for i, row in enumerate(csv.reader(f)):
+            if i >= limit:
+                break
+            if i >= skip:
+                width = max(width, len(row))
+    return width
+
+def _read_table(path, sheet_name=0, **kwargs):
+    """
+    按扩展名读取 excel / csv（kwargs 原样传给 pandas；sheet_name 只对 excel 有效）
+    CSV 不带表头读取（header=None）时列数按前几行最宽的一行定：pandas 默认按第一行定列数，
+    第一行是只有一格的标题行时后面的行会报 “Expected 1 fields”
+    """
+    if _is_excel(path):
+        return pd.read_excel(path, sheet_name=sheet_name, **kwargs)
+    if "header" in kwargs and kwargs["header"] is None and "names" not in kwargs:
+        kwargs["names"] = range(_csv_width(path, kwargs.get("skiprows"), kwargs.get("nrows")))
+    return pd.read_csv(path, **kwargs)
+
+def _header_label(v):
+    if v is None or pd.isna(v):
+        return None
+    s = str(v).strip()
+    return s if s and not s.startswith("Unnamed") else None
+
+def _fit_names(names, n):
+    """列名个数与表体列数对齐：多余的截掉，不足的补 Column_*"""
+    names = list(names)[:n]
+    return names + [f"Column_{i}" for i in range(len(names), n)]
+
+def _dedupe_names(names):
+    """重名列加 .1 / .2 后缀（与 pandas 读取时的处理一致），避免按列名取到多列"""
+    seen = set()
+    out = []
+    for n in names:
+        cand, k = n, 0
+        while cand in seen:
+            k += 1
+            cand = f"{n}.{k}"
+        seen.add(cand)
+        out.append(cand)
+    return out
+
+def sniff_header(path, header_idx, merge_multirow=False, sheet_name=0, skiprows=0):
+    """
+    只读前 header_idx+1 行，决定列名：
+    - 单行表头：空白 / Unnamed 不超过 30%（未勾选合并多行表头时）
+    - 两行合并表头：第 0 行（合并单元格向右填充）+ 第 header_idx 行，经 clean_column_names_from_multiindex 拼接
+    - 都取不到 → None（调用方改用 Column_*）
+    """
+    head = _read_table(path, sheet_name=sheet_name, header=None, nrows=header_idx + 1, dtype=str,
+                       skiprows=skiprows or None)
+    if len(head) <= header_idx:
+        return None
+    labels = [_header_label(v) for v in head.iloc[header_idx].tolist()]
+    unnamed_count = sum(1 for c in labels if c is None)
+    if header_idx > 0 and (merge_multirow or unnamed_count > 0.3 * len(labels)):
+        top = pd.Series([_header_label(v) for v in head.iloc[0].tolist()], dtype=object).ffill()
+        return clean_column_names_from_multiindex(list(zip(top.tolist(), labels)))
+    if unnamed_count == len(labels):
+        return None
+    # clean remaining unnamed by forward fill
+    return pd.Series(labels, dtype=object).ffill().bfill().tolist()
+
+def try_read_and_clean(path, header_idx, merge_multirow=False, nrows=None, sheet_name=0, skiprows=0):
+    """
+    读取 excel 或 csv，处理合并表头（Unnamed）：
+    - 先用 sniff_header 只读表头附近几行，决定单行表头 / 两行合并表头 / Column_*
+    - 再只读一次表体，把列名替换成 clean names（不会有 Unnamed）
+    merge_multirow: 强制按两行合并表头处理（侧边栏“尝试合并多行表头”）
+    nrows: 只读表体前 n 行（预览用）
+    sheet_name: excel 的工作表（名称或序号，默认第一张；多张表见 read_workbook）
+    skiprows: 先跳过表格最上面几行（如标题行），其余行号都相对跳过之后
+    """
+    try:
+        with perf_span("sniff_header"):
+            names = sniff_header(path, header_idx, merge_multirow, sheet_name=sheet_name, skiprows=skiprows)
+        if names is not None:
+            with perf_span("read_table") as span:
+                df = _read_table(path, sheet_name=sheet_name, header=header_idx, nrows=nrows, skiprows=skiprows or None)
+                span["rows"] = len(df)
+            df.columns = _dedupe_names(_fit_names(names, len(df.columns)))
+            return df
+    except Exception:
+        pass
+    # final fallback: read without header, create Column_*
+    with perf_span("read_table") as span:
+        df = _read_table(path, sheet_name=sheet_name, header=None, nrows=nrows, skiprows=skiprows or None)
+        span["rows"] = len(df)
+    df.columns = [f"Column_{i}" for i in range(len(df.columns))]
+    return df
+
+# ============== 多工作表 Excel（每张表一个进程并行解析） ==============
+def process_pool(max_workers=None):
+    """
+    本项目所有进程池都用 spawn 启动子进程：Streamlit 服务端是多线程的，fork 会把其它线程正持有的锁
+    原样复制进子进程，子进程可能一直卡住（任务函数因此都要是模块顶层函数）
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+SHEET_COLUMN = "工作表"
+HEADER_SCAN_ROWS = 10
+
+def list_sheets(path):
+    """Excel 的工作表名（按工作簿里的顺序，不读单元格）；CSV 返回 []"""
+    if not _is_excel(path):
+        return []
+    with pd.ExcelFile(path) as xl:
+        return [str(name) for name in xl.sheet_names]
+
+def _header_score(labels):
+    """像表头的行返回非空单元格数（至少一半非空、非空的至少 80% 是文字而不是数字），否则 0"""
+    filled = [v for v in labels if v is not None]
+    if not filled or len(filled) < 0.5 * len(labels):
+        return 0
+    texts = sum(re.fullmatch(_PLAIN_NUMBER_RE, v) is None for v in filled)
+    return len(filled) if texts >= 0.8 * len(filled) else 0
+
+def detect_header_row(path, sheet_name=0, preferred=None, max_rows=HEADER_SCAN_ROWS):
+    """
+    找表头行：preferred 行像表头就用它；否则取前 max_rows 行里最“满”的像表头的行（同样满取靠前的，
+    这样标题行 / 空行 / 只有几个分组名的合并表头第一行都不会被选中）；找不到返回 None
+    path 也可以是已打开的 pd.ExcelFile
+    """
+    head = _read_table(path, sheet_name=sheet_name, header=None, dtype=str,
+                       nrows=max(max_rows, (preferred or 0) + 1))
+    scores = [_header_score([_header_label(v) for v in row]) for row in head.itertuples(index=False)]
+    if preferred is not None and preferred < len(scores) and scores[preferred]:
+        return preferred
+    best = max(scores, default=0)
+    return scores.index(best) if best else None
+
+def _read_sheet(task):
+    """
+    一张工作表（在工作进程里执行）：工作簿只打开一次；各张表的表头行可以不同——
+    给定的表头行不像表头时按 detect_header_row 找，表头更靠下（上面多了标题行等）就跳过多出的行，
+    让该表与给定的表头设置对齐（合并两行表头时上一行仍是分组行）
+    """
+    path, sheet, header_idx, merge_multirow = task
+    with pd.ExcelFile(path) as xl:
+        found = detect_header_row(xl, sheet, preferred=header_idx)
+        if found is None or found == header_idx:
+            header, skip = header_idx, 0
+        elif found > header_idx:
+            header, skip = header_idx, found - header_idx
+        else:
+            header, skip = found, 0
+        return try_read_and_clean(xl, header, merge_multirow, sheet_name=sheet, skiprows=skip)
+
+@perf_stage("read_workbook")
+def read_workbook(path, header_idx, merge_multirow=False, sheets=None, max_workers=None):
+    """
+    多工作表 Excel：每张表单独识别表头后纵向拼接，第一列 SHEET_COLUMN 为工作表名
+    sheets：要读的工作表名（默认全部）；列名不同的表按列名对齐，缺的列为空
+    多张表时用进程池每张表一个任务（openpyxl 是纯 Python，线程并行不起来），总耗时约等于最慢的一张表；
+    进程池不可用（如已在不能再开子进程的环境里）时顺序读取
+    """
+    names = list_sheets(path) if sheets is None else [str(x) for x in sheets]
+    tasks = [(str(path), name, header_idx, merge_multirow) for name in names]
+    workers = min(len(tasks), max_workers or os.cpu_count() or 1)
+    frames = None
+    if workers > 1:
+        # 只有进程池本身出问题才退回顺序读取；某张表解析失败的异常原样抛出（顺序再读一遍也一样失败）
+        pool = futures = None
+        try:
+            pool = process_pool(workers)
+            futures = [pool.submit(_read_sheet, task) for task in tasks]
+        except (OSError, NotImplementedError):  # 开不了子进程
+            pass
+        try:
+            if futures is not None:
+                frames = [f.result() for f in futures]
+        except (BrokenProcessPool, pickle.PicklingError):  # 子进程异常退出 / 任务或结果无法序列化
+            frames = None
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+    if frames is None:
+        frames = [_read_sheet(task) for task in tasks]
+    frames = [df.assign(**{SHEET_COLUMN: name}) for df, name in zip(frames, names) if len(df)]
+    if not frames:
+        return pd.DataFrame(columns=[SHEET_COLUMN])
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    return df[[SHEET_COLUMN] + [c for c in df.columns if c != SHEET_COLUMN]]
+
+# ============== 解析缓存（按文件内容哈希） ==============
+# 缓存放在源文件旁的 .parse_cache/ 下：<文件名>__<内容哈希>__h<表头行>[m].pkl
+PARSE_CACHE_DIRNAME = ".parse_cache"
+PARSE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+_hash_memo = {}
+
+def file_content_hash(path):
+    """文件内容 sha1；按 (路径, 大小, mtime) 记忆，未改动的文件不重复读取"""
+    st_ = os.stat(path)
+    memo_key = (str(path), st_.st_size, st_.st_mtime_ns)
+    digest = _hash_memo.get(memo_key)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = _hash_memo[memo_key] = h.hexdigest()
+    return digest
+
+def _parse_cache_dir(path):
+    return Path(path).parent / PARSE_CACHE_DIRNAME
+
+def invalidate_parse_cache(path):
+    """删除某个源文件的全部解析缓存（覆盖上传 / 删除文件时调用）"""
+    p = Path(path)
+    cache_dir = _parse_cache_dir(p)
+    if cache_dir.exists():
+        for f in cache_dir.glob(f"{glob.escape(p.name)}__*.pkl"):
+            f.unlink(missing_ok=True)
+    for k in [k for k in _hash_memo if k[0] == str(p)]:
+        _hash_memo.pop(k, None)
+    _invalidate_shared(p)
+
+# 覆盖上传时旧版本挪到源文件旁的 .previous/ 下，供增量重算 / “与上次上传相比”对比
+PREVIOUS_DIRNAME = ".previous"
+
+def previous_version_path(path):
+    p = Path(path)
+    return p.parent / PREVIOUS_DIRNAME / p.name
+
+def archive_previous_version(path):
+    """
+    覆盖上传前调用：把旧文件连同它的解析缓存一起挪到 .previous/（同盘 rename，不复制、不重新解析）
+    返回旧版本路径；源文件不存在时返回 None
+    """
+    p = Path(path)
+    if not p.exists():
+        return None
+    _invalidate_shared(p)
+    prev = previous_version_path(p)
+    prev.parent.mkdir(parents=True, exist_ok=True)
+    invalidate_parse_cache(prev)
+    os.replace(p, prev)
+    src_dir = _parse_cache_dir(p)
+    if src_dir.exists():
+        dst_dir = _parse_cache_dir(prev)
+        for f in src_dir.glob(f"{glob.escape(p.name)}__*.pkl"):
+            dst_dir.mkdir(parents=True, exist_ok=True)
+            os.replace(f, dst_dir / f.name)
+    # rename 不改大小 / mtime，内容哈希直接转记到新路径下
+    for k in [k for k in _hash_memo if k[0] == str(p)]:
+        _hash_memo[(str(prev),) + k[1:]] = _hash_memo.pop(k)
+    return prev
+
+def discard_previous_version(path):
+    """删除文件时一并删除它的旧版本及解析缓存"""
+    prev = previous_version_path(path)
+    invalidate_parse_cache(prev)
+    prev.unlink(missing_ok=True)
+
+def _evict_lru(files, max_bytes):
+    """files 合计超过 max_bytes 时，按最近使用时间（mtime）从旧到新删除"""
+    entries = []
+    for f in files:
+        try:
+            st_ = f.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st_.st_mtime, st_.st_size, f))
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        f.unlink(missing_ok=True)
+        total -= size
+
+def evict_parse_cache(root, max_bytes=PARSE_CACHE_MAX_BYTES):
+    """root 下所有 .parse_cache 合计超过 max_bytes 时，按最近使用时间（mtime）从旧到新删除"""
+    _evict_lru(Path(root).glob(f"**/{PARSE_CACHE_DIRNAME}/*.pkl"), max_bytes)
+
+def parse_cache_key(path, header_idx, merge_multirow=False, sheets=None):
+    """解析结果的 key：(文件内容哈希, 表头设置[+ 工作表])；内容相同的文件（不论路径）共用一份"""
+    header_key = f"h{header_idx}{'m' if merge_multirow else ''}"
+    if sheets is not None:
+        header_key += "s" + hashlib.sha1("\x00".join(map(str, sheets)).encode("utf-8")).hexdigest()[:8]
+    return file_content_hash(path), header_key
+
+@perf_stage("read_and_clean")
+def read_and_clean_cached(path, header_idx, merge_multirow=False, cache_root=None, max_bytes=PARSE_CACHE_MAX_BYTES,
+                          sheets=None):
+    """
+    try_read_and_clean 的持久缓存版本：
+    - key = 文件内容哈希 + header_idx（+ 是否合并多行表头），同名文件被覆盖后哈希变化，自然不会命中旧结果
+    - 命中时直接读 pickle，并刷新 mtime 作为 LRU 依据
+    - 未命中时解析、写入缓存，再按 cache_root（默认源文件所在目录）做容量淘汰
+    sheets：给出时按 read_workbook 读这些工作表并拼接（带 SHEET_COLUMN 列）；默认只读第一张表
+    """
+    p = Path(path)
+    digest, header_key = parse_cache_key(p, header_idx, merge_multirow, sheets)
+    cache_file = _parse_cache_dir(p) / f"{p.name}__{digest[:16]}__{header_key}.pkl"
+    if cache_file.exists():
+        try:
+            with perf_span("parse_cache_load") as span:
+                df = pd.read_pickle(cache_file)
+                span["rows"] = len(df)
+            os.utime(cache_file)
+            return df
+        except Exception:
+            cache_file.unlink(missing_ok=True)
+
+    if sheets is not None:
+        df = read_workbook(p, header_idx, merge_multirow, sheets=sheets)
+    else:
+        df = try_read_and_clean(p, header_idx, merge_multirow)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = temp_path(cache_file)
+        df.to_pickle(tmp)
+        os.replace(tmp, cache_file)
+        evict_parse_cache(cache_root or p.parent, max_bytes)
+    except OSError:
+        # 缓存写失败不影响本次结果
+        pass
+    return df
+
+# ============== 跨会话共享缓存（同一进程内所有会话共用一份） ==============
+SHARED_CACHE_MAX_MB = 2048
+SHARED_HOLDER_TTL_S = 3600
+
+def object_nbytes(obj):
+    """DataFrame / Series（含字符串本身）、带 nbytes 的对象、以及它们组成的 tuple / list 的内存占用"""
+    if isinstance(obj, (tuple, list)):
+        return sum(object_nbytes(x) for x in obj)
+    if isinstance(obj, pd.DataFrame):
+        return frame_nbytes(obj)
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    return int(getattr(obj, "nbytes", 0))
+
+class SharedFrameCache:
+    """
+    进程内跨会话共享的只读缓存（Streamlit 的所有会话都在同一个进程里）：
+    - 同一份内容只加载一次：key 由调用方给（表格用 内容哈希 + 表头设置，费率配置用版本 sha1）；
+      多个会话同时请求同一个 key 时只有一个去加载，其余等它加载完拿同一个对象（不复制）
+    - 引用计数：每个会话（holder）的每个用途（slot，如 “当前表格” / “上一版”）引用一个 key，换文件时自动换引用；
+      超过 holder_ttl 秒没再出现的会话视为已离开
+    - 文件被覆盖 / 删除时 invalidate(path) 移除该文件的条目；总量超过 max_mb 时淘汰没有会话引用、最久未用的
+    拿到的对象是共享的，调用方只读使用（pandas 写时复制：改列值会得到自己的副本，但不要在原对象上增删列）
+    """
+
+    def __init__(self, max_mb=SHARED_CACHE_MAX_MB, holder_ttl=SHARED_HOLDER_TTL_S):
+        self.max_mb = max_mb
+        self.holder_ttl = holder_ttl
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> {"value", "nbytes", "path", "last_used"}
+        self._loading = {}  # key -> threading.Event（正在加载）
+        self._holders = {}  # holder -> {"seen": 时间, "slots": {slot: key}}
+        _shared_caches.add(self)
+
+    def get(self, key, load, holder=None, slot=None, path=None):
+        """
+        取 key 对应的共享对象；没有则调用 load() 加载并登记（path 为来源文件，invalidate 用）
+        holder / slot 给出时登记引用：同一会话的同一 slot 只引用一个 key
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    entry["last_used"] = time.monotonic()
+                    self._hold(holder, slot, key)
+                    return entry["value"]
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    break
+            # 别的会话正在加载同一个 key：等它完成后重新查（加载失败则由本会话重试）
+            event.wait()
+        try:
+            value = load()
+        except BaseException:
+            with self._lock:
+                self._loading.pop(key).set()
+            raise
+        with self._lock:
+            self.loads += 1
+            self._entries[key] = {"value": value, "nbytes": object_nbytes(value),
+                                  "path": None if path is None else str(path), "last_used": time.monotonic()}
+            self._hold(holder, slot, key)
+            self._loading.pop(key).set()
+            self._evict()
+        return value
+
+    def _hold(self, holder, slot, key):
+        if holder is None:
+            return
+        h = self._holders.setdefault(holder, {"seen": 0.0, "slots": {}})
+        h["seen"] = time.monotonic()
+        h["slots"][slot] = key
+
+    def drop(self, holder, slot=None):
+        """会话不再使用某个 slot（slot=None：整个会话离开）"""
+        with self._lock:
+            if slot is None:
+                self._holders.pop(holder, None)
+            elif holder in self._holders:
+                self._holders[holder]["slots"].pop(slot, None)
+            self._evict()
+
+    def refs(self):
+        """key → 引用它的会话数"""
+        counts = {}
+        for h in self._holders.values():
+            for key in set(h["slots"].values()):
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def invalidate(self, path):
+        """移除来源为 path 的全部条目（正在使用的会话手里的对象不受影响，下次重跑时重新取）"""
+        path = str(path)
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e["path"] == path]:
+                self._entries.pop(key)
+                self.evictions += 1
+
+    def _evict(self):
+        now = time.monotonic()
+        for holder in [h for h, v in self._holders.items() if now - v["seen"] > self.holder_ttl]:
+            self._holders.pop(holder)
+        max_bytes = self.max_mb * 1024 * 1024
+        total = sum(e["nbytes"] for e in self._entries.values())
+        if total <= max_bytes:
+            return
+        used = self.refs()
+        for key, entry in sorted(self._entries.items(), key=lambda kv: kv[1]["last_used"]):
+            if total <= max_bytes:
+                break
+            if key in used:
+                continue
+            self._entries.pop(key)
+            total -= entry["nbytes"]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory_mb": sum(e["nbytes"] for e in self._entries.values()) / 2**20,
+                "sessions": len(self._holders),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def table(self):
+        """每个条目一行：类型 / 来源文件 / 内存 / 引用会话数 / 最近使用（秒前）"""
+        with self._lock:
+            used, now = self.refs(), time.monotonic()
+            rows = [[key[0] if isinstance(key, tuple) else str(key), e["path"], round(e["nbytes"] / 2**20, 2),
+                     used.get(key, 0), round(now - e["last_used"], 1)] for key, e in self._entries.items()]
+        return pd.DataFrame(rows, columns=["类型", "来源文件", "内存 (MB)", "引用会话数", "最近使用 (s 前)"])
+
+_shared_caches = weakref.WeakSet()
+
+def _invalidate_shared(path):
+    for cache in list(_shared_caches):
+        cache.invalidate(path)
+
+def invalidate_shared_caches(path):
+    """
+    文件在别的进程里被覆盖上传（批量上传的工作进程调用 archive_previous_version）后，在本进程调用：
+    丢掉本进程共享缓存里该文件及其旧版本（.previous/）的条目
+    """
+    _invalidate_shared(Path(path))
+    _invalidate_shared(previous_version_path(path))
+
+# 进程内默认实例：app 的所有会话和 FeeConfigStore 共用
+SHARED_CACHE = SharedFrameCache()
+
+
+def read_and_clean_shared(path, header_idx, merge_multirow=False, cache_root=None, holder=None, slot="sheet",
+                          cache=None, sheets=None):
+    """
+    read_and_clean_cached 的跨会话共享版本：同一进程内同一份内容只解析 / 读取一次，返回共享的只读 DataFrame
+    holder：会话标识（引用计数用），slot：该会话里的用途
+    """
+    cache = SHARED_CACHE if cache is None else cache
+    return cache.get(("sheet",) + parse_cache_key(path, header_idx, merge_multirow, sheets),
+                     lambda: read_and_clean_cached(path, header_idx, merge_multirow=merge_multirow,
+                                                   cache_root=cache_root, sheets=sheets),
+                     holder=holder, slot=slot, path=path)
+
+def list_sheets_shared(path, cache=None):
+    """list_sheets 按文件内容记在共享缓存里（大工作簿每次重跑都打开一遍也要几百毫秒）"""
+    cache = SHARED_CACHE if cache is None else cache
+    return cache.get(("sheet_names", file_content_hash(path)), lambda: list_sheets(path), path=path)
+
+# ============== 价格解析 ==============
+# 价格分隔符：/ | ; ， 以及空白；英文逗号本身也是分隔符
+PRICE_SPLIT_RE = re.compile(r"[\/\|;，,\s]+")
+_NULL_TOKENS = ["nan", "none"]
+
+# 价格拆分：支持多分隔符（单元格版本，批量请用 parse_price_series / parse_price_columns）
+def split_price_cell(v):
+    if pd.isna(v):
+        return []
+    parts = [p for p in PRICE_SPLIT_RE.split(str(v)) if p != "" and p.lower() not in _NULL_TOKENS]
+    out = []
+    for p in parts:
+        try:
+            out.append(float(p))
+        except ValueError:
+            # ignore non-numeric candidate
+            continue
+    return out
+
+# 批量解析用的字节查找表：ASCII 分隔符 / 数字字符（非 ASCII 分隔符先用正则统一成空格）
+_SEP_BYTES = np.zeros(256, dtype=bool)
+_SEP_BYTES[list(b"/|;, \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f")] = True
+_NUMERIC_BYTES = np.zeros(256, dtype=bool)
+_NUMERIC_BYTES[list(b"0123456789.eE+-")] = True
+_SPACE, _NEWLINE, _NA_MARK = 32, 10, ord("~")
+# 单格价格数超过此值的行改用逐格解析，避免宽表列数被个别长文本撑大
+_MAX_PRICES_PER_CELL = 16
+
+def _token_to_float(tok):
+    """
+    与 split_price_cell 对单个片段的处理一致：nan / none 与非数字 → None（丢弃）；
+    float() 能解析的都保留，包括 "+nan" 这类解析出 NaN 的片段（逐格版本也会把它当作一个价格）
+    """
+    if tok.lower() in _NULL_TOKENS:
+        return None
+    try:
+        return float(tok)
+    except ValueError:
+        return None
+
+def _to_float_or_nan(p):
+    if isinstance(p, str):
+        v = _token_to_float(p)
+        return np.nan if v is None else v
+    return np.nan if isinstance(p, bool) or pd.isna(p) else float(p)
+
+def _empty_prices():
+    return pd.DataFrame({"row": pd.Series(dtype=np.int64), "price": pd.Series(dtype=float)})
+
+def _split_cells(s):
+    """逐格解析（兜底路径）→ long-form (row, price)；解析出的 NaN 价格保留（只去掉没有价格的格）"""
+    lists = s.map(split_price_cell)
+    lists = lists[lists.str.len() > 0].explode()
+    return pd.DataFrame({"row": lists.index.to_numpy(dtype=np.int64),
+                         "price": lists.to_numpy(dtype=float)})
+
+def parse_price_series(s):
+    """
+    批量拆分一整列价格（与 split_price_cell 逐格结果一致）：
+    返回 long-form DataFrame[row, price]，row 取自 s.index，同一单元格内保持原顺序
+
+    做法：整列拼成一个字节串（每格一行），用查找表把分隔符统一成单个空格，
+    非数字片段（文字 / nan / none / 全角数字等）在 Python 里单独处理并打上 "~" 空值标记，
+    剩下的纯数字部分交给 read_csv 的 C 解析器按“每格一行、每个价格一列”整体转成 float。
+    """
+    s = s[s.notna()]
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        # 数值列：每格就是一个价格，无需字符串解析
+        return pd.DataFrame({"row": s.index.to_numpy(dtype=np.int64),
+                             "price": s.to_numpy(dtype=float)})
+    if s.empty:
+        return _empty_prices()
+
+    # \x00 作为单元格边界；单元格本身含 \x00 或 "~" 时退回逐格解析
+    joined = "\x00".join(s.astype(str).tolist())
+    if joined.count("\x00") != len(s) - 1 or "~" in joined:
+        return _split_cells(s)
+    joined = joined.replace("，", " ")
+    if not joined.isascii():
+        # 其它 Unicode 空白（全角空格等）
+        joined = PRICE_SPLIT_RE.sub(" ", joined)
+
+    buf = np.frombuffer(joined.encode("utf-8"), dtype=np.uint8).copy()
+    buf[_SEP_BYTES[buf]] = _SPACE
+    buf[buf == 0] = _NEWLINE
+    # 连续分隔符合并为一个空格，并去掉每行首尾的分隔符
+    is_sp = buf == _SPACE
+    is_delim = is_sp | (buf == _NEWLINE)
+    buf = buf[~(is_sp & np.r_[True, is_delim[:-1]])]
+    buf = buf[~((buf == _SPACE) & np.r_[buf[1:] == _NEWLINE, True])]
+
+    is_nl = buf == _NEWLINE
+    is_sp = buf == _SPACE
+    is_delim = is_sp | is_nl
+    line_of = np.r_[0, np.cumsum(is_nl)[:-1]]
+    tokens_per_line = np.bincount(line_of[is_sp], minlength=len(s)) + 1
+
+    rows_index = s.index.to_numpy(dtype=np.int64)
+    extra = []
+    long_lines = tokens_per_line > _MAX_PRICES_PER_CELL
+    if long_lines.any():
+        extra.append(_split_cells(s[long_lines]))
+        buf = buf[is_nl | ~long_lines[line_of]]
+        is_nl = buf == _NEWLINE
+        is_sp = buf == _SPACE
+        is_delim = is_sp | is_nl
+        line_of = np.r_[0, np.cumsum(is_nl)[:-1]]
+        tokens_per_line[long_lines] = 1
+
+    fills = None
+    other = ~(_NUMERIC_BYTES[buf] | is_delim)
+    if other.any():
+        # 含非数字字符的片段：逐个（按内容去重）解析，原位置替换为 "~"（读作 NaN）
+        tok_id = np.cumsum(is_delim)
+        is_start = ~is_delim & np.r_[True, is_delim[:-1]]
+        bad = np.zeros(tok_id[-1] + 1, dtype=bool)
+        bad[tok_id[other]] = True
+        bad_byte = bad[tok_id] & ~is_delim
+        starts = np.flatnonzero(is_start & bad_byte)
+        delim_pos = np.flatnonzero(is_delim)
+        ends = np.r_[delim_pos, len(buf)][np.searchsorted(delim_pos, starts)]
+
+        raw = buf.tobytes()
+        cache = {}
+        values = np.empty(len(starts))
+        ok = np.empty(len(starts), dtype=bool)
+        for i, (a, b) in enumerate(zip(starts.tolist(), ends.tolist())):
+            tok = raw[a:b]
+            if tok in cache:
+                v = cache[tok]
+            else:
+                v = cache[tok] = _token_to_float(tok.decode("utf-8"))
+            ok[i] = v is not None
+            values[i] = np.nan if v is None else v
+        if ok.any():
+            # 位置：第几行（单元格）的第几个片段
+            sp_before = np.r_[0, np.cumsum(is_sp)]
+            line_start = np.r_[0, np.flatnonzero(is_nl) + 1]
+            ok_lines = line_of[starts[ok]]
+            fills = (ok_lines, sp_before[starts[ok]] - sp_before[line_start[ok_lines]], values[ok])
+        buf[starts] = _NA_MARK
+        buf = buf[~(bad_byte & ~is_start)]
+
+    n_cols = int(tokens_per_line.max())
+    # 末尾追加一行 "~"，避免 C 解析器丢掉结尾的空行（空单元格）
+    wide = pd.read_csv(
+        io.BytesIO(buf.tobytes() + b"\n~"), sep=" ", header=None, names=range(n_cols), index_col=False,
+        quoting=csv.QUOTE_NONE, skip_blank_lines=False, keep_default_na=False, na_values=["", "~"],
+        float_precision="round_trip", low_memory=False,
+    )
+    for k in wide.columns:
+        if not pd.api.types.is_numeric_dtype(wide[k]):
+            # 只由数字字符组成但不是合法数字（1.2.3、1e、- 等）：逐段 float()
+            # pandas 3 起这类列是 str 类型而不是 object，按“非数值列”判断
+            wide[k] = wide[k].map(_to_float_or_nan)
+
+    # pandas 3 的 to_numpy 可能返回只读视图，写入 fills 前要拷贝
+    values = np.array(wide.to_numpy(dtype=float)[:len(s)])
+    keep = ~np.isnan(values)
+    if fills is not None:
+        values[fills[0], fills[1]] = fills[2]
+        keep[fills[0], fills[1]] = True
+    values = values.ravel()
+    keep = keep.ravel()
+    out = pd.DataFrame({"row": np.repeat(rows_index, n_cols)[keep], "price": values[keep]})
+    if extra:
+        out = pd.concat([out] + extra, ignore_index=True)
+        out = out.iloc[np.argsort(out["row"].to_numpy(), kind="stable")].reset_index(drop=True)
+    return out
+
+def parse_price_columns(df, price_cols, rows_mask=None):
+    """
+    多列批量解析：price_cols 按顺序拼接，等价于逐行 prices += split_price_cell(row[col])
+    rows_mask: 可选布尔数组，只解析被选中的行
+    返回 long-form DataFrame[row, col, price]：row 为行位置，col 为 price_cols 中的序号
+    """
+    parts = []
+    for k, c in enumerate(price_cols or []):
+        s = _get_col(df, c)
+        if s is None:
+            continue
+        if rows_mask is not None:
+            s = s[rows_mask]
+        long = parse_price_series(s)
+        long.insert(1, "col", k)
+        parts.append(long)
+    if not parts:
+        empty = _empty_prices()
+        empty.insert(1, "col", pd.Series(dtype=np.int64))
+        return empty
+    long = pd.concat(parts, ignore_index=True)
+    return long.sort_values("row", kind="stable").reset_index(drop=True)
+
+# ============== 利润计算（向量化） ==============
+def result_columns(currency):
+    """结果表列顺序（与页面 / 导出保持一致）"""
+    return [
+        "产品名称",
+        f"成本 ({currency})",
+        f"卖价 ({currency})",
+        f"平台抽成 ({currency})",
+        "利润 (MYR)",
+        "利润率 %",
+        "个人抽成 (MYR)",
+        "来源",
+        "平台方案",
+    ]
+
+def _get_col(df, col):
+    """按列名取一列（位置索引）；列不存在返回 None，重名列取第一列"""
+    if not col or col not in df.columns:
+        return None
+    s = df[col]
+    if isinstance(s, pd.DataFrame):
+        s = s.iloc[:, 0]
+    return s.reset_index(drop=True)
+
+def _cell_text(s):
+    """逐格 str(v).strip()：pandas 3 的 astype(str) 会保留空值，空值格在这里按原样转成 "nan" / "None" 等文字"""
+    text = s.astype(str)
+    missing = text.isna().to_numpy()
+    if missing.any():
+        text = text.astype(object)
+        text[missing] = [str(v) for v in s[missing]]
+    return text.str.strip()
+
+def profit_columns(cost, price, platform_fee_pct, personal_commission_pct, conv):
+    """
+    单价层面的利润公式（numpy 数组 / 标量均可广播）：
+    返回 (平台抽成 本币, 利润 MYR, 利润率 %, 个人抽成 MYR)
+    """
+    # 价格可以是 inf / NaN（"inf"、"+nan" 这类单元格）：结果按浮点规则为 NaN / inf，与逐行版本一样不告警
+    with np.errstate(divide="ignore", invalid="ignore"):
+        platform_fee_local = price * (platform_fee_pct / 100.0)
+        profit_local = price - cost - platform_fee_local
+        margin_pct = np.where(price > 0, profit_local / price * 100.0, np.nan)
+        personal_comm_local = profit_local * (personal_commission_pct / 100.0)
+        # convert to MYR
+        return platform_fee_local, profit_local / conv, margin_pct, personal_comm_local / conv
+
+@perf_stage("compute_profit")
+def compute_profit(df, mapping, platform_fee_pct, personal_commission_pct, conv,
+                   currency="MYR", platform_label="自定义"):
+    """
+    df: 已清理表头的价钱表
+    mapping: {"name", "cost", "promo_cost", "promo_price", "price_cols"[, "sheet"]} → 列名（可为 None / []）
+    规则与逐行版本一致：
+    - 促销成本 + 促销售价都有值 → 用促销（Promotion），否则用普通成本 + 普通卖价列（Normal）
+    - 每个单元格可含多个价格，逐个展开为一行；无有效价格的行跳过
+    - 金额先按本币计算，利润 / 个人抽成再除以 conv 换算为 MYR
+    platform_fee_pct / conv: 标量，或与 df 等长的逐行数组（见 effective_terms）
+    结果的 index 为该价格所在的源表行位置（增量重算 update_profit 按它对行）
+    """
+    n = len(df)
+    cols = result_columns(currency)
+
+    name_s = _get_col(df, mapping.get("name"))
+    cost_s = _get_col(df, mapping.get("cost"))
+    promo_cost_s = _get_col(df, mapping.get("promo_cost"))
+    promo_price_s = _get_col(df, mapping.get("promo_price"))
+
+    # promotion priority
+    if promo_cost_s is not None and promo_price_s is not None:
+        use_promo = (promo_cost_s.notna() & promo_price_s.notna()).to_numpy()
+    else:
+        use_promo = np.zeros(n, dtype=bool)
+
+    normal_cost = pd.to_numeric(cost_s, errors="coerce").to_numpy(dtype=float) if cost_s is not None else np.full(n, np.nan)
+    if promo_cost_s is not None:
+        promo_cost = pd.to_numeric(promo_cost_s, errors="coerce").to_numpy(dtype=float)
+        base_cost = np.where(use_promo, promo_cost, normal_cost)
+    else:
+        base_cost = normal_cost
+    base_cost = np.nan_to_num(base_cost, nan=0.0)
+
+    # 展开价格：促销行只取促销售价列；普通行按 price_cols 顺序依次取
+    with perf_span("parse_prices", rows=n):
+        parts = [parse_price_columns(df, mapping.get("price_cols"), rows_mask=~use_promo)[["row", "price"]]]
+        if promo_price_s is not None and use_promo.any():
+            parts.append(parse_price_series(promo_price_s[use_promo]))
+        long = pd.concat(parts, ignore_index=True)
+    if long.empty:
+        return pd.DataFrame(columns=cols)
+    long = long.sort_values("row", kind="stable")
+
+    rows = long["row"].to_numpy()
+    price = long["price"].to_numpy(dtype=float)
+    cost = base_cost[rows]
+
+    # 费率 / 汇率可以是标量，也可以是按原表逐行的数组（按生效日期逐行取值时）
+    if np.ndim(platform_fee_pct):
+        platform_fee_pct = np.asarray(platform_fee_pct, dtype=float)[rows]
+    if np.ndim(conv):
+        conv = np.asarray(conv, dtype=float)[rows]
+    platform_fee_local, profit_myr, margin_pct, personal_comm_myr = profit_columns(
+        cost, price, platform_fee_pct, personal_commission_pct, conv)
+
+    if name_s is not None:
+        product = _cell_text(name_s).to_numpy()[rows]
+    else:
+        product = np.full(len(rows), "", dtype=object)
+
+    out = pd.DataFrame({
+        cols[0]: product,
+        cols[1]: cost,
+        cols[2]: price,
+        cols[3]: platform_fee_local,
+        cols[4]: profit_myr,
+        cols[5]: margin_pct,
+        cols[6]: personal_comm_myr,
+        cols[7]: np.where(use_promo[rows], "Promotion", "Normal"),
+        cols[8]: platform_label or "自定义",
+    }, index=pd.Index(rows))
+    # 多工作表拼接的表：结果带上每个价格来自哪张工作表
+    sheet_s = _get_col(df, mapping.get("sheet"))
+    if sheet_s is not None:
+        out[SHEET_COLUMN] = sheet_s.astype(str).to_numpy()[rows]
+    return out
+
+@perf_stage("sort_results")
+def sorted_results(result_df):
+    """页面显示用：产品名转字符串，按利润从高到低排序（保留源表行位置 index）"""
+    result_df = result_df.assign(**{"产品名称": result_df["产品名称"].astype(str)})
+    return result_df.sort_values(by="利润 (MYR)", ascending=False, kind="stable")
+
+def compute_profit_scenarios(df, mapping, scenarios, personal_commission_pct, conv, currency="MYR"):
+    """
+    同一张表按多个费率方案计算：价格只解析一次
+    scenarios: [(方案名, 平台费率 %), ...]；结果按方案顺序纵向拼接，平台方案列 = 方案名
+    """
+    base = compute_profit(df, mapping, 0.0, personal_commission_pct, conv, currency=currency)
+    cols = result_columns(currency)
+    cost = base[cols[1]].to_numpy(dtype=float)
+    price = base[cols[2]].to_numpy(dtype=float)
+    frames = []
+    for label, fee_pct in scenarios:
+        fee, profit_myr, margin_pct, comm_myr = profit_columns(cost, price, float(fee_pct), personal_commission_pct, conv)
+        frames.append(base.assign(**{cols[3]: fee, cols[4]: profit_myr, cols[5]: margin_pct,
+                                     cols[6]: comm_myr, cols[8]: label}))
+    if not frames:
+        return base.iloc[0:0]
+    return pd.concat(frames, ignore_index=True)
+
+# ============== 紧凑表示（省内存） ==============
+# 只做无损转换：数值列能精确放进 float32 才用 float32；字符串列只有“纯数字”时才转数值，
+# 否则保持原样，保证 compute_profit 的结果（包括“促销列是否有值”的判断）与转换前完全一致
+COMPACT_CATEGORY_MAX_RATIO = 0.5  # 不同值 ≤ 非空值的一半时转 category
+_PLAIN_NUMBER_RE = r"\s*[-+]?(?:\d+\.?\d*|\.\d+)\s*"
+RESULT_CATEGORY_COLUMNS = ["产品名称", "来源", "平台方案", SHEET_COLUMN]
+
+def frame_nbytes(df):
+    """DataFrame 实际占用内存（含字符串本身与 index）"""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+def _as_float(arr):
+    """float64 数组：能无损放进 float32 时返回 float32"""
+    f32 = arr.astype(np.float32)
+    return f32 if np.array_equal(f32.astype(np.float64), arr, equal_nan=True) else arr
+
+def _compact_column(s, text=False):
+    """text=True：只可能转 category（如产品名称列，纯数字的 SKU 名不能变成 123.0）"""
+    if isinstance(s.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(s):
+        return s
+    if not text and pd.api.types.is_numeric_dtype(s):
+        return pd.Series(_as_float(s.to_numpy(dtype=np.float64)), index=s.index, name=s.name)
+    kind = pd.api.types.infer_dtype(s, skipna=True)
+    if not text and kind in ("integer", "floating", "mixed-integer-float", "decimal"):
+        num = pd.to_numeric(s, errors="coerce")
+        if num.notna().sum() == s.notna().sum():
+            return pd.Series(_as_float(num.to_numpy(dtype=np.float64)), index=s.index, name=s.name)
+        return s
+    if kind == "string":
+        present = s.dropna()
+        if not text and len(present) and present.str.fullmatch(_PLAIN_NUMBER_RE).all():
+            num = pd.to_numeric(s, errors="coerce")
+            return pd.Series(_as_float(num.to_numpy(dtype=np.float64)), index=s.index, name=s.name)
+        if present.nunique() <= COMPACT_CATEGORY_MAX_RATIO * len(present):
+            return s.astype("category")
+    return s
+
+def compact_frame(df, text_columns=()):
+    """整表无损压缩：数值 → float32 / float64，重复多的字符串 → category，其它列原样"""
+    cols = {i: _compact_column(df.iloc[:, i], text=df.columns[i] in text_columns) for i in range(df.shape[1])}
+    return pd.DataFrame(cols).set_axis(df.columns, axis=1)
+
+@perf_stage("compact_sheet")
+def compact_sheet(df, mapping, keep=()):
+    """计算前的瘦身：只留映射到的列（及 keep 里的列，如日期列），再 compact_frame（名称列不转数值）"""
+    cols = [c for c in dict.fromkeys(_mapped_columns(mapping) + [c for c in keep if c]) if c in df.columns]
+    sub = df.loc[:, ~df.columns.duplicated()][cols].reset_index(drop=True)
+    return compact_frame(sub, text_columns=[mapping.get("name")])
+
+@perf_stage("compact_results")
+def compact_results(result_df):
+    """结果瘦身：产品名称 / 来源 / 平台方案 → category，金额列无损时 float32，index → int32"""
+    conv = {}
+    for col in result_df.columns:
+        s = result_df[col]
+        if col in RESULT_CATEGORY_COLUMNS and not isinstance(s.dtype, pd.CategoricalDtype):
+            conv[col] = s.astype("category")
+        elif pd.api.types.is_float_dtype(s):
+            conv[col] = pd.Series(_as_float(s.to_numpy(dtype=np.float64)), index=result_df.index)
+    out = result_df.assign(**conv)
+    index = out.index.to_numpy()
+    if index.dtype.kind == "i" and (len(index) == 0 or index.max() < 2**31):
+        out.index = pd.Index(index.astype(np.int32))
+    return out
+
+# ============== 增量重算（重新上传只改了少数行时） ==============
+def _mapped_columns(mapping):
+    cols = [mapping.get(k) for k in ("name", "cost", "promo_cost", "promo_price", "sheet")]
+    return [c for c in cols + list(mapping.get("price_cols") or []) if c]
+
+def _row_keys(old_df, new_df, mapping):
+    """
+    新旧两版各行的身份（int64）：产品名称（去首尾空格）+ 同名第几次出现
+    名称在两版之间统一编码后与出现次序拼成一个整数；没有名称列时退化为行号
+    """
+    old_name, new_name = _get_col(old_df, mapping.get("name")), _get_col(new_df, mapping.get("name"))
+    if old_name is None or new_name is None:
+        return np.arange(len(old_df), dtype=np.int64), np.arange(len(new_df), dtype=np.int64)
+    codes, _ = pd.factorize(_cell_text(pd.concat([old_name, new_name], ignore_index=True)))
+    codes = codes.astype(np.int64)
+
+    def keys(c):
+        occ = pd.Series(c).groupby(c, sort=False).cumcount().to_numpy(dtype=np.int64)
+        return (c << 32) | occ
+
+    return keys(codes[:len(old_df)]), keys(codes[len(old_df):])
+
+def _rows_differ(old_df, new_df, mapping, old_pos, new_pos):
+    """逐个映射列比较已对齐的新旧行（空值与空值视为相同）；返回每对是否有改动"""
+    differ = np.zeros(len(new_pos), dtype=bool)
+    for col in _mapped_columns(mapping):
+        a, b = _get_col(old_df, col), _get_col(new_df, col)
+        if a is None or b is None:
+            if (a is None) != (b is None):
+                differ[:] = True
+            continue
+        a = a.take(old_pos).reset_index(drop=True)
+        b = b.take(new_pos).reset_index(drop=True)
+        try:
+            same = a.eq(b).fillna(False).to_numpy(dtype=bool)
+        except TypeError:
+            same = (a.astype(str) == b.astype(str)).to_numpy(dtype=bool)
+        differ |= ~(same | (a.isna() & b.isna()).to_numpy(dtype=bool))
+    return differ
+
+@perf_stage("diff_sheets")
+def diff_sheets(old_df, new_df, mapping):
+    """
+    按“产品名称 + 同名出现次序”对齐新旧两版清理后的表，逐列比较映射到的列（名称 / 成本 / 促销 / 各卖价列），返回 dict：
+    - unchanged / changed：(旧行位置数组, 新行位置数组)，一一对应，按新行位置排序
+    - added：新行位置；removed：旧行位置
+    - old_keys / new_keys：两版的行身份（change_report 用）；n_old / n_new：行数
+    """
+    old_keys, new_keys = _row_keys(old_df, new_df, mapping)
+    old_of_new = pd.Index(old_keys).get_indexer(new_keys)
+    matched = old_of_new >= 0
+    new_pos = np.flatnonzero(matched)
+    old_pos = old_of_new[matched]
+    differ = _rows_differ(old_df, new_df, mapping, old_pos, new_pos)
+    seen = np.zeros(len(old_df), dtype=bool)
+    seen[old_pos] = True
+    return {
+        "unchanged": (old_pos[~differ], new_pos[~differ]),
+        "changed": (old_pos[differ], new_pos[differ]),
+        "added": np.flatnonzero(~matched),
+        "removed": np.flatnonzero(~seen),
+        "old_keys": old_keys,
+        "new_keys": new_keys,
+        "n_old": len(old_df),
+        "n_new": len(new_df),
+    }
+
+def _compute_rows(df, rows, mapping, platform_fee_pct, personal_commission_pct, conv, currency, platform_label):
+    """只算 df 的 rows 这些行；结果 index 仍为 df 中的行位置"""
+    part = compute_profit(df.iloc[rows].reset_index(drop=True), mapping, platform_fee_pct,
+                          personal_commission_pct, conv, currency=currency, platform_label=platform_label)
+    part.index = np.asarray(rows, dtype=np.int64)[part.index.to_numpy(dtype=np.int64)]
+    return part
+
+@perf_stage("update_profit")
+def update_profit(old_result, diff, new_df, mapping, platform_fee_pct, personal_commission_pct, conv,
+                  currency="MYR", platform_label="自定义"):
+    """
+    增量重算：old_result 为旧版表的 compute_profit 结果（可已被 sorted_results 排过序，index 为旧行位置），
+    未改动行直接沿用并改写为新行位置，只对新增 / 改动的行重新计算；
+    返回与 compute_profit(new_df, ...) 相同的结果（按源表行顺序；同一行内多个价格的先后沿用 old_result）
+    费率 / 汇率只支持标量（逐行数组时请全量计算）
+    """
+    old_pos, new_pos = diff["unchanged"]
+    remap = np.full(diff["n_old"], -1, dtype=np.int64)
+    remap[old_pos] = new_pos
+    kept_rows = remap[old_result.index.to_numpy(dtype=np.int64)]
+    kept = old_result[kept_rows >= 0]
+    kept.index = kept_rows[kept_rows >= 0]
+
+    redo = np.sort(np.concatenate([diff["changed"][1], diff["added"]]))
+    part = _compute_rows(new_df, redo, mapping, platform_fee_pct, personal_commission_pct, conv,
+                         currency, platform_label)
+    out = pd.concat([kept, part]) if not part.empty else kept
+    return out.iloc[np.argsort(out.index.to_numpy(), kind="stable")]
+
+@perf_stage("change_report")
+def change_report(old_df, new_df, mapping, diff, platform_fee_pct, personal_commission_pct, conv,
+                  currency="MYR"):
+    """
+    “与上次上传相比”：只对新增 / 改动 / 删除的行计算，每个价格一行，列出新旧成本、卖价、利润与利润变化
+    同一行的多个价格按出现顺序一一对应
+    """
+    cols = result_columns(currency)
+    status = {}
+    for k in diff["old_keys"][diff["removed"]]:
+        status[k] = "删除"
+    for k in diff["new_keys"][diff["changed"][1]]:
+        status[k] = "修改"
+    for k in diff["new_keys"][diff["added"]]:
+        status[k] = "新增"
+
+    def side(df, rows, keys, tag):
+        part = _compute_rows(df, rows, mapping, platform_fee_pct, personal_commission_pct, conv,
+                             currency, "")
+        idx = part.index.to_numpy(dtype=np.int64)
+        # 没有行要算时 compute_profit 返回的空表是 object 列：金额统一转 float，后面的 np.isclose 才能比较
+        return pd.DataFrame({
+            "_key": keys[idx],
+            "_k": pd.Series(idx).groupby(idx).cumcount().to_numpy(),
+            f"产品名称{tag}": part[cols[0]].to_numpy(dtype=object),
+            f"成本 {tag}": part[cols[1]].to_numpy(dtype=float),
+            f"卖价 {tag}": part[cols[2]].to_numpy(dtype=float),
+            f"利润 (MYR) {tag}": part[cols[4]].to_numpy(dtype=float),
+        })
+
+    old_rows = np.sort(np.concatenate([diff["changed"][0], diff["removed"]]))
+    new_rows = np.sort(np.concatenate([diff["changed"][1], diff["added"]]))
+    m = side(old_df, old_rows, diff["old_keys"], "旧").merge(
+        side(new_df, new_rows, diff["new_keys"], "新"), on=["_key", "_k"], how="outer", sort=False)
+    m = m[~np.isclose(m["利润 (MYR) 旧"], m["利润 (MYR) 新"], equal_nan=True)
+          | (m["卖价 旧"].isna() != m["卖价 新"].isna())]
+    out = pd.DataFrame({
+        "产品名称": m["产品名称新"].fillna(m["产品名称旧"]).astype(str),
+        "变化": m["_key"].map(status).fillna("修改"),
+        f"成本 旧 ({currency})": m["成本 旧"],
+        f"成本 新 ({currency})": m["成本 新"],
+        f"卖价 旧 ({currency})": m["卖价 旧"],
+        f"卖价 新 ({currency})": m["卖价 新"],
+        "利润 旧 (MYR)": m["利润 (MYR) 旧"],
+        "利润 新 (MYR)": m["利润 (MYR) 新"],
+        "利润变化 (MYR)": m["利润 (MYR) 新"].fillna(0.0) - m["利润 (MYR) 旧"].fillna(0.0),
+    })
+    return out.sort_values("利润变化 (MYR)", key=np.abs, ascending=False, kind="stable").reset_index(drop=True)
+
+# ============== 跨国家商品对比（名称归一化 + 匹配索引） ==============
+CATALOG_MATCH_MIN_SCORE = 0.6
+CATALOG_MAX_BLOCK = 200  # 出现在超过这么多商品里的词（如 “set”“ml”）不参与候选生成
+
+# 分隔符 = 字母 / 数字 / 组合符号以外的字符；泰文、印地文等的元音符号是组合符号（Mn），不能当分隔符
+# Arrow 字符串走 RE2（\W 只认 ASCII，要用 \p{..}）；object 字符串走 Python re（不支持 \p，组合符号按文字区块列出）
+_NAME_SEP_RE2 = r"[^\p{L}\p{N}\p{M}]+"
+_NAME_SEP_PY = re.compile(r"(?:[^\w\u0300-\u036f\u0900-\u0dff\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff]|_)+")
+
+def normalize_names(names):
+    """商品名归一化（向量化）：全角 / 兼容字符统一（NFKC）、小写、标点与空白压成单个空格；中文 / 泰文等原样保留"""
+    s = pd.Series(names, dtype=object).astype(str)
+    wide = ~s.str.isascii()  # NFKC 逐个字符串处理，只对含非 ASCII 字符的名称做
+    if wide.any():
+        s = s.where(~wide, s[wide].str.normalize("NFKC"))
+    sep = _NAME_SEP_RE2 if getattr(s.dtype, "storage", None) == "pyarrow" else _NAME_SEP_PY
+    return s.str.lower().str.replace(sep, " ", regex=True).str.strip()
+
+def normalize_name(name):
+    """单个名称归一化（与 normalize_names 结果相同），用于每次输入的查询词，不走向量化的开销"""
+    s = str(name)
+    if not s.isascii():
+        s = unicodedata.normalize("NFKC", s)
+    return _NAME_SEP_PY.sub(" ", s.lower()).strip()
+
+def name_keys(normalized):
+    """归一化后的名称 → uint64 连接键"""
+    return pd.util.hash_array(np.asarray(normalized, dtype=object))
+
+def _name_tokens(normalized):
+    """(名称位置, 词) 长表，同一名称内去重"""
+    t = pd.Series(np.asarray(normalized, dtype=object)).str.split().explode().dropna()
+    return pd.DataFrame({"id": t.index.to_numpy(dtype=np.int64), "token": t.to_numpy(dtype=object)}).drop_duplicates()
+
+class ProductMatchIndex:
+    """
+    模糊匹配索引（按词分块）：只比较至少有一个共同词的名称对，相似度 = 词集合的 Jaccard
+    出现在超过 max_block 个名称里的常见词不用来生成候选，避免退化成两两比较
+    names: 已归一化的参考名称
+    """
+
+    def __init__(self, names, max_block=CATALOG_MAX_BLOCK):
+        tokens = _name_tokens(names)
+        self.n_tokens = np.bincount(tokens["id"].to_numpy(), minlength=len(names))
+        freq = tokens["token"].value_counts()
+        self.postings = tokens[tokens["token"].isin(freq.index[freq.to_numpy() <= max_block])]
+
+    def match(self, queries, min_score=CATALOG_MATCH_MIN_SCORE):
+        """queries: 已归一化的名称 → DataFrame[query, ref, score]，每个 query 最多一个（得分最高的）参考名称"""
+        q = _name_tokens(queries)
+        n_q = np.bincount(q["id"].to_numpy(), minlength=len(queries))
+        pairs = q.merge(self.postings, on="token", suffixes=("_q", "_r"))
+        if pairs.empty:
+            return pd.DataFrame({"query": pd.Series(dtype=np.int64), "ref": pd.Series(dtype=np.int64),
+                                 "score": pd.Series(dtype=float)})
+        shared = pairs.groupby(["id_q", "id_r"], sort=False).size()
+        iq = shared.index.get_level_values(0).to_numpy()
+        ir = shared.index.get_level_values(1).to_numpy()
+        score = shared.to_numpy() / (n_q[iq] + self.n_tokens[ir] - shared.to_numpy())
+        best = pd.DataFrame({"query": iq, "ref": ir, "score": score})
+        best = best[best["score"] >= min_score].sort_values(["query", "score"], ascending=[True, False], kind="stable")
+        return best.drop_duplicates("query").reset_index(drop=True)
+
+@perf_stage("consolidate_catalog")
+def consolidate_catalog(results, agg="max", fuzzy=False, min_score=CATALOG_MATCH_MIN_SCORE):
+    """
+    各国家结果合并成 商品 × 国家 的利润宽表
+    results: {国家: 含“产品名称”“利润 (MYR)”列的结果}（按国家顺序；同名商品名称取第一个出现的写法）
+    agg: 同一国家同一商品多行（多个卖价 / 多个方案）时的汇总方式（"max" / "min" / "mean"）
+    fuzzy: 归一化后仍对不上的名称，再用 ProductMatchIndex 和其它国家已有、本国没有的商品匹配
+    返回 (宽表, 模糊匹配明细)；宽表列：产品名称, 利润 (MYR) | <国家>..., 覆盖国家数, 利润最高国家
+    """
+    parts, matches, countries = [], [], []
+    catalog_keys = np.empty(0, dtype=np.uint64)
+    catalog_norm = np.empty(0, dtype=object)
+    for country, res in results.items():
+        if res is None or res.empty:
+            continue
+        per_name = res.groupby(res["产品名称"].astype(str), sort=False)["利润 (MYR)"].agg(agg)
+        norm = normalize_names(per_name.index).to_numpy(dtype=object)
+        keys = name_keys(norm)
+        if fuzzy and len(catalog_keys):
+            seen = np.isin(keys, catalog_keys)
+            free = ~np.isin(catalog_keys, keys)
+            if (~seen).any() and free.any():
+                ref_keys, ref_norm = catalog_keys[free], catalog_norm[free]
+                query = np.flatnonzero(~seen)
+                found = ProductMatchIndex(ref_norm).match(norm[query], min_score)
+                if not found.empty:
+                    qpos = query[found["query"].to_numpy()]
+                    rpos = found["ref"].to_numpy()
+                    matches.append(pd.DataFrame({"国家": country, "产品名称": per_name.index[qpos],
+                                                 "匹配到": ref_norm[rpos], "相似度": found["score"].to_numpy()}))
+                    keys = keys.copy()
+                    keys[qpos] = ref_keys[rpos]
+        new = ~np.isin(keys, catalog_keys)
+        catalog_keys = np.concatenate([catalog_keys, keys[new]])
+        catalog_norm = np.concatenate([catalog_norm, norm[new]])
+        countries.append(country)
+        parts.append(pd.DataFrame({"key": keys, "国家": country, "产品名称": per_name.index.to_numpy(dtype=object),
+                                   "利润 (MYR)": per_name.to_numpy(dtype=float)}))
+
+    match_cols = ["国家", "产品名称", "匹配到", "相似度"]
+    matches = pd.concat(matches, ignore_index=True) if matches else pd.DataFrame(columns=match_cols)
+    if not parts:
+        return pd.DataFrame(columns=["产品名称", "覆盖国家数", "利润最高国家"]), matches
+    long = pd.concat(parts, ignore_index=True)
+    wide = long.groupby(["key", "国家"], sort=False)["利润 (MYR)"].agg(agg).unstack("国家").reindex(columns=countries)
+    names = long.drop_duplicates("key").set_index("key")["产品名称"]
+    profit = wide.to_numpy(dtype=float)
+    covered = np.isfinite(profit)
+    best = np.where(covered.any(axis=1), np.nanargmax(np.where(covered, profit, -np.inf), axis=1), -1)
+    out = pd.DataFrame({"产品名称": names.reindex(wide.index).to_numpy()})
+    for i, c in enumerate(countries):
+        out[f"利润 (MYR) | {c}"] = profit[:, i]
+    out["覆盖国家数"] = covered.sum(axis=1)
+    out["利润最高国家"] = np.where(best >= 0, np.asarray(countries, dtype=object)[np.maximum(best, 0)], None)
+    out = out.sort_values(["覆盖国家数", "产品名称"], ascending=[False, True], kind="stable").reset_index(drop=True)
+    return out, matches
+
+# ============== 产品搜索（前缀索引 + 字符三元组倒排） ==============
+SEARCH_MAX_RESULTS = 200
+_GRAM_BITS = 21  # 一个 Unicode 码位最多 21 位，三个字符拼成一个 63 位的键
+
+def _gram_code(chars):
+    """1–3 个字符 → 三元组键（不足 3 个的低位补 0，即该前缀对应的键区间的起点）"""
+    code = 0
+    for i in range(3):
+        code = (code << _GRAM_BITS) | (ord(chars[i]) if i < len(chars) else 0)
+    return code
+
+class ProductSearchIndex:
+    """
+    产品名搜索索引，每组结果建一次（页面上按结果 key 缓存），之后每次输入只查索引：
+    - 前缀索引：排好序的归一化名称，二分查找
+    - 三元组倒排：按字符（不是按词）切三元组，中文 / 泰文这类不用空格分词的名称也能搜任意子串；
+      每个名称前加一个空格，“词首匹配”就是查 " 词"；末尾补两个占位符，1–2 个字符的查询是一段连续的键区间
+    search() 返回排好序、最多 limit 个产品名：完全相同 > 名称前缀 > 每个词都在词首 > 每个词都包含，
+    同一档按名称长度、名称排序
+    """
+
+    def __init__(self, names):
+        names = pd.Series(pd.unique(pd.Series(names).dropna().astype(object)), dtype=object)
+        norm = normalize_names(names).to_numpy(dtype=object)
+        n = len(norm)
+        self.names = names.to_numpy(dtype=object)
+        self._text = np.array([" " + x for x in norm], dtype=object)
+        self._length = np.fromiter((len(x) for x in norm), dtype=np.int64, count=n)
+        self._order = np.argsort(norm, kind="stable")
+        self._sorted = norm[self._order]
+        self._alpha = np.empty(n, dtype=np.int64)
+        self._alpha[self._order] = np.arange(n)
+
+        # 倒排：所有 (三元组, 名称) 对按三元组排序去重，postings 是按名称编号升序的连续切片
+        text = "".join(x + "\x01\x01\x00" for x in self._text)
+        cps = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        owner = np.repeat(np.arange(n, dtype=np.int32), [len(x) + 3 for x in self._text])
+        c0, c1, c2 = cps[:-2], cps[1:-1], cps[2:]
+        valid = (c0 > 1) & (c1 != 0) & (c2 != 0)
+        codes = ((c0 << 42) | (c1 << 21) | c2)[valid]
+        owner = owner[:-2][valid]
+        order = np.lexsort((owner, codes))
+        codes, owner = codes[order], owner[order]
+        keep = np.ones(len(codes), dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (owner[1:] != owner[:-1])
+        codes, self._postings = codes[keep], owner[keep]
+        first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.empty(0, dtype=np.int64)
+        self._keys = codes[first]
+        self._starts = np.append(first, len(codes))
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def nbytes(self):
+        arrays = (self._length, self._order, self._alpha, self._postings, self._keys, self._starts)
+        strings = sum(len(x) * 4 for x in self._text) * 3  # 原名 / 归一化 / 带空格，粗略按 UCS-4 计
+        return int(sum(a.nbytes for a in arrays) + strings)
+
+    def _range(self, lo, hi):
+        # 键要保持 uint64 比较（和 int64 混用会转成 float64，非 ASCII 字符的键会丢精度）
+        i, j = np.searchsorted(self._keys, np.array([lo, hi], dtype=np.uint64))
+        return self._postings[self._starts[i]:self._starts[j]]
+
+    def _containing(self, term):
+        """包含 term 的名称（布尔掩码）；term 超过 3 个字符时是候选（每个三元组都出现，还要逐个确认）"""
+        n = len(self.names)
+        if len(term) < 3:
+            lo = _gram_code(term)
+            mask = np.zeros(n, dtype=bool)
+            mask[self._range(lo, lo + (1 << (_GRAM_BITS * (3 - len(term)))))] = True
+            return mask
+        codes = {_gram_code(term[k:k + 3]) for k in range(len(term) - 2)}
+        postings = [self._range(code, code + 1) for code in codes]
+        if not all(len(p) for p in postings):
+            return np.zeros(n, dtype=bool)
+        # 每个三元组的 posting 内名称不重复，出现次数 = 三元组个数 即全部包含
+        return np.bincount(np.concatenate(postings), minlength=n) == len(codes)
+
+    def _all_terms(self, terms):
+        mask = self._containing(terms[0])
+        for term in terms[1:]:
+            mask &= self._containing(term)
+        return mask
+
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        """
+        按 query 查找，返回产品名列表（最多 limit 个）；query 归一化后为空时返回 None（表示不筛选）
+        """
+        qn = normalize_name(query)
+        if not qn:
+            return None
+        terms = qn.split()
+        contains = self._all_terms(terms)
+        ids = np.flatnonzero(contains)
+        if not len(ids):
+            return []
+        tier = np.where(self._all_terms([" " + t for t in terms])[ids], 2, 3).astype(np.int64)
+        lo, hi = np.searchsorted(self._sorted, [qn, qn + "\U0010ffff"])
+        prefix = np.zeros(len(self.names), dtype=bool)
+        prefix[self._order[lo:hi]] = True
+        is_prefix = prefix[ids]
+        tier[is_prefix] = np.where(self._length[ids[is_prefix]] == len(qn), 0, 1)
+        n = len(self.names)
+        rank = tier * (1 << 40) + self._length[ids] * (n + 1) + self._alpha[ids]
+        # 只排最靠前的一段；要逐个确认时多取一些，不够再全排
+        check_contains = any(len(t) > 3 for t in terms)
+        check_word = any(len(t) > 2 for t in terms)
+        take = limit * 4 if check_contains or check_word else limit
+        if len(ids) > take:
+            top = np.argpartition(rank, take)[:take]
+            ordered = ids[top[np.argsort(rank[top], kind="stable")]]
+            ranks = np.sort(rank[top])
+        else:
+            order = np.argsort(rank, kind="stable")
+            ordered, ranks = ids[order], rank[order]
+        out = self._confirm(ordered, ranks >> 40, terms, limit, check_contains, check_word)
+        if len(out) < limit and len(ids) > take:
+            order = np.argsort(rank, kind="stable")
+            out = self._confirm(ids[order], rank[order] >> 40, terms, limit, check_contains, check_word)
+        return out
+
+    def matching(self, query):
+        """
+        全部匹配的产品名（不排序、不限个数，用于按搜索词筛选结果）；query 归一化后为空时返回 None
+        """
+        qn = normalize_name(query)
+        if not qn:
+            return None
+        terms = qn.split()
+        ids = np.flatnonzero(self._all_terms(terms))
+        if any(len(t) > 3 for t in terms) and len(ids):
+            text = pd.Series(self._text[ids], dtype=object)
+            ok = np.ones(len(ids), dtype=bool)
+            for t in terms:
+                ok &= text.str.contains(t, regex=False).to_numpy(dtype=bool)
+            ids = ids[ok]
+        return self.names[ids]
+
+    def _confirm(self, ids, tiers, terms, limit, check_contains, check_word):
+        """三元组只保证字符都出现过：超过 3 个字符的词按排好的顺序逐个确认，够 limit 个就停"""
+        out, demoted = [], []
+        for i, tier in zip(ids, tiers):
+            if tier >= 2 and (check_contains or check_word):
+                text = self._text[i]
+                if check_contains and not all(t in text for t in terms):
+                    continue
+                if tier == 2 and check_word and not all(" " + t in text for t in terms):
+                    demoted.append(self.names[i])  # 实际只是包含，不在词首（少见），排到最后
+                    continue
+            out.append(self.names[i])
+            if len(out) >= limit:
+                break
+        return out + demoted[:limit - len(out)]
+
+# ============== 价格敏感度扫描 / 保本价 ==============
+class SweepResult:
+    """
+    sweep_profit 的结果（按数组存放，不展开成 商品 × 方案 × 汇率 的行）：
+    - items：每个价格一行（产品名称 / 来源 / 成本 / 卖价，本币），与 compute_profit 展开方式一致
+    - profit_myr[i, f, r]：第 i 个价格在第 f 个费率方案、第 r 个汇率冲击下的利润 (MYR)
+    - margin_pct[i, f]、break_even[i, f]：利润率 % 与保本卖价（本币，与汇率无关）
+    个人抽成与利润成正比，不单独存：commission_myr(k) 按需算
+    """
+
+    def __init__(self, items, fee_labels, fee_pcts, rate_shocks, convs, commissions,
+                 profit_myr, margin_pct, break_even):
+        self.items = items
+        self.fee_labels = list(fee_labels)
+        self.fee_pcts = fee_pcts
+        self.rate_shocks = rate_shocks
+        self.convs = convs
+        self.commissions = commissions
+        self.profit_myr = profit_myr
+        self.margin_pct = margin_pct
+        self.break_even = break_even
+
+    @property
+    def shape(self):
+        return self.profit_myr.shape
+
+    def commission_myr(self, k=0):
+        """第 k 档个人抽成 (MYR)，形状同 profit_myr"""
+        return self.profit_myr * (self.commissions[k] / 100.0)
+
+    def summary(self):
+        """每个 (方案, 汇率冲击) 一行：总利润、平均利润率、亏损价格数"""
+        n_f, n_r = self.profit_myr.shape[1:]
+        with np.errstate(invalid="ignore"):
+            total = np.nansum(self.profit_myr, axis=0, dtype=float)
+            losses = (self.profit_myr < 0).sum(axis=0)
+            margin = np.nanmean(self.margin_pct, axis=0) if len(self.items) else np.full(n_f, np.nan)
+        return pd.DataFrame({
+            "平台方案": np.repeat(self.fee_labels, n_r),
+            "费率 %": np.repeat(self.fee_pcts, n_r),
+            "汇率冲击 %": np.tile(self.rate_shocks * 100.0, n_f),
+            "汇率除数": np.tile(self.convs, n_f),
+            "总利润 (MYR)": total.ravel(),
+            "平均利润率 %": np.repeat(margin, n_r),
+            "亏损价格数": losses.ravel(),
+        })
+
+    def break_even_table(self):
+        """每个价格一行，各方案的保本卖价一列（宽表）"""
+        be = pd.DataFrame(self.break_even, columns=[f"保本价 | {label}" for label in self.fee_labels])
+        return pd.concat([self.items.reset_index(drop=True), be], axis=1)
+
+def break_even_price(cost, fee_pct):
+    """保本卖价：price - cost - price × fee% = 0 → cost / (1 - fee%)；费率 >= 100% 时无解（NaN）"""
+    keep = 1.0 - np.asarray(fee_pct, dtype=float) / 100.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(keep > 0, np.asarray(cost, dtype=float) / keep, np.nan)
+
+@perf_stage("sweep_profit")
+def sweep_profit(df, mapping, fee_grid, conv, rate_shocks=(0.0,), commissions=(0.0,), currency="MYR",
+                 dtype=np.float32):
+    """
+    价格敏感度扫描：价格只解析一次，成本 × 卖价 × 费率网格 × 汇率网格整体广播计算
+    fee_grid: [(方案名, 平台费率 %), ...]（如某国家的全部费率方案）
+    rate_shocks: 汇率冲击（小数，0.1 = 汇率除数上调 10%）；commissions: 个人抽成 % 档位
+    dtype: profit_myr 立方体的精度（默认 float32，10 万价格 × 50 方案 × 5 档汇率约 100 MB）
+    返回 SweepResult
+    """
+    base = compute_profit(df, mapping, 0.0, 0.0, 1.0, currency=currency)
+    cols = result_columns(currency)
+    cost = base[cols[1]].to_numpy(dtype=float)
+    price = base[cols[2]].to_numpy(dtype=float)
+    labels = [label for label, _ in fee_grid]
+    fee = np.array([float(pct) for _, pct in fee_grid], dtype=float)
+    shocks = np.asarray(rate_shocks, dtype=float)
+    convs = float(conv) * (1.0 + shocks)
+    convs = np.where(convs > 0, convs, 1.0)
+
+    profit_local = price[:, None] * (1.0 - fee[None, :] / 100.0) - cost[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        margin_pct = np.where(price[:, None] > 0, profit_local / price[:, None] * 100.0, np.nan)
+    profit_myr = np.empty((len(price), len(fee), len(convs)), dtype=dtype)
+    np.divide(profit_local[:, :, None], convs[None, None, :], out=profit_myr, casting="same_kind")
+
+    items = base[[cols[0], cols[7], cols[1], cols[2]]]
+    return SweepResult(items, labels, fee, shocks, convs, np.asarray(commissions, dtype=float),
+                       profit_myr, margin_pct, break_even_price(cost[:, None], fee[None, :]))
+
+# ============== 计算结果记忆（会话内） ==============
+RESULT_MEMO_MAX_MB = 256
+RESULT_MEMO_MAX_ENTRIES = 16
+
+def result_key(path, header_idx, merge_multirow, mapping, platform_fee_pct, personal_commission_pct, conv,
+               currency="MYR", platform_label="自定义", sheets=None):
+    """结果记忆的 key：文件内容哈希 + 表头设置 + 工作表 + 字段映射 + 费率 / 抽成 / 汇率（只含影响计算结果的输入）"""
+    key = (
+        file_content_hash(path), int(header_idx), bool(merge_multirow),
+        tuple((k, tuple(v) if isinstance(v, (list, tuple)) else v) for k, v in sorted(mapping.items())),
+        _key_number(platform_fee_pct), float(personal_commission_pct), _key_number(conv), currency, platform_label,
+    )
+    return key + (tuple(sheets),) if sheets else key
+
+def _key_number(v):
+    """标量 → float；逐行数组 → 内容摘要"""
+    if np.ndim(v):
+        return hashlib.sha1(np.ascontiguousarray(v, dtype=float).tobytes()).hexdigest()
+    return float(v)
+
+class ResultMemo:
+    """
+    计算结果的 LRU 记忆（放在 st.session_state 里，每个会话一份）：
+    - 只改显示的控件（搜索 / 产品筛选 / 分页 / 图表）重跑脚本时直接取缓存，不重新计算
+    - 总内存超过 max_mb 或条数超过 max_entries 时淘汰最久未用的结果
+    - 当前页面在用的结果（get_or_compute(..., pin=True)）不会被淘汰：之后存入的搜索索引 / 排名等
+      派生对象再大，也只会挤掉别的条目，不会把它挤掉后下次重跑重新计算
+    缓存的 DataFrame 由调用方只读使用；也可以缓存带 nbytes 属性的对象（如 ProductSearchIndex）
+    """
+
+    def __init__(self, max_mb=RESULT_MEMO_MAX_MB, max_entries=RESULT_MEMO_MAX_ENTRIES):
+        self.max_mb = max_mb
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pinned = None
+        self._entries = {}  # key -> (DataFrame, 字节数)；dict 保持插入顺序，末尾为最近使用
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_compute(self, key, compute, pin=False):
+        """命中返回缓存结果；未命中调用 compute() 计算、存入并按上限淘汰；pin=True 时这一条替换原来 pin 的那条"""
+        if pin:
+            self.pinned = key
+        hit = self._entries.pop(key, None)
+        if hit is not None:
+            self._entries[key] = hit
+            self.hits += 1
+            return hit[0]
+        self.misses += 1
+        df = compute()
+        size = df.memory_usage(index=True, deep=True).sum() if hasattr(df, "memory_usage") else df.nbytes
+        self._entries[key] = (df, int(size))
+        self.evict()
+        return df
+
+    def peek(self, key):
+        """只查不算：有缓存返回结果，否则 None（不计入命中统计、不改变 LRU 顺序）"""
+        hit = self._entries.get(key)
+        return None if hit is None else hit[0]
+
+    def evict(self):
+        """按上限从最久未用的开始淘汰（最近一条和 pin 的那条即使超过上限也保留，保证本次结果可用）"""
+        max_bytes = self.max_mb * 1024 * 1024
+        while len(self._entries) > self.max_entries or self.nbytes > max_bytes:
+            newest = next(reversed(self._entries))
+            victim = next((k for k in self._entries if k != newest and k != self.pinned), None)
+            if victim is None:
+                break
+            del self._entries[victim]
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.pinned = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "memory_mb": self.nbytes / 2**20,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+            "evictions": self.evictions,
+        }
+
+# ============== 结果样式 ==============
+def _unique_index(df):
+    return df if df.index.is_unique else df.reset_index(drop=True)
+
+@perf_stage("style_results")
+def style_results(df_results):
+    """
+    负利润整行标红，促销行标绿（红色优先）；金额 / 百分比按“整数不带小数，其余 2 位”格式化
+    compute_profit 的结果 index 是源表行位置（一行多个价格时重复），Styler 要求 index 唯一，重复时改为行号
+    """
+    df_results = _unique_index(df_results)
+    # apply row-wise style: negative profit -> red; promotion -> green (but red dominates)
+    def row_style(row):
+        if pd.isna(row["利润 (MYR)"]):
+            return [""] * len(row)
+        if row["利润 (MYR)"] < 0:
+            return ["background-color:#ffd6d6"] * len(row)  # light red
+        if row.get("来源", "") == "Promotion":
+            return ["background-color:#e6ffe6"] * len(row)  # light green
+        return [""] * len(row)
+
+    sty = df_results.style.apply(lambda r: row_style(r), axis=1)
+
+    # ✅ 动态格式化函数：整数不加小数点，小数保留 2 位
+    def smart_format(x, prefix="", suffix=""):
+        try:
+            if pd.isna(x):
+                return "-"
+            if float(x).is_integer():
+                return f"{prefix}{int(x)}{suffix}"
+            else:
+                return f"{prefix}{x:,.2f}{suffix}"
+        except Exception:
+            return x
+
+    # 构建格式化规则
+    format_dict = {}
+    for col in df_results.columns:
+        if "利润 (MYR)" in col:
+            format_dict[col] = lambda x, p="RM ": smart_format(x, prefix=p)
+        elif "抽成" in col or "成本" in col or "卖价" in col:
+            format_dict[col] = lambda x: smart_format(x)
+        elif "%" in col:  # 利润率百分比
+            format_dict[col] = lambda x: smart_format(x, suffix="%")
+
+    sty = sty.format(format_dict, na_rep="-")
+    return sty
+
+# ============== 结果分页渲染（只样式化当前页） ==============
+RESULT_PAGE_SIZES = [50, 100, 200, 500]
+_NEGATIVE_CSS = "background-color:#ffd6d6"
+_PROMOTION_CSS = "background-color:#e6ffe6"
+
+def result_row_css(df_results):
+    """逐行底色（与 style_results 规则一致，整列一次算出）：负利润红，促销绿，利润为空不上色"""
+    profit = pd.to_numeric(df_results["利润 (MYR)"], errors="coerce").to_numpy(dtype=float)
+    valid = ~np.isnan(profit)
+    if "来源" in df_results.columns:
+        promo = (df_results["来源"] == "Promotion").to_numpy()
+    else:
+        promo = np.zeros(len(df_results), dtype=bool)
+    return np.select([valid & (profit < 0), valid & promo], [_NEGATIVE_CSS, _PROMOTION_CSS], "")
+
+def format_amounts(values, prefix="", suffix=""):
+    """smart_format 的整列版本：空值 → "-"，整数不带小数，其余千分位 + 2 位小数"""
+    v = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=float)
+    out = np.full(len(v), "-", dtype=object)
+    finite = np.isfinite(v)
+    is_int = finite & (np.mod(v, 1, where=finite, out=np.ones_like(v)) == 0)
+    is_frac = ~np.isnan(v) & ~is_int
+    # |v| >= 2^63 的整数放不进 int64（astype 会溢出成 -9223372036854775808），交给 Python int
+    small = is_int & (np.abs(v) < 2.0 ** 63)
+    big = is_int & ~small
+    out[small] = v[small].astype(np.int64).astype(str)
+    out[big] = [str(int(x)) for x in v[big]]
+    out[is_frac] = pd.Series(v[is_frac]).map("{:,.2f}".format).to_numpy()
+    if prefix or suffix:
+        has = ~np.isnan(v)
+        out[has] = (prefix + pd.Series(out[has], dtype=object) + suffix).to_numpy()
+    return out
+
+def format_results(df_results):
+    """按 style_results 的列规则把金额 / 百分比列转成显示字符串（其余列原样）"""
+    out = df_results.copy()
+    for col in df_results.columns:
+        if "利润 (MYR)" in col:
+            out[col] = format_amounts(df_results[col], prefix="RM ")
+        elif "抽成" in col or "成本" in col or "卖价" in col:
+            out[col] = format_amounts(df_results[col])
+        elif "%" in col:
+            out[col] = format_amounts(df_results[col], suffix="%")
+    return out
+
+def sort_order(df_results, sort_by=None, ascending=False):
+    """排序后的行位置（稳定排序，空值排最后）；sort_by 为空时保持原顺序"""
+    if not sort_by or sort_by not in df_results.columns:
+        return np.arange(len(df_results))
+    key = df_results[sort_by].reset_index(drop=True)
+    return key.sort_values(ascending=ascending, kind="stable", na_position="last").index.to_numpy()
+
+def result_page(df_results, page=1, page_size=RESULT_PAGE_SIZES[0], sort_by=None, ascending=False, order=None):
+    """
+    取第 page 页（从 1 开始）：返回 (当前页 DataFrame, 总页数)
+    order: 可选，预先算好的 sort_order 结果（翻页时复用，不必每页重新排序）
+    """
+    n_pages = max(1, -(-len(df_results) // page_size))
+    page = min(max(1, int(page)), n_pages)
+    if order is None:
+        order = sort_order(df_results, sort_by, ascending)
+    return df_results.iloc[order[(page - 1) * page_size:page * page_size]], n_pages
+
+@perf_stage("style_page")
+def style_results_page(page_df):
+    """
+    只样式化一页结果：底色与格式化都按列整体计算，不逐行 / 逐格调用 Python 函数
+    渲染开销与页大小成正比，与结果总行数无关；index 重复（未 reset 的 compute_profit 结果）时改为行号
+    """
+    page_df = _unique_index(page_df)
+    shown = format_results(page_df)
+    css = np.repeat(result_row_css(page_df)[:, None], len(page_df.columns), axis=1)
+    css_df = pd.DataFrame(css, index=shown.index, columns=shown.columns)
+    return shown.style.apply(lambda _: css_df, axis=None)
+
+# ============== 图表数据（服务端聚合，限制发给浏览器的图形数） ==============
+CHART_MAX_MARKS = 400
+CHART_HIST_BINS = 40
+
+@perf_stage("chart_ranking")
+def product_ranking(result_df, value="利润 (MYR)"):
+    """
+    每个产品一行，按利润合计从高到低排名（名次 = 行号，从 0 开始）
+    列：产品名称 / 利润合计 / 最高利润 / 最低利润 / 价格数
+    结果只和 result_df 有关，页面上按结果 key 缓存，拖动名次区间时不重算
+    """
+    g = result_df.groupby("产品名称", observed=True, sort=False)[value]
+    ranking = pd.DataFrame({
+        "利润合计 (MYR)": g.sum(),
+        "最高利润 (MYR)": g.max(),
+        "最低利润 (MYR)": g.min(),
+        "价格数": g.size(),
+    })
+    ranking = ranking.sort_values("利润合计 (MYR)", ascending=False, kind="stable").reset_index()
+    ranking["产品名称"] = ranking["产品名称"].astype(object)
+    return ranking
+
+def chart_window(n_products, n, view="top", start=0):
+    """名次区间 [start, stop)：view = "top" 前 n 名 / "bottom" 后 n 名 / "range" 从 start 开始的 n 名"""
+    n = max(0, min(int(n), n_products))
+    if view == "bottom":
+        start = n_products - n
+    elif view != "range":
+        start = 0
+    start = min(max(0, int(start)), max(0, n_products - n))
+    return start, start + n
+
+@perf_stage("chart_products")
+def chart_products(result_df, ranking, start, stop, by="来源", value="利润 (MYR)"):
+    """
+    名次区间内的产品 × by 的利润合计（长表，画堆叠柱状图用）
+    只取区间内产品的结果行，图形数 ≤ (stop - start) × by 的取值个数
+    """
+    names = ranking["产品名称"].iloc[start:stop]
+    rows = result_df[result_df["产品名称"].isin(names)]
+    out = rows.groupby(["产品名称", by], observed=True)[value].sum().reset_index()
+    out["名次"] = out["产品名称"].map(pd.Series(np.arange(start, stop) + 1, index=names.to_numpy())).astype(int)
+    out["产品名称"] = out["产品名称"].astype(object)
+    out[by] = out[by].astype(object)
+    return out.sort_values(["名次", by], kind="stable").reset_index(drop=True)
+
+def chart_max_products(result_df, by="来源", max_marks=CHART_MAX_MARKS):
+    """产品柱状图最多能放几个产品（每个产品占 by 的取值个数个图形）"""
+    return max(1, max_marks // max(1, result_df[by].nunique()))
+
+@perf_stage("chart_histogram")
+def profit_histogram(result_df, bins=CHART_HIST_BINS, by="来源", value="利润 (MYR)", value_range=None):
+    """
+    利润分布：等宽分箱后按 by 计数，列：区间下限 / 区间上限 / by / 数量
+    value_range=(lo, hi) 时只统计该区间内的结果（下钻）；图形数 ≤ bins × by 的取值个数
+    """
+    values = pd.to_numeric(result_df[value], errors="coerce").to_numpy(dtype=float)
+    keep = np.isfinite(values)
+    if value_range is not None:
+        keep &= (values >= value_range[0]) & (values <= value_range[1])
+    values = values[keep]
+    if values.size == 0:
+        return pd.DataFrame(columns=["区间下限", "区间上限", by, "数量"])
+    edges = np.histogram_bin_edges(values, bins=bins)
+    idx = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+    groups = result_df[by].to_numpy()[keep]
+    counts = pd.Series(1, index=pd.MultiIndex.from_arrays([idx, groups])).groupby(level=[0, 1]).size()
+    out = counts.rename("数量").reset_index()
+    out.columns = ["_bin", by, "数量"]
+    out.insert(0, "区间下限", edges[out["_bin"].to_numpy()])
+    out.insert(1, "区间上限", edges[out["_bin"].to_numpy() + 1])
+    return out.drop(columns="_bin")
+
+def fee_chart_data(fee_df, max_marks=CHART_MAX_MARKS):
+    """
+    费率图的数据：方案数不超过 max_marks 时原样返回明细（每个方案一根柱），
+    否则按 国家 × 平台 汇总为 最低 / 平均 / 最高 费率与方案数
+    返回 (DataFrame, "detail" 或 "summary")
+    """
+    cols = ["country", "platform", "scenario", "fee_pct"]
+    if len(fee_df) <= max_marks:
+        return fee_df[cols].reset_index(drop=True), "detail"
+    summary = (
+        fee_df.groupby(["country", "platform"], observed=True)
+        .agg(min_pct=("fee_pct", "min"), avg_pct=("fee_pct", "mean"), max_pct=("fee_pct", "max"),
+             count=("fee_pct", "count"))
+        .reset_index()
+    )
+    return summary, "summary"
+
+# ============== 字段映射猜测 ==============
+def guess_name_column(df):
+    """猜测产品名称列（DESCRIPTION / 产品名 / ชื่อสินค้า …）"""
+    patterns = [r"\b(desc(ription)?|product(\s*name)?|item(\s*name)?|name|title)\b",
+                r"(产品|商品|品名|名稱|名称|标题|描述)",
+                r"(ชื่อสินค้า|รายละเอียด)"]
+    cols = [str(c) for c in df.columns]
+    for pat in patterns:
+        for c in cols:
+            if re.search(pat, c, flags=re.IGNORECASE):
+                return c
+    # fallback: first string-like column
+    for c in cols:
+        s = df[c].dropna()
+        if not s.empty:
+            # if many unique values => likely name
+            if s.astype(str).nunique() / max(1, len(s)) > 0.2:
+                return c
+    return cols[0]
+
+def guess_column_mapping(df):
+    """默认字段映射（侧边栏默认值 / 批量计算共用）"""
+    cols = list(df.columns)
+    # guess price columns by name containing price or selling
+    guess_price_cols = [c for c in cols if re.search(r"price|sell|selling|PRICE", str(c), re.I)]
+    return {
+        "name": guess_name_column(df) if cols else None,
+        "cost": "COST" if "COST" in cols else None,
+        "promo_cost": "PROMOTION" if "PROMOTION" in cols else None,
+        "promo_price": None,
+        "price_cols": guess_price_cols[:2],
+        "sheet": SHEET_COLUMN if SHEET_COLUMN in cols else None,
+    }
+
+# ============== 结果分批写出 ==============
+class ResultWriter:
+    """
+    按扩展名分批写出结果表（每次 write 一个 DataFrame，列需一致）：
+    - .parquet：pyarrow ParquetWriter（可选依赖）
+    - .csv / .csv.gz：追加写
+    - .xlsx：xlsxwriter constant_memory，超过 Excel 行数上限自动续写到新工作表；
+      start_sheet() 切换到下一张表（如 Filtered_Results）
+    settings: 可选的计算设置 {名称: 值}：xlsx 写成最后一张 Settings 表，
+    parquet 存入文件元数据（profit_calc_settings），csv 另存为同名 .settings.json
+    """
+    XLSX_MAX_ROWS = 1_048_576
+    SETTINGS_SHEET = "Settings"
+    SETTINGS_METADATA_KEY = b"profit_calc_settings"
+
+    def __init__(self, path, sheet_name="All_Results", settings=None):
+        self.path = Path(path)
+        self.sheet_name = sheet_name
+        self.settings = settings
+        self.rows = 0
+        self._kind = self._detect_kind(self.path)
+        self._pq_writer = None
+        self._workbook = None
+        self._sheet = None
+        self._sheet_rows = 0
+        self._sheet_count = 0
+        self._columns = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self._kind == "csv" and self.path.exists():
+            self.path.unlink()
+
+    @staticmethod
+    def _detect_kind(path):
+        name = path.name.lower()
+        if name.endswith(".parquet"):
+            return "parquet"
+        if name.endswith(".xlsx"):
+            return "xlsx"
+        if name.endswith(".csv") or name.endswith(".csv.gz"):
+            return "csv"
+        raise ValueError(f"不支持的输出格式：{path.name}")
+
+    @property
+    def supports_sheets(self):
+        return self._kind == "xlsx"
+
+    def write(self, df):
+        if df is None or df.empty:
+            return
+        if self._columns is None:
+            self._columns = list(df.columns)
+        if self._kind == "parquet":
+            self._write_parquet(df)
+        elif self._kind == "xlsx":
+            self._write_xlsx(df)
+        else:
+            df.to_csv(self.path, mode="a", index=False, header=(self.rows == 0), encoding="utf-8-sig" if self.rows == 0 else "utf-8")
+        self.rows += len(df)
+
+    def start_sheet(self, sheet_name, columns=None):
+        """xlsx：之后的 write 写到新工作表 sheet_name；给出 columns 时立即写表头（没有数据也保留空表）"""
+        if not self.supports_sheets:
+            raise ValueError(f"{self.path.name} 不支持多工作表")
+        self.sheet_name = sheet_name
+        self._sheet = None
+        self._sheet_count = 0
+        self._columns = list(columns) if columns is not None else None
+        if self._columns is not None:
+            self._open_workbook()
+            self._new_sheet()
+
+    def _write_parquet(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._pq_writer is None:
+            schema = table.schema
+            if self.settings is not None:
+                metadata = dict(schema.metadata or {})
+                metadata[self.SETTINGS_METADATA_KEY] = _settings_json(self.settings).encode("utf-8")
+                schema = schema.with_metadata(metadata)
+            self._pq_writer = pq.ParquetWriter(self.path, schema)
+        self._pq_writer.write_table(table.cast(self._pq_writer.schema))
+
+    def _open_workbook(self):
+        if self._workbook is None:
+            import xlsxwriter
+            # 卖价可以是 inf（"inf" 单元格），写成 Excel 的 #DIV/0! 错误值，不然 xlsxwriter 直接报错
+            self._workbook = xlsxwriter.Workbook(str(self.path), {"constant_memory": True, "nan_inf_to_errors": True})
+
+    def _new_sheet(self):
+        self._sheet_count += 1
+        name = self.sheet_name if self._sheet_count == 1 else f"{self.sheet_name}_{self._sheet_count}"
+        self._sheet = self._workbook.add_worksheet(name[:31])
+        self._sheet.write_row(0, 0, self._columns)
+        self._sheet_rows = 1
+
+    def _write_xlsx(self, df):
+        self._open_workbook()
+        values = df.astype(object).where(df.notna(), None).to_numpy().tolist()
+        for row in values:
+            if self._sheet is None or self._sheet_rows >= self.XLSX_MAX_ROWS:
+                self._new_sheet()
+            self._sheet.write_row(self._sheet_rows, 0, row)
+            self._sheet_rows += 1
+
+    def _write_settings_sheet(self):
+        ws = self._workbook.add_worksheet(self.SETTINGS_SHEET)
+        ws.write_row(0, 0, ["设置", "值"])
+        for r, (k, v) in enumerate(self.settings.items(), start=1):
+            ws.write_row(r, 0, [str(k), _settings_value(v)])
+
+    def close(self):
+        if self._pq_writer is not None:
+            self._pq_writer.close()
+        if self._kind == "xlsx":
+            if self._workbook is None:
+                # 没有任何结果也生成一个只有空表的文件，方便下载
+                self._open_workbook()
+                self._workbook.add_worksheet(self.sheet_name[:31])
+            if self.settings is not None:
+                self._write_settings_sheet()
+            self._workbook.close()
+        elif self._kind == "csv" and self.settings is not None:
+            settings_path = self.path.with_name(self.path.name + ".settings.json")
+            settings_path.write_text(_settings_json(self.settings), encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def _settings_value(v):
+    """设置值转成单元格能写的标量：列表用逗号拼接，None → 空"""
+    if v is None:
+        return ""
+    if isinstance(v, (list, tuple)):
+        return ", ".join(str(x) for x in v)
+    if isinstance(v, (np.integer, np.floating)):
+        return v.item()
+    return v if isinstance(v, (int, float, str)) else str(v)
+
+def _settings_json(settings):
+    return json.dumps({str(k): _settings_value(v) for k, v in settings.items()}, ensure_ascii=False, indent=2)
+
+# ============== 结果导出（按需生成，按结果 key 缓存） ==============
+EXPORT_FORMATS = ["xlsx", "parquet", "csv.gz"]
+EXPORT_BATCH_ROWS = 50_000
+EXPORT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+@perf_stage("export")
+def export_results(path, result_df, filtered_df=None, settings=None, batch_rows=EXPORT_BATCH_ROWS):
+    """
+    结果分批写出到 path（格式见 ResultWriter），不在内存里拼整个文件：
+    - xlsx：All_Results + Filtered_Results（filtered_df 不为 None 时）+ Settings
+    - parquet / csv.gz：只写 All_Results，settings 存为元数据 / sidecar JSON
+    先写临时文件再改名，中途失败不会留下半个文件被当作缓存命中
+    """
+    path = Path(path)
+    tmp = temp_path(path, keep_suffix=True)
+    with ResultWriter(tmp, settings=settings) as writer:
+        for start in range(0, len(result_df), batch_rows):
+            writer.write(result_df.iloc[start:start + batch_rows])
+        if filtered_df is not None and writer.supports_sheets:
+            writer.start_sheet("Filtered_Results", columns=filtered_df.columns)
+            for start in range(0, len(filtered_df), batch_rows):
+                writer.write(filtered_df.iloc[start:start + batch_rows])
+    os.replace(tmp, path)
+    settings_tmp = tmp.with_name(tmp.name + ".settings.json")
+    if settings_tmp.exists():
+        os.replace(settings_tmp, path.with_name(path.name + ".settings.json"))
+    return path
+
+def export_cache_path(export_dir, key, fmt, stem="profit_results"):
+    """导出文件的缓存路径：同一组结果 key（+ 筛选等）和格式对应同一个文件，已生成则直接复用"""
+    digest = hashlib.sha1(repr((key, fmt)).encode("utf-8")).hexdigest()[:16]
+    return Path(export_dir) / f"{stem}_{digest}.{fmt}"
+
+def evict_exports(export_dir, max_bytes=EXPORT_CACHE_MAX_BYTES):
+    """导出目录合计超过 max_bytes 时，按 mtime 从旧到新删除"""
+    _evict_lru(Path(export_dir).glob("*"), max_bytes)
+
+# ============== 大 CSV 分块流式计算 ==============
+STREAM_MEMORY_MB = 256
+STREAM_PREVIEW_ROWS = 1000
+# 一个块在计算时的内存放大倍数（原始块 + 价格展开 + 结果表）
+_STREAM_MEMORY_FACTOR = 8
+
+def estimate_chunksize(path, header_idx, memory_mb=STREAM_MEMORY_MB, sample_rows=2000):
+    """按前 sample_rows 行的实际内存占用估算每块行数，使单块计算不超过 memory_mb"""
+    sample = _read_table(path, header=header_idx, nrows=sample_rows)
+    bytes_per_row = sample.memory_usage(index=False, deep=True).sum() / max(1, len(sample))
+    rows = int(memory_mb * 1024 * 1024 / max(1.0, bytes_per_row * _STREAM_MEMORY_FACTOR))
+    return max(100, rows)
+
+def iter_clean_chunks(path, header_idx, merge_multirow=False, chunksize=None, memory_mb=STREAM_MEMORY_MB):
+    """
+    分块读取 CSV：表头只识别一次，每块套用同一组 clean names
+    yield (chunk, 已读字节数, 文件总字节数)
+    """
+    try:
+        names = sniff_header(path, header_idx, merge_multirow)
+    except Exception:
+        names = None
+    if chunksize is None:
+        chunksize = estimate_chunksize(path, header_idx if names is not None else None, memory_mb)
+    total = os.path.getsize(path)
+    # 不带表头读取时列数要先定好（见 _read_table），否则第一行是标题行时第二行就报错
+    width = {} if names is not None else {"names": range(_csv_width(path))}
+    with open(path, "rb") as f:
+        reader = pd.read_csv(f, header=header_idx if names is not None else None, chunksize=chunksize, **width)
+        for chunk in reader:
+            chunk.columns = _dedupe_names(_fit_names(names or [], len(chunk.columns)))
+            yield chunk, min(f.tell(), total), total
+
+def compute_profit_streaming(path, header_idx, mapping, platform_fee_pct, personal_commission_pct, conv,
+                             out_path, currency="MYR", platform_label="自定义", merge_multirow=False,
+                             memory_mb=STREAM_MEMORY_MB, chunksize=None, progress=None):
+    """
+    大 CSV：逐块 compute_profit，结果直接写入 out_path（格式见 ResultWriter），内存占用与文件大小无关
+    注意：结果按文件原顺序输出（不做全表按利润排序）
+    progress: 可选回调 progress(已读字节数, 文件总字节数)
+    返回 {"rows_in", "rows_out", "path"}
+    """
+    rows_in = 0
+    with ResultWriter(out_path) as writer:
+        for chunk, done, total in iter_clean_chunks(path, header_idx, merge_multirow, chunksize, memory_mb):
+            rows_in += len(chunk)
+            writer.write(compute_profit(chunk, mapping, platform_fee_pct, personal_commission_pct, conv,
+                                        currency=currency, platform_label=platform_label))
+            if progress is not None:
+                progress(done, total)
+    return {"rows_in": rows_in, "rows_out": writer.rows, "path": Path(out_path)}
+
@@ -0,0 +1,72 @@
+# tests/test_profit_calc.py
+# -*- coding: utf-8 -*-
+"""profit-calc 命令行：费率 / 汇率按 --as-of 当天生效的值取"""
+
+import io
+import json
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import profit_calc
+
+FEES = """country,platform,scenario,fee_pct,remark,effective_from,effective_to
+Thailand,Shopee,基础佣金,10,,,
+Thailand,Shopee,基础佣金,20,三月大促,2025-03-01,2025-03-31
+Thailand,Lazada,基础佣金,5,,,
+"""
+RATE_HISTORY = """currency,rate,effective_from,effective_to
+THB,8,2025-03-01,2025-03-31
+"""
+PRICES = "DESCRIPTION,COST,SELLING PRICE\nA,10,110\nB,20,220\n"
+
+
+@pytest.fixture
+def cli_files(tmp_path):
+    paths = {name: tmp_path / name for name in ["fees.csv", "history.csv", "rates.json", "prices.csv"]}
+    paths["fees.csv"].write_text(FEES, encoding="utf-8")
+    paths["history.csv"].write_text(RATE_HISTORY, encoding="utf-8")
+    paths["rates.json"].write_text(json.dumps({"THB": 4.0}), encoding="utf-8")
+    paths["prices.csv"].write_text(PRICES, encoding="utf-8")
+    return {name: str(p) for name, p in paths.items()}
+
+
+def _run(capsys, files, *extra):
+    argv = [files["prices.csv"], "--country", "Thailand", "--platform", "Shopee", "--scenario", "基础佣金",
+            "--header-row", "1", "--fees", files["fees.csv"], "--rates", files["rates.json"],
+            "--rate-history", files["history.csv"], *extra]
+    assert profit_calc.main(argv) == 0
+    return pd.read_csv(io.StringIO(capsys.readouterr().out))
+
+
+@pytest.mark.parametrize("as_of,fee_pct,conv", [
+    ("2025-03-15", 20.0, 8.0),   # 临时费率 + 汇率历史
+    ("2025-03-31", 20.0, 8.0),   # effective_to 当天仍生效
+    ("2025-04-01", 10.0, 4.0),   # 结束后回到基础费率 / 当前汇率
+])
+def test_fee_and_rate_follow_as_of(capsys, cli_files, as_of, fee_pct, conv):
+    out = _run(capsys, cli_files, "--as-of", as_of)
+    assert out["平台抽成 (THB)"].tolist() == pytest.approx([110 * fee_pct / 100, 220 * fee_pct / 100])
+    assert out["利润 (MYR)"].tolist() == pytest.approx([(100 - 11 * fee_pct / 10) / conv,
+                                                        (200 - 22 * fee_pct / 10) / conv])
+
+
+def test_as_of_defaults_to_today(capsys, cli_files, monkeypatch):
+    class March(date):
+        @classmethod
+        def today(cls):
+            return cls(2025, 3, 10)
+
+    assert _run(capsys, cli_files)["平台抽成 (THB)"].tolist() == pytest.approx([11.0, 22.0])
+    monkeypatch.setattr(profit_calc, "date", March)
+    assert _run(capsys, cli_files)["平台抽成 (THB)"].tolist() == pytest.approx([22.0, 44.0])
+
+
+def test_no_fee_in_effect_is_an_error(capsys, cli_files, tmp_path):
+    fees = tmp_path / "march_only.csv"
+    fees.write_text(FEES.splitlines()[0] + "\n" + FEES.splitlines()[2] + "\n", encoding="utf-8")
+    with pytest.raises(SystemExit):
+        profit_calc.main([cli_files["prices.csv"], "--country", "Thailand", "--platform", "Shopee",
+                          "--fees", str(fees), "--as-of", "2025-04-01"])
+    assert "2025-04-01" in capsys.readouterr().err
@@ -0,0 +1,730 @@
+# tests/test_profit_core.py
+# -*- coding: utf-8 -*-
+"""
+profit_core 的测试：
+- 向量化 compute_profit 与原来逐行 iterrows 的循环（reference_profit）结果一致
+- 回归用例：标题行 CSV 的读取与分块读取、解析缓存、重新上传的对比与增量重算、生效日期取值、结果样式、
+  计算结果记忆、并发写入、费率配置版本库、批量上传后的共享缓存、商品名归一化、产品名搜索、多工作表读取、价格扫描与保本价
+"""
+
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synth import make_price_cells
+from profit_core import (
+    FeeConfigStore, FeeIndex, PARSE_CACHE_DIRNAME, ProductSearchIndex, ResultMemo, ResultWriter, SEARCH_MAX_RESULTS,
+    SHEET_COLUMN, SharedFrameCache, break_even_price, change_report, compute_profit, consolidate_catalog,
+    detect_header_row, diff_sheets, effective_conversion, effective_positions, estimate_chunksize, format_amounts,
+    invalidate_parse_cache, iter_clean_chunks, normalize_name, normalize_names, parse_price_series, process_pool,
+    profit_columns, read_and_clean_cached, read_and_clean_shared, read_workbook, result_columns, result_page,
+    sorted_results, split_price_cell, style_results, style_results_page, sweep_profit, try_read_and_clean,
+    update_profit,
+)
+from upload_pipeline import UploadJobs, upload_tasks
+
+
+# ============== compute_profit 与逐行循环等价 ==============
+def _cell(row, col):
+    """row.get(col)；重名列时取第一列（与 compute_profit 的 _get_col 一致）"""
+    v = row.get(col)
+    return v.iloc[0] if isinstance(v, pd.Series) else v
+
+
+def reference_profit(df, mapping, platform_fee_pct, personal_commission_pct, conv,
+                     currency="MYR", platform_label="自定义"):
+    """向量化之前 app.py 里的逐行实现（只把 records 的列名换成 result_columns）"""
+    name_col, cost_col = mapping.get("name"), mapping.get("cost")
+    promo_cost_col, promo_price_col = mapping.get("promo_cost"), mapping.get("promo_price")
+    price_cols = mapping.get("price_cols") or []
+    cols = result_columns(currency)
+    records = []
+    for _, row in df.iterrows():
+        product = str(_cell(row, name_col) if name_col else "").strip()
+        if promo_cost_col and promo_price_col and pd.notna(_cell(row, promo_cost_col)) and pd.notna(_cell(row, promo_price_col)):
+            base_cost = pd.to_numeric(_cell(row, promo_cost_col), errors="coerce")
+            base_cost = 0.0 if pd.isna(base_cost) else float(base_cost)
+            prices = split_price_cell(_cell(row, promo_price_col))
+            use_promo = True
+        else:
+            base_cost = pd.to_numeric(_cell(row, cost_col), errors="coerce") if cost_col else np.nan
+            base_cost = 0.0 if pd.isna(base_cost) else float(base_cost)
+            prices = []
+            for col in price_cols:
+                prices += split_price_cell(_cell(row, col))
+            use_promo = False
+        if not prices:
+            continue
+        for price in prices:
+            platform_fee_local = price * (platform_fee_pct / 100.0)
+            profit_local = price - base_cost - platform_fee_local
+            margin_pct = (profit_local / price * 100.0) if price > 0 else np.nan
+            personal_comm_local = profit_local * (personal_commission_pct / 100.0)
+            records.append({
+                cols[0]: product,
+                cols[1]: base_cost,
+                cols[2]: price,
+                cols[3]: platform_fee_local,
+                cols[4]: profit_local / conv,
+                cols[5]: margin_pct,
+                cols[6]: personal_comm_local / conv,
+                cols[7]: "Promotion" if use_promo else "Normal",
+                cols[8]: platform_label or "自定义",
+            })
+    return pd.DataFrame(records, columns=cols)
+
+
+def _sheet():
+    return pd.DataFrame({
+        "DESCRIPTION": ["A", " B ", np.nan, "D", "E", "F", "G", "H"],
+        "COST": [10, "12.5", 3, None, "x", 7, 8, 9],
+        "PROMOTION": [np.nan, 9, 2, np.nan, 1, 6, np.nan, 5],
+        "SELLING PRICE": ["20/25", "30", "15 | 16", "none", "40；41", "-", "10 - 12", "1e/1.2.3/50"],
+        "PRICE 2": [22, np.nan, "ask", 18, np.nan, 0, 11, np.nan],
+        "PROMO SELLING PRICE": [np.nan, "19,21", "12", 30, np.nan, "-5", np.nan, "8"],
+    })
+
+
+MAPPINGS = {
+    "normal": {"name": "DESCRIPTION", "cost": "COST", "promo_cost": None, "promo_price": None,
+               "price_cols": ["SELLING PRICE", "PRICE 2"]},
+    "promo": {"name": "DESCRIPTION", "cost": None, "promo_cost": "PROMOTION",
+              "promo_price": "PROMO SELLING PRICE", "price_cols": []},
+    "mixed": {"name": "DESCRIPTION", "cost": "COST", "promo_cost": "PROMOTION",
+              "promo_price": "PROMO SELLING PRICE", "price_cols": ["SELLING PRICE", "PRICE 2"]},
+    "price_col_order": {"name": "DESCRIPTION", "cost": "COST", "promo_cost": "PROMOTION",
+                        "promo_price": "PROMO SELLING PRICE", "price_cols": ["PRICE 2", "SELLING PRICE"]},
+}
+
+
+def _assert_same(df, mapping, fee=5.0, comm=10.0, conv=4.2):
+    got = compute_profit(df, mapping, fee, comm, conv, currency="THB", platform_label="Shopee")
+    want = reference_profit(df, mapping, fee, comm, conv, currency="THB", platform_label="Shopee")
+    pd.testing.assert_frame_equal(got.reset_index(drop=True), want, check_dtype=False)
+
+
+@pytest.mark.parametrize("kind", list(MAPPINGS))
+def test_compute_profit_matches_row_loop(kind):
+    _assert_same(_sheet(), MAPPINGS[kind])
+
+
+def test_compute_profit_duplicate_columns():
+    df = _sheet()
+    df.insert(3, "COST", [99] * len(df), allow_duplicates=True)
+    df.insert(5, "SELLING PRICE", ["1/2"] * len(df), allow_duplicates=True)
+    _assert_same(df, MAPPINGS["mixed"])
+
+
+def test_compute_profit_nan_names():
+    df = _sheet()
+    df["DESCRIPTION"] = [np.nan, None, "X", np.nan, 5, "", "  ", np.nan]
+    _assert_same(df, MAPPINGS["mixed"])
+    _assert_same(df, dict(MAPPINGS["normal"], name=None))
+
+
+def test_compute_profit_no_prices():
+    df = _sheet().assign(**{"SELLING PRICE": "ask", "PRICE 2": np.nan})
+    got = compute_profit(df, MAPPINGS["normal"], 5.0, 0.0, 1.0)
+    assert got.empty
+    assert list(got.columns) == result_columns("MYR")
+
+
+# ============== 批量价格解析与逐格 split_price_cell 一致 ==============
+ODD_CELLS = ["１５", "inf", "-inf", "Infinity", "1_000", "١٢٣", "+nan", "-NaN / 5", "nan", "none", "１５/inf|1_0",
+             "10 - 12", "-", "1e", "1.2.3", "ask 3", "٣٫٥", "  ", "", "20；30，40"]
+
+
+def _split_long(cells):
+    rows, prices = [], []
+    for i, v in zip(cells.index, cells):
+        for p in split_price_cell(v):
+            rows.append(i)
+            prices.append(p)
+    return pd.DataFrame({"row": np.asarray(rows, dtype=np.int64), "price": np.asarray(prices, dtype=float)})
+
+
+@pytest.mark.parametrize("cell", ODD_CELLS)
+def test_parse_price_series_odd_cells(cell):
+    cells = pd.Series(["10", cell, "7/8"])
+    pd.testing.assert_frame_equal(parse_price_series(cells), _split_long(cells))
+
+
+def test_parse_price_series_matches_split_price_cell():
+    cells = pd.concat([make_price_cells(5000, seed=3), pd.Series(ODD_CELLS)], ignore_index=True)
+    pd.testing.assert_frame_equal(parse_price_series(cells), _split_long(cells))
+
+
+def test_compute_profit_with_fallback_price_cells():
+    df = _sheet().assign(**{"SELLING PRICE": ["10", "１５", "inf", "1_000", "١٢٣", "+nan", "nan", "5"]})
+    _assert_same(df, MAPPINGS["normal"])
+
+
+@pytest.mark.parametrize("suffix", [".xlsx", ".csv", ".parquet"])
+def test_export_results_with_infinite_prices(tmp_path, suffix):
+    if suffix == ".parquet":
+        pytest.importorskip("pyarrow")
+    df = pd.DataFrame({"DESCRIPTION": ["A", "B", "C"], "COST": [1, 2, 3], "SELLING PRICE": ["inf", "-inf/5", "+nan"]})
+    mapping = {"name": "DESCRIPTION", "cost": "COST", "promo_cost": None, "promo_price": None,
+               "price_cols": ["SELLING PRICE"]}
+    result = compute_profit(df, mapping, 5.0, 0.0, 1.0)
+    assert np.isinf(result["卖价 (MYR)"]).sum() == 2
+    with ResultWriter(tmp_path / f"out{suffix}") as writer:
+        writer.write(result)
+    assert writer.rows == len(result) == 4
+
+
+# ============== 读取：第一行是只有一格的标题行的 CSV ==============
+TITLED_CSV = "Price list 2026\n名称,成本,售价,价2,促销价\nA,10,20/25,22,\nB,12.5,30,,19\nC,1,2,3,4\n"
+# 第一行是一格空白，表头识别不出 → 整张表不带表头读成 Column_*
+BLANK_TOP_CSV = ",\n名称,成本,售价,价2,促销价\nA,10,20/25,22,\n"
+
+
+def _write_csv(tmp_path, text):
+    path = tmp_path / "sheet.csv"
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_read_titled_csv(tmp_path):
+    path = _write_csv(tmp_path, TITLED_CSV)
+    assert detect_header_row(path) == 1
+    df = try_read_and_clean(path, 1)
+    assert df.columns.tolist() == ["名称", "成本", "售价", "价2", "促销价"]
+    assert df["售价"].tolist() == ["20/25", "30", "2"]
+
+
+def test_read_csv_without_header_falls_back_to_column_names(tmp_path):
+    path = _write_csv(tmp_path, BLANK_TOP_CSV)
+    df = try_read_and_clean(path, 0)
+    assert df.columns.tolist() == [f"Column_{i}" for i in range(5)]
+    assert df["Column_0"].tolist()[1:] == ["名称", "A"]
+
+
+@pytest.mark.parametrize("text,header_idx", [(TITLED_CSV, 1), (BLANK_TOP_CSV, 0)], ids=["title_row", "blank_top"])
+def test_stream_csv_matches_full_read(tmp_path, text, header_idx):
+    path = _write_csv(tmp_path, text)
+    full = try_read_and_clean(path, header_idx)
+    assert estimate_chunksize(path, header_idx) >= 100
+    streamed = pd.concat([c for c, _, _ in iter_clean_chunks(path, header_idx)], ignore_index=True)
+    pd.testing.assert_frame_equal(streamed, full)
+    small = [c for c, _, _ in iter_clean_chunks(path, header_idx, chunksize=1)]
+    assert len(small) == len(full) and all(c.columns.tolist() == full.columns.tolist() for c in small)
+
+
+# ============== 解析缓存（按文件内容哈希） ==============
+@pytest.fixture
+def parse_calls(monkeypatch):
+    """记录 read_and_clean_cached 实际解析了哪些文件（命中缓存时不解析）"""
+    import profit_core
+
+    calls = []
+    parse = profit_core.try_read_and_clean
+
+    def counted(path, *args, **kwargs):
+        calls.append(Path(path).name)
+        return parse(path, *args, **kwargs)
+
+    monkeypatch.setattr(profit_core, "try_read_and_clean", counted)
+    return calls
+
+
+def _cache_files(tmp_path):
+    return sorted(f.name.split("__")[0] for f in (tmp_path / PARSE_CACHE_DIRNAME).glob("*.pkl"))
+
+
+def test_parse_cache_hits_and_follows_file_content(tmp_path, parse_calls):
+    path = tmp_path / "a.csv"
+    path.write_text("名称,成本,售价\nA,10,20\n", encoding="utf-8")
+    first = read_and_clean_cached(path, 0)
+    pd.testing.assert_frame_equal(read_and_clean_cached(path, 0), first)
+    assert parse_calls == ["a.csv"]
+    # 只改 mtime、内容不变：重新算哈希，仍然命中
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+    read_and_clean_cached(path, 0)
+    assert parse_calls == ["a.csv"]
+    # 内容变了（大小相同）：哈希变化，重新解析
+    path.write_text("名称,成本,售价\nA,10,30\n", encoding="utf-8")
+    assert read_and_clean_cached(path, 0)["售价"].tolist() == [30]
+    assert parse_calls == ["a.csv", "a.csv"]
+    # 表头设置不同是另一份缓存
+    read_and_clean_cached(path, 1)
+    assert len(parse_calls) == 3 and _cache_files(tmp_path) == ["a.csv"] * 3
+    invalidate_parse_cache(path)
+    assert _cache_files(tmp_path) == []
+
+
+def test_parse_cache_evicts_least_recently_used(tmp_path, parse_calls):
+    paths = {}
+    for name in "abc":
+        paths[name] = tmp_path / f"{name}.csv"
+        paths[name].write_text(f"名称,成本,售价\n{name},10,20\n", encoding="utf-8")
+    read_and_clean_cached(paths["a"], 0)
+    read_and_clean_cached(paths["b"], 0)
+    pkl = {f.name[0]: f for f in (tmp_path / PARSE_CACHE_DIRNAME).glob("*.pkl")}
+    os.utime(pkl["a"], (1000, 1000))
+    os.utime(pkl["b"], (2000, 2000))
+    read_and_clean_cached(paths["a"], 0)  # 命中：刷新 a 的使用时间，b 变成最久未用
+    assert parse_calls == ["a.csv", "b.csv"]
+    budget = int(pkl["a"].stat().st_size * 2.5)
+    read_and_clean_cached(paths["c"], 0, cache_root=tmp_path, max_bytes=budget)
+    assert _cache_files(tmp_path) == ["a.csv", "c.csv"]
+    read_and_clean_cached(paths["b"], 0, cache_root=tmp_path, max_bytes=budget)  # 被淘汰的要重新解析
+    assert parse_calls == ["a.csv", "b.csv", "c.csv", "b.csv"]
+    assert _cache_files(tmp_path) == ["b.csv", "c.csv"]
+
+
+# ============== 重新上传：逐行对比 / 增量重算 / 变化报告 ==============
+def _versions():
+    old = _sheet()
+    new = old.copy()
+    new.loc[0, "SELLING PRICE"] = "20/30"       # A 改价
+    new = new.drop(index=3)                      # 删除 D
+    extra = pd.DataFrame({"DESCRIPTION": ["A", "Z"], "COST": [1, 2], "PROMOTION": [np.nan, np.nan],
+                          "SELLING PRICE": ["9", "50/60"], "PRICE 2": [np.nan, np.nan],
+                          "PROMO SELLING PRICE": [np.nan, np.nan]})
+    return old, pd.concat([new, extra], ignore_index=True)   # 新增第二个 A 和 Z
+
+
+def test_diff_sheets_aligns_by_name_and_occurrence():
+    old, new = _versions()
+    d = diff_sheets(old, new, MAPPINGS["mixed"])
+    assert d["changed"][0].tolist() == [0] and d["changed"][1].tolist() == [0]
+    assert d["removed"].tolist() == [3]
+    assert new["DESCRIPTION"].iloc[d["added"]].tolist() == ["A", "Z"]
+    assert sorted(d["unchanged"][0].tolist()) == [1, 2, 4, 5, 6, 7]
+    assert (d["n_old"], d["n_new"]) == (8, 9)
+
+
+@pytest.mark.parametrize("fee,conv", [(5.0, 1.0), (12.5, 4.2)])
+def test_update_profit_matches_full_recompute(fee, conv):
+    old, new = _versions()
+    mapping = MAPPINGS["mixed"]
+    old_result = sorted_results(compute_profit(old, mapping, fee, 10.0, conv, currency="THB", platform_label="X"))
+    got = update_profit(old_result, diff_sheets(old, new, mapping), new, mapping, fee, 10.0, conv,
+                        currency="THB", platform_label="X")
+    want = compute_profit(new, mapping, fee, 10.0, conv, currency="THB", platform_label="X")
+    # 同一行内多个价格的先后沿用 old_result（已按利润排序），按 (行, 卖价) 排好再比
+    by_row = lambda r: r.rename_axis("_row").sort_values(["_row", "卖价 (THB)"], kind="stable")
+    pd.testing.assert_frame_equal(by_row(got), by_row(want), check_dtype=False)
+
+
+def test_change_report_lists_changed_added_removed():
+    old, new = _versions()
+    mapping = MAPPINGS["mixed"]
+    report = change_report(old, new, mapping, diff_sheets(old, new, mapping), 0.0, 0.0, 1.0)
+    by = report.groupby("变化")["产品名称"].apply(sorted).to_dict()
+    assert by == {"修改": ["A"], "删除": ["D"], "新增": ["A", "Z", "Z"]}
+    a = report[report["变化"] == "修改"].iloc[0]
+    assert (a["卖价 旧 (MYR)"], a["卖价 新 (MYR)"], a["利润变化 (MYR)"]) == (25.0, 30.0, 5.0)
+
+
+@pytest.mark.parametrize("case", ["removed_only", "added_only", "unchanged", "unmapped_change"])
+def test_change_report_when_one_side_is_empty(case):
+    old = _sheet()
+    new = {
+        "removed_only": old.iloc[:5],
+        "added_only": pd.concat([old, old.iloc[:2].assign(DESCRIPTION=["Z1", "Z2"])], ignore_index=True),
+        "unchanged": old.copy(),
+        "unmapped_change": old.assign(extra="x"),
+    }[case]
+    mapping = MAPPINGS["mixed"]
+    report = change_report(old, new, mapping, diff_sheets(old, new, mapping), 5.0, 0.0, 1.0)
+    want = {"removed_only": {"删除"}, "added_only": {"新增"}, "unchanged": set(), "unmapped_change": set()}[case]
+    assert set(report["变化"]) == want
+    assert report["利润变化 (MYR)"].dtype == float
+
+
+# ============== 生效日期 ==============
+def _fees():
+    return pd.DataFrame({
+        "country": ["Thailand"] * 4,
+        "platform": ["Shopee"] * 4,
+        "scenario": ["基础佣金"] * 3 + ["大促"],
+        "fee_pct": [5.0, 8.0, 9.0, 3.0],
+        "remark": ["", "三月临时", "三月中旬", ""],
+        "effective_from": ["2024-01-01", "2024-03-01", "2024-03-10", "2024-01-01"],
+        "effective_to": [None, "2024-03-31", "2024-03-15", "2024-02-29"],
+    })
+
+
+DATES = ["2023-12-31", "2024-01-01", "2024-02-29", "2024-03-01", "2024-03-09", "2024-03-10",
+         "2024-03-15", "2024-03-16", "2024-03-31", "2024-04-01", "2024-05-01", None]
+
+
+def _fee_queries(scenario):
+    return pd.DataFrame({"country": "Thailand", "platform": "Shopee", "scenario": scenario,
+                         "date": pd.to_datetime(DATES)})
+
+
+def test_effective_positions_override_on_open_ended_base():
+    pos = effective_positions(_fees(), _fee_queries("基础佣金"), ["country", "platform", "scenario"])
+    assert pos.tolist() == [-1, 0, 0, 1, 1, 2, 2, 1, 1, 0, 0, -1]
+    pos = effective_positions(_fees(), _fee_queries("大促"), ["country", "platform", "scenario"])
+    assert pos.tolist() == [-1, 3, 3, -1, -1, -1, -1, -1, -1, -1, -1, -1]
+
+
+@pytest.mark.parametrize("day", [d for d in DATES if d])
+def test_effective_positions_agrees_with_fee_index(day):
+    fees = _fees()
+    pos = effective_positions(fees, _fee_queries("基础佣金").iloc[:1].assign(date=pd.Timestamp(day)),
+                              ["country", "platform", "scenario"])[0]
+    want = FeeIndex(fees, as_of=day).fee_pct("Thailand", "Shopee", "基础佣金")
+    assert (None if pos < 0 else fees["fee_pct"].iloc[pos]) == want
+
+
+def test_effective_conversion_falls_back_after_temporary_rate():
+    history = pd.DataFrame({"currency": ["THB", "THB"], "rate": [7.5, 8.0],
+                            "effective_from": ["2024-01-01", "2024-03-01"], "effective_to": [None, "2024-03-31"]})
+    dates = pd.to_datetime(["2023-06-01", "2024-02-01", "2024-03-15", "2024-05-01"]).to_numpy()
+    conv = effective_conversion(history, np.full(4, "THB", dtype=object), dates, {"THB": 7.0})
+    assert conv.tolist() == [7.0, 7.5, 8.0, 7.5]
+
+
+# ============== 结果样式（compute_profit 的 index 可重复） ==============
+def test_style_results_with_repeated_source_rows():
+    result = compute_profit(_sheet(), MAPPINGS["mixed"], 5.0, 0.0, 1.0)
+    assert not result.index.is_unique
+    html = style_results(result).to_html()
+    assert "#ffd6d6" in html and "#e6ffe6" in html
+    page, n_pages = result_page(result, 1, 5, sort_by="利润 (MYR)")
+    assert n_pages == -(-len(result) // 5)
+    assert style_results_page(page).to_html().count("<tr>") == len(page) + 1
+    assert style_results_page(result).to_html().count("<tr>") == len(result) + 1
+
+
+def _smart_format(x, prefix="", suffix=""):
+    """style_results 里逐格的格式化规则"""
+    if pd.isna(x):
+        return "-"
+    return f"{prefix}{int(x)}{suffix}" if float(x).is_integer() else f"{prefix}{x:,.2f}{suffix}"
+
+
+BIG = 2.0 ** 63
+
+
+@pytest.mark.parametrize("values", [
+    [BIG - 1024, BIG, -BIG, -BIG - 2048, 1e20, -1e300, 1.7e308],   # int64 边界两侧
+    [np.nan, np.inf, -np.inf, 0.0, -0.0, 12.5, -1234567.891, 3.0, BIG * 4 + 0.0],
+])
+def test_format_amounts_matches_cell_formatting(values):
+    got = format_amounts(values, prefix="RM ")
+    assert got.tolist() == [_smart_format(x, prefix="RM ") for x in values]
+    assert format_amounts(values).tolist() == [_smart_format(x) for x in values]
+
+
+# ============== 计算结果记忆（会话内） ==============
+def _frame(mb):
+    return pd.DataFrame({"x": np.zeros(int(mb * 2**20 / 8))})
+
+
+def test_result_memo_keeps_pinned_result_over_derived_entries():
+    memo = ResultMemo(max_entries=2)
+    result = memo.get_or_compute(("result", 1), lambda: _frame(0.01), pin=True)
+    for i in range(3):
+        memo.get_or_compute(("search_index", i), lambda: _frame(0.01))
+    assert memo.peek(("result", 1)) is result and memo.peek(("search_index", 2)) is not None
+    assert len(memo) == 2 and memo.evictions == 2
+    # 命中不会重新计算
+    assert memo.get_or_compute(("result", 1), lambda: pytest.fail("recomputed"), pin=True) is result
+    # 换了当前结果：旧结果不再受保护
+    memo.get_or_compute(("result", 2), lambda: _frame(0.01), pin=True)
+    memo.get_or_compute(("search_index", 3), lambda: _frame(0.01))
+    assert memo.peek(("result", 1)) is None and memo.peek(("result", 2)) is not None
+
+
+def test_result_memo_memory_limit_skips_pinned_result():
+    memo = ResultMemo(max_mb=1, max_entries=16)
+    memo.get_or_compute("other", lambda: _frame(0.2))
+    memo.get_or_compute("result", lambda: _frame(0.6), pin=True)
+    memo.get_or_compute("index", lambda: _frame(0.6))  # 超过上限：淘汰 other，result 和最近一条都保留
+    assert memo.peek("other") is None and memo.peek("result") is not None and memo.peek("index") is not None
+    memo.get_or_compute("ranking", lambda: _frame(0.1))
+    assert memo.peek("index") is None and memo.peek("result") is not None
+    memo.clear()
+    assert len(memo) == 0 and memo.pinned is None
+
+
+def test_result_memo_without_pin_evicts_least_recently_used():
+    memo = ResultMemo(max_entries=2)
+    for key in ["a", "b"]:
+        memo.get_or_compute(key, lambda: _frame(0.01))
+    memo.get_or_compute("a", lambda: pytest.fail("recomputed"))
+    memo.get_or_compute("c", lambda: _frame(0.01))
+    assert memo.peek("b") is None and memo.peek("a") is not None
+    assert memo.stats()["hits"] == 1 and memo.stats()["evictions"] == 1
+
+
+# ============== 费率配置版本库 ==============
+def _fee_version(pct):
+    return pd.DataFrame([["Thailand", "Shopee", "基础佣金", pct, ""]],
+                        columns=["country", "platform", "scenario", "fee_pct", "remark"])
+
+
+def test_fee_config_identical_saves_share_one_blob(tmp_path):
+    store = FeeConfigStore(tmp_path / "fees", legacy_file=None)  # 首次使用写入示例配置
+    objects = tmp_path / "fees" / "objects"
+    assert len(list(objects.glob("*.csv"))) == 1 and len(store.versions()) == 1
+    first = store.save(_fee_version(8.0), note="v1")
+    assert store.save(_fee_version(8.0), note="again") == first  # 与当前版本相同：不存、不记
+    assert len(list(objects.glob("*.csv"))) == 2 and store.versions()["note"].tolist() == ["v1", "示例配置"]
+    second = store.save(_fee_version(9.0), note="v2")
+    assert store.save(_fee_version(8.0), note="v1 again") == first  # 内容和旧版本相同：复用对象，只移动 HEAD
+    assert len(list(objects.glob("*.csv"))) == 3 and store.head() == first != second
+    assert store.versions()["note"].tolist()[:3] == ["v1 again", "v2", "v1"]
+
+
+def test_fee_config_checkout_rolls_back(tmp_path):
+    store = FeeConfigStore(tmp_path / "fees", legacy_file=None)
+    v1 = store.save(_fee_version(8.0), note="v1")
+    v2 = store.save(_fee_version(9.0), note="v2")
+    assert store.index().fee_pct("Thailand", "Shopee", "基础佣金") == 9.0
+    store.checkout(v1)
+    assert store.head() == v1
+    assert store.load()["fee_pct"].tolist() == [8.0]
+    assert store.index().fee_pct("Thailand", "Shopee", "基础佣金") == 8.0
+    assert store.versions()["note"].iloc[0] == f"回滚 → {v1[:8]}"
+    n = len(store.versions())
+    store.checkout(v1)  # 已是当前版本：不再记一条
+    assert len(store.versions()) == n
+    # 回滚只换 HEAD：新实例读到的也是 v1，v2 仍可取回
+    again = FeeConfigStore(tmp_path / "fees", legacy_file=None)
+    assert again.head() == v1 and again.load(v2)["fee_pct"].tolist() == [9.0]
+    with pytest.raises(KeyError):
+        store.checkout("0" * 40)
+
+
+# ============== 并发写入（多个会话线程同时保存） ==============
+def test_fee_config_concurrent_saves(tmp_path):
+    store = FeeConfigStore(tmp_path / "fees", legacy_file=tmp_path / "missing.csv")
+    errors = []
+
+    def save_many(worker):
+        try:
+            for i in range(50):
+                store.save(pd.DataFrame([["Thailand", "Shopee", f"方案{worker}", float(i), ""]],
+                                        columns=["country", "platform", "scenario", "fee_pct", "remark"]))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save_many, args=(w,)) for w in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert store.head() is not None
+    assert not list((tmp_path / "fees").rglob("*.tmp"))
+
+
+# ============== 批量上传后清掉页面进程的共享缓存 ==============
+def test_bulk_reupload_invalidates_shared_cache(tmp_path):
+    upload_dir, meta_db = tmp_path / "uploads", tmp_path / "meta.sqlite"
+    sheet = "产品信息,,成本,售价\nSKU,DESCRIPTION,COST,SELLING PRICE\n"
+    cache = SharedFrameCache()
+
+    def upload(body):
+        tasks, _ = upload_tasks([("Thailand/a.csv", (sheet + body).encode("utf-8"))],
+                                upload_dir=upload_dir, meta_db=meta_db)
+        jobs = UploadJobs()
+        with process_pool(1) as pool:
+            jobs.submit(pool, tasks)
+        return jobs
+
+    jobs = upload("1,A,10,20\n")
+    assert jobs.sync() == 1 and jobs.sync() == 0
+    path = upload_dir / "Thailand" / "a.csv"
+    first = read_and_clean_shared(str(path), 1, cache_root=upload_dir, holder="s1", cache=cache)
+    assert cache.stats()["entries"] == 1
+
+    jobs = upload("1,A,10,20\n2,B,5,9\n")
+    # 覆盖发生在工作进程里，本进程的共享缓存要等 sync 才清
+    assert cache.stats()["entries"] == 1
+    jobs.sync()
+    assert cache.stats()["entries"] == 0
+    second = read_and_clean_shared(str(path), 1, cache_root=upload_dir, holder="s1", cache=cache)
+    assert len(first) == 1 and len(second) == 2
+
+
+# ============== 跨国家商品名归一化（中文 / 泰文不能被当成分隔符） ==============
+NAMES = ["ครีมกันแดด SPF50", "防晒霜（50ml）", "Sun-Cream_50 ML", "ＦＵＬＬ　ＷＩＤＴＨ", "सनस्क्रीन क्रीम", "Kem chống nắng"]
+
+
+def test_normalize_names_keeps_non_ascii_letters():
+    want = ["ครีมกันแดด spf50", "防晒霜 50ml", "sun cream 50 ml", "full width", "सनस्क्रीन क्रीम", "kem chống nắng"]
+    assert normalize_names(NAMES).tolist() == want
+    assert normalize_names(pd.Series(NAMES, dtype=object)).tolist() == want
+    assert [normalize_name(n) for n in NAMES] == want
+
+
+def test_catalog_joins_thai_names_across_countries():
+    th = pd.DataFrame({"产品名称": ["ครีมกันแดด", "ยาสีฟัน"], "利润 (MYR)": [3.0, 1.0]})
+    my = pd.DataFrame({"产品名称": ["ครีมกันแดด ", "防晒霜"], "利润 (MYR)": [5.0, 2.0]})
+    wide, _ = consolidate_catalog({"Thailand": th, "Malaysia": my})
+    assert len(wide) == 3
+    assert wide["覆盖国家数"].tolist().count(2) == 1
+
+
+# ============== 产品名搜索索引 ==============
+SEARCH_NAMES = ["Red Apple Juice", "Apple", "Pineapple juice", "apple pie", "Green apple juice 1L", "Juicer",
+                "ครีมกันแดด SPF50", "กันแดด", "防晒霜 50ml", "儿童防晒霜", "洗面奶", "abc bcd", np.nan, "Apple"]
+
+
+def test_search_ranks_exact_prefix_word_then_contains():
+    index = ProductSearchIndex(SEARCH_NAMES)
+    assert len(index) == 12  # 去重、去掉空值
+    assert index.search("apple") == ["Apple", "apple pie", "Red Apple Juice", "Green apple juice 1L",
+                                     "Pineapple juice"]
+    assert index.search("apple juice") == ["Red Apple Juice", "Green apple juice 1L", "Pineapple juice"]
+    assert index.search("JUICE  apple!") == index.search("apple juice")
+    assert sorted(index.matching("apple juice")) == ["Green apple juice 1L", "Pineapple juice", "Red Apple Juice"]
+
+
+def test_search_thai_and_cjk_substrings():
+    index = ProductSearchIndex(SEARCH_NAMES)
+    assert index.search("กันแดด") == ["กันแดด", "ครีมกันแดด SPF50"]
+    assert index.search("ครีมกันแดด spf") == ["ครีมกันแดด SPF50"]
+    assert index.search("防晒") == ["防晒霜 50ml", "儿童防晒霜"]
+    assert index.search("霜") == ["儿童防晒霜", "防晒霜 50ml"]
+    assert sorted(index.matching("防晒霜")) == ["儿童防晒霜", "防晒霜 50ml"]
+
+
+def test_search_confirms_long_terms_beyond_trigrams():
+    # "abc bcd" 含 abc / bcd 两个三元组，但不含 "abcd"
+    index = ProductSearchIndex(SEARCH_NAMES)
+    assert index.search("abcd") == [] and len(index.matching("abcd")) == 0
+    assert index.search("abc") == ["abc bcd"]
+
+
+@pytest.mark.parametrize("query", ["", "   ", "!!! --", "・"])
+def test_search_empty_query_means_no_filter(query):
+    index = ProductSearchIndex(SEARCH_NAMES)
+    assert index.search(query) is None and index.matching(query) is None
+
+
+def test_search_limit_cutoff():
+    names = [f"item {i}" for i in range(100)] + ["item"]
+    index = ProductSearchIndex(names)
+    assert index.search("item", limit=5) == ["item", "item 0", "item 1", "item 2", "item 3"]
+    assert len(index.search("item")) == min(SEARCH_MAX_RESULTS, 101)
+    assert index.search("item 1", limit=3) == ["item 1", "item 10", "item 11"]
+    assert len(index.matching("item")) == 101
+
+
+def test_matching_agrees_with_substring_scan():
+    rng = np.random.default_rng(3)
+    alphabet = list("abcde ") + ["ก", "ั", "น", "防", "晒"]
+    names = ["".join(rng.choice(alphabet, size=rng.integers(1, 12))) for _ in range(400)]
+    index = ProductSearchIndex(names)
+    norm = dict(zip(index.names, normalize_names(index.names)))
+    for _ in range(200):
+        query = "".join(rng.choice(alphabet, size=rng.integers(1, 6)))
+        terms = normalize_name(query).split()
+        if not terms:
+            assert index.matching(query) is None
+            continue
+        want = sorted(n for n, x in norm.items() if all(t in x for t in terms))
+        assert sorted(index.matching(query)) == want
+        assert sorted(index.search(query, limit=len(index))) == want
+
+
+# ============== 多工作表 Excel ==============
+@pytest.fixture
+def workbook(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    wb = openpyxl.Workbook()
+    jan = wb.active
+    jan.title = "Jan"
+    for row in [["Jan price list"], ["名称", "成本", "售价"], ["A", 10, "20/25"], ["B", 12, "30"]]:
+        jan.append(row)
+    feb = wb.create_sheet("Feb")  # 多一行标题，表头低一行
+    for row in [["Feb price list"], ["updated 2025-02-03"], ["名称", "成本", "售价"], ["C", 5, "9"]]:
+        feb.append(row)
+    wb.create_sheet("Notes")  # 空表
+    mar = wb.create_sheet("Mar")  # 没有标题行，列顺序不同、多一列
+    for row in [["名称", "售价", "成本", "备注"], ["D", "40", 20, "new"]]:
+        mar.append(row)
+    path = tmp_path / "book.xlsx"
+    wb.save(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_read_workbook_aligns_sheets(workbook, workers):
+    df = read_workbook(workbook, 1, max_workers=workers)
+    assert df.columns.tolist() == [SHEET_COLUMN, "名称", "成本", "售价", "备注"]
+    assert df[SHEET_COLUMN].tolist() == ["Jan", "Jan", "Feb", "Mar"]
+    assert df["名称"].tolist() == ["A", "B", "C", "D"]
+    assert df["售价"].astype(str).tolist() == ["20/25", "30", "9", "40"]
+    assert df["成本"].astype(float).tolist() == [10, 12, 5, 20]
+
+
+def test_read_workbook_selected_and_empty_sheets(workbook):
+    assert read_workbook(workbook, 1, sheets=["Mar", "Feb"], max_workers=2)["名称"].tolist() == ["D", "C"]
+    empty = read_workbook(workbook, 1, sheets=["Notes"])
+    assert empty.columns.tolist() == [SHEET_COLUMN] and empty.empty
+
+
+def test_read_workbook_sheet_errors_propagate(workbook):
+    with pytest.raises(ValueError, match="Nope"):
+        read_workbook(workbook, 1, sheets=["Jan", "Nope"], max_workers=2)
+
+
+# ============== 价格敏感度扫描 / 保本价 ==============
+FEE_GRID = [("无抽成", 0.0), ("Shopee", 5.5), ("Lazada 大促", 12.0)]
+SHOCKS = [-0.1, 0.0, 0.25]
+
+
+@pytest.mark.parametrize("kind", ["normal", "mixed"])
+def test_sweep_profit_matches_compute_profit(kind):
+    df, mapping, conv = _sheet(), MAPPINGS[kind], 4.2
+    sweep = sweep_profit(df, mapping, FEE_GRID, conv, rate_shocks=SHOCKS, commissions=[0.0, 10.0],
+                         currency="THB", dtype=np.float64)
+    cols = result_columns("THB")
+    assert sweep.shape == (len(sweep.items), len(FEE_GRID), len(SHOCKS))
+    summary = sweep.summary()
+    for f, (_, fee) in enumerate(FEE_GRID):
+        for r, shock in enumerate(SHOCKS):
+            want = compute_profit(df, mapping, fee, 10.0, conv * (1 + shock), currency="THB")
+            assert sweep.items[cols[0]].tolist() == want[cols[0]].tolist()
+            np.testing.assert_allclose(sweep.profit_myr[:, f, r], want[cols[4]].to_numpy(dtype=float))
+            np.testing.assert_allclose(sweep.commission_myr(1)[:, f, r], want[cols[6]].to_numpy(dtype=float))
+            np.testing.assert_allclose(sweep.margin_pct[:, f], want[cols[5]].to_numpy(dtype=float))
+            row = summary.iloc[f * len(SHOCKS) + r]
+            assert row["总利润 (MYR)"] == pytest.approx(want[cols[4]].sum())
+            assert row["亏损价格数"] == (want[cols[4]] < 0).sum()
+
+
+def test_sweep_profit_float32_cube_is_close():
+    sweep = sweep_profit(_sheet(), MAPPINGS["mixed"], FEE_GRID, 4.2, rate_shocks=SHOCKS)
+    exact = sweep_profit(_sheet(), MAPPINGS["mixed"], FEE_GRID, 4.2, rate_shocks=SHOCKS, dtype=np.float64)
+    assert sweep.profit_myr.dtype == np.float32
+    np.testing.assert_allclose(sweep.profit_myr, exact.profit_myr, rtol=1e-6)
+
+
+@pytest.mark.parametrize("fee", [0.0, 5.5, 12.0, 99.0])
+def test_break_even_price_zeroes_profit(fee):
+    sweep = sweep_profit(_sheet(), MAPPINGS["mixed"], [("x", fee)], 4.2, dtype=np.float64)
+    cost = sweep.items["成本 (MYR)"].to_numpy(dtype=float)
+    be = sweep.break_even[:, 0]
+    np.testing.assert_allclose(be, break_even_price(cost, fee))
+    # 按保本价卖：利润为 0；高一分赚、低一分亏
+    at = pd.DataFrame({"DESCRIPTION": sweep.items["产品名称"].to_numpy(), "COST": cost, "PRICE": be})
+    mapping = {"name": "DESCRIPTION", "cost": "COST", "promo_cost": None, "promo_price": None,
+               "price_cols": ["PRICE"]}
+    profit = compute_profit(at, mapping, fee, 0.0, 4.2)["利润 (MYR)"].to_numpy(dtype=float)
+    np.testing.assert_allclose(profit, 0.0, atol=1e-9)
+    _, up, _, _ = profit_columns(cost, be + 0.01, fee, 0.0, 1.0)
+    _, down, _, _ = profit_columns(cost, be - 0.01, fee, 0.0, 1.0)
+    assert (up > 0).all() and (down < 0).all()
+
+
+def test_break_even_price_without_solution():
+    assert np.isnan(break_even_price([10.0, 0.0], [100.0, 150.0])).all()
+    table = sweep_profit(_sheet(), MAPPINGS["mixed"], FEE_GRID + [("全抽", 100.0)], 1.0).break_even_table()
+    assert table.columns[-4:].tolist() == [f"保本价 | {label}" for label in ["无抽成", "Shopee", "Lazada 大促", "全抽"]]
+    assert table["保本价 | 全抽"].isna().all()
+    assert table["保本价 | 无抽成"].tolist() == table["成本 (MYR)"].tolist()
@@ -0,0 +1,240 @@
+# upload_pipeline.py
+# -*- coding: utf-8 -*-
+"""
+多文件上传：一次上传 / 导入多张价钱表（可跨国家），后台进程池并行解析
+- 国家按文件所在文件夹或文件名识别（国家名 / 中文名 / 币种代码；文件夹名也可以是国家代码），识别不出的用默认国家
+- 每个文件一个任务：写入 uploads/<国家>/（同名覆盖时旧版本挪到 .previous/）→ 解析（结果进解析缓存）→ 写上传记录
+- 页面端用 UploadJobs 只保存 Future 并定时轮询状态，解析期间页面照常可用；
+  完成的任务在页面进程里清掉被覆盖文件的共享缓存（SHARED_CACHE 只在本进程，工作进程清不到）
+
+用法：
+    python upload_pipeline.py 价钱表目录/ [更多文件或目录...] [--country Thailand] [--workers 8] [--header-row 2]
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+import time
+from concurrent.futures import as_completed
+from pathlib import Path, PurePath
+
+import pandas as pd
+
+from profit_core import (
+    COUNTRY_CURRENCY, META_DB, UPLOAD_DIR, MetaStore, archive_previous_version, count_rows, invalidate_shared_caches,
+    process_pool, read_and_clean_cached, temp_path,
+)
+
+UPLOAD_TYPES = ["xlsx", "xls", "csv"]
+
+# 文件名 / 文件夹名里能认出国家的写法（不区分大小写）；国家代码太短，只在整个文件夹名等于它时才算
+COUNTRY_ALIASES = {
+    "Thailand": ["thailand", "thai", "thb", "泰国"],
+    "Malaysia": ["malaysia", "myr", "马来西亚", "大马"],
+    "Vietnam": ["vietnam", "viet nam", "vnd", "越南"],
+    "Philippines": ["philippines", "php", "菲律宾"],
+    "Indonesia": ["indonesia", "idr", "印尼", "印度尼西亚"],
+}
+COUNTRY_CODES = {"th": "Thailand", "my": "Malaysia", "vn": "Vietnam", "ph": "Philippines", "id": "Indonesia"}
+
+_TOKEN_RE = re.compile(r"[a-z]+|[^\x00-\x7f]+")
+
+def _country_in(text):
+    text = text.lower()
+    tokens = set(_TOKEN_RE.findall(text))
+    for country, aliases in COUNTRY_ALIASES.items():
+        for alias in aliases:
+            # 英文按整词匹配（避免别的单词里碰巧含 “php” 之类）；中文按子串
+            if alias.isascii():
+                hit = alias in tokens or (" " in alias and alias in text)
+            else:
+                hit = alias in text
+            if hit:
+                return country
+    return None
+
+def guess_country(name, default=None):
+    """
+    按路径识别国家：先看文件夹（由近到远，整名等于国家代码也算），再看文件名；都认不出返回 default
+    name 可以是目录上传得到的相对路径（如 "Thailand/a.xlsx"）
+    """
+    p = PurePath(str(name).replace("\\", "/"))
+    for folder in reversed(p.parent.parts):
+        country = COUNTRY_CODES.get(folder.strip().lower()) or _country_in(folder)
+        if country in COUNTRY_CURRENCY:
+            return country
+    country = _country_in(p.stem)
+    return country if country in COUNTRY_CURRENCY else default
+
+def ingest_upload(task):
+    """
+    单个文件（在工作进程里执行）：写入 → 解析 → 上传记录
+    task: {"country", "filename", "data"（bytes）或 "src"（源文件路径）, "upload_dir", "meta_db", "header_idx", "merge_multirow"}
+    内容与上次相同则不重写文件；解析失败时文件和记录照常保存（可在页面上改表头行后再试），状态为“解析失败”
+    返回 {"status", "rows", "columns", "error", "path"（保存位置）, "changed"（是否写了新内容）, "seconds"}
+    """
+    start = time.perf_counter()
+    data = task["data"] if task.get("data") is not None else Path(task["src"]).read_bytes()
+    upload_dir = Path(task["upload_dir"])
+    save_path = upload_dir / task["country"] / task["filename"]
+    digest = hashlib.sha1(data).hexdigest()
+    store = MetaStore(task["meta_db"])
+    saved = store.get(task["country"], task["filename"])
+    changed = saved is None or saved["content_hash"] != digest or not save_path.exists()
+    if changed:
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        archive_previous_version(save_path)
+        tmp = temp_path(save_path)
+        tmp.write_bytes(data)
+        os.replace(tmp, save_path)
+
+    out = {"status": "已保存" if changed else "未变化", "rows": None, "columns": None, "error": None,
+           "path": str(save_path), "changed": changed}
+    try:
+        df = read_and_clean_cached(save_path, task["header_idx"], merge_multirow=task["merge_multirow"],
+                                   cache_root=upload_dir)
+        out.update(rows=len(df), columns=len(df.columns))
+    except Exception as e:
+        out.update(status="解析失败", error=str(e))
+    if changed:
+        store.upsert(task["country"], task["filename"], save_path, content_hash=digest, n_rows=count_rows(save_path))
+    out["seconds"] = time.perf_counter() - start
+    return out
+
+def upload_tasks(files, default_country=None, header_idx=1, merge_multirow=False,
+                 upload_dir=UPLOAD_DIR, meta_db=META_DB):
+    """
+    files: [(名称或相对路径, bytes 或 源文件路径), ...] → 任务列表
+    国家按 guess_country 识别；识别不出又没有默认国家的文件不会生成任务（放在第二个返回值里）
+    同一国家下同名文件只保留最后一个
+    返回 (任务列表, 未识别国家的名称列表)
+    """
+    tasks, unknown = {}, []
+    for name, payload in files:
+        country = guess_country(name, default_country)
+        if country is None:
+            unknown.append(str(name))
+            continue
+        filename = PurePath(str(name).replace("\\", "/")).name
+        is_bytes = isinstance(payload, (bytes, bytearray, memoryview))
+        tasks[(country, filename)] = {
+            "name": str(name),
+            "country": country,
+            "filename": filename,
+            "data": bytes(payload) if is_bytes else None,
+            "src": None if is_bytes else str(payload),
+            "upload_dir": str(upload_dir),
+            "meta_db": str(meta_db),
+            "header_idx": header_idx,
+            "merge_multirow": merge_multirow,
+        }
+    return list(tasks.values()), unknown
+
+class UploadJobs:
+    """
+    一个会话的上传任务（放在 st.session_state 里）：只保存 Future，状态在页面重跑 / 定时刷新时轮询
+    executor 由调用方提供（多个会话可以共用一个进程池）
+    """
+
+    def __init__(self):
+        self.jobs = []  # [{"country", "filename", "future", "synced"}]
+
+    def submit(self, executor, tasks):
+        for task in tasks:
+            self.jobs.append({"country": task["country"], "filename": task["filename"],
+                              "future": executor.submit(ingest_upload, task), "synced": False})
+
+    def sync(self):
+        """
+        在页面进程里处理刚完成的任务（每个只处理一次）：写了新内容的文件，
+        把本进程共享缓存里它和它旧版本的条目清掉，其它会话下次重跑时读新版本
+        返回本次处理的任务数
+        """
+        n = 0
+        for job in self.jobs:
+            if job.get("synced", True) or not job["future"].done():
+                continue
+            job["synced"] = True
+            n += 1
+            try:
+                out = job["future"].result()
+            except Exception:
+                continue
+            if out.get("changed"):
+                invalidate_shared_caches(out["path"])
+        return n
+
+    @property
+    def pending(self):
+        return sum(not job["future"].done() for job in self.jobs)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def clear_finished(self):
+        self.jobs = [job for job in self.jobs if not job["future"].done()]
+
+    def table(self):
+        """每个文件一行：国家 / 文件 / 状态 / 行数 / 列数 / 耗时 / 错误"""
+        rows = []
+        for job in self.jobs:
+            fut = job["future"]
+            row = {"国家": job["country"], "文件": job["filename"], "状态": "排队中",
+                   "行数": None, "列数": None, "耗时 (s)": None, "错误": None}
+            if fut.done():
+                try:
+                    out = fut.result()
+                    row.update({"状态": out["status"], "行数": out["rows"], "列数": out["columns"],
+                                "耗时 (s)": round(out["seconds"], 2), "错误": out["error"]})
+                except Exception as e:
+                    row.update({"状态": "失败", "错误": str(e)})
+            elif fut.running():
+                row["状态"] = "解析中"
+            rows.append(row)
+        return pd.DataFrame(rows, columns=["国家", "文件", "状态", "行数", "列数", "耗时 (s)", "错误"])
+
+def _iter_sources(paths):
+    """命令行参数里的文件 / 目录 → (相对名称, 文件路径)；目录递归，名称保留目录名以便按文件夹识别国家"""
+    for arg in paths:
+        root = Path(arg)
+        if root.is_dir():
+            for f in sorted(root.rglob("*")):
+                if f.is_file() and f.suffix.lower().lstrip(".") in UPLOAD_TYPES and not f.name.startswith("."):
+                    yield str(f.relative_to(root.parent)), f
+        else:
+            yield root.name, root
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量导入价钱表：按文件夹 / 文件名识别国家，多进程并行解析")
+    parser.add_argument("paths", nargs="+", help="价钱表文件或目录（目录递归查找 xlsx / xls / csv）")
+    parser.add_argument("--country", choices=list(COUNTRY_CURRENCY), help="识别不出国家时使用的默认国家")
+    parser.add_argument("--meta", default=str(META_DB), help="上传记录（默认 file_metadata.sqlite）")
+    parser.add_argument("--upload-dir", default=str(UPLOAD_DIR), help="上传目录（默认 uploads/）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="进程数（默认 CPU 核数）")
+    parser.add_argument("--header-row", type=int, default=2, help="表头所在行（从 1 开始，默认 2）")
+    parser.add_argument("--merge-multirow", action="store_true", help="强制合并多行表头")
+    args = parser.parse_args(argv)
+
+    MetaStore(args.meta)  # 建表 / 迁移只在这里做一次
+    tasks, unknown = upload_tasks(_iter_sources(args.paths), args.country, header_idx=args.header_row - 1,
+                                  merge_multirow=args.merge_multirow, upload_dir=args.upload_dir, meta_db=args.meta)
+    for name in unknown:
+        print(f"跳过（认不出国家，可用 --country 指定）：{name}", file=sys.stderr)
+    failed = 0
+    with process_pool(args.workers) as pool:
+        futures = {pool.submit(ingest_upload, task): task for task in tasks}
+        for fut in as_completed(futures):
+            task = futures[fut]
+            try:
+                out = fut.result()
+            except Exception as e:
+                out = {"status": "失败", "error": str(e)}
+            failed += out["status"] in ("失败", "解析失败")
+            detail = out["error"] or f"{out['rows']:,} 行 × {out['columns']} 列"
+            print(f"[{out['status']}] {task['country']} / {task['filename']}：{detail}")
+    return 1 if failed or unknown else 0
+
+if __name__ == "__main__":
+    sys.exit(main())